@@ -1,9 +1,25 @@
-import re, StringIO
+import os, re, json, time, heapq, fnmatch
+from collections import deque
+from zope.interface import implements
 from twisted.python import log
+from twisted.internet import defer
+from buildbot.interfaces import IRenderable
+from buildbot.process.buildstep import BuildStep, LogLineObserver
+from buildbot.process.buildstep import RemoteShellCommand
+from buildbot.process.properties import Property
 from buildbot.steps.shell import ShellCommand, WithProperties, Compile
+from buildbot.steps.shell import SetPropertyFromCommand
+from buildbot.steps.source.git import Git
 from buildbot.status.builder import FAILURE, SUCCESS, WARNINGS, SKIPPED
+from buildbot.status.testresult import TestResult
 from buildbot.status.github import GitHubStatus
 from buildbot.steps.python_twisted import TrialTestCaseCounter, countFailedTests
+from metrichistory import check_regression, linear_fit, sparkline
+from sqlitestore import median
+from coveragehistory import coverage_delta
+from warningindex import fingerprint_warnings
+from githubqueue import StatusQueue, GitHubStatusDelivery
+from resultcache import factory_fingerprint
 
 class PythonCommand(ShellCommand):
     # set python_command= to a list of everything but the leading "python",
@@ -36,6 +52,9 @@ class ToolVersions(PythonCommand):
             mo = python_re.search(line)
             if mo:
                 self.tool_versions.append( ("py", mo.group(1)) )
+                # version, build and compiler: what the tox cache keys on
+                self.setProperty("python-fingerprint",
+                                 line[len("python:"):].strip(), "ToolVersions")
             mo = twisted_re.search(line)
             if mo:
                 self.tool_versions.append( ("tw", mo.group(1)) )
@@ -46,6 +65,81 @@ class ToolVersions(PythonCommand):
             text.append(tool + version)
         return text
 
+class MirroredGit(Git):
+    """
+    A Git checkout that borrows objects from a bare mirror shared by all the
+    builders on a buildslave. Before each checkout we fetch the build's
+    repository into the mirror (under refs/mirror/<repourl>/, so forks
+    don't collide), and fresh clones use it with --reference, so a clobber
+    only copies what the mirror doesn't already have. Otherwise it is the
+    usual in-place fetch, reset and clean.
+
+    The time the checkout took (mirror update included) and how much the
+    builder's own repository grew are set as the checkout-seconds and
+    checkout-bytes properties.
+    """
+    def __init__(self, mirror="../../git-mirror.git", **kwargs):
+        # 'mirror' is relative to the workdir, which is usually
+        # <slave basedir>/<builder>/build
+        kwargs.setdefault("reference", mirror)
+        Git.__init__(self, **kwargs)
+        self.addFactoryArguments(mirror=mirror)
+        self.mirror = mirror
+
+    def full(self):
+        return self._measured(Git.full)
+
+    def incremental(self):
+        return self._measured(Git.incremental)
+
+    @defer.inlineCallbacks
+    def _measured(self, checkout):
+        started = time.time()
+        yield self.updateMirror()
+        before = yield self.repositoryBytes()
+        res = yield checkout(self)
+        after = yield self.repositoryBytes()
+        self.setProperty("checkout-seconds", round(time.time() - started, 1),
+                         "MirroredGit")
+        self.setProperty("checkout-bytes", max(0, after - before),
+                         "MirroredGit")
+        defer.returnValue(res)
+
+    @defer.inlineCallbacks
+    def updateMirror(self):
+        # a broken or busy mirror only costs us the savings, so none of
+        # this can fail the checkout. The mirror never runs gc: builders'
+        # clones point into it, and pruning a force-pushed branch would
+        # take objects they still use.
+        key = re.sub(r'[^A-Za-z0-9]+', '_', self.repourl).strip("_")
+        rc = yield self._dovccmd(["init", "--bare", "--quiet", self.mirror],
+                                 abandonOnFailure=False)
+        if rc != 0:
+            # and a clone with --reference to a missing mirror would fail
+            if self.reference == self.mirror:
+                self.reference = None
+            return
+        yield self._dovccmd(["--git-dir", self.mirror, "config", "gc.auto", "0"],
+                            abandonOnFailure=False)
+        yield self._dovccmd(["--git-dir", self.mirror, "fetch", "--quiet",
+                             "--no-tags", self.repourl,
+                             "+refs/heads/*:refs/mirror/%s/*" % key],
+                            abandonOnFailure=False)
+
+    @defer.inlineCallbacks
+    def repositoryBytes(self):
+        # 'size' (loose objects) and 'size-pack' are in KiB. There is no
+        # repository yet before the first clone.
+        stdout = yield self._dovccmd(["count-objects", "-v"],
+                                     abandonOnFailure=False,
+                                     collectStdout=True)
+        size = 0
+        for line in (stdout or "").splitlines():
+            name, _, value = line.partition(":")
+            if name in ("size", "size-pack"):
+                size += int(value.strip() or 0) * 1024
+        defer.returnValue(size)
+
 class CompileAndShowVersion(Compile):
     """Emit the version number in the status box
     """
@@ -78,33 +172,95 @@ class BuildTahoe(PythonCommand):
     descriptionDone = ["build"]
     python_command = ["setup.py", "-v", "build"]
 
-def parse_timings(log):
-    # scan the log, measure time consumed per test, show a sorted list
-    # with the most time-consuming test at the top
-    last_test = None
-    tests = []
+class TestTimings:
+    """
+    Accumulate per-test durations from --reporter=timing output, one line at
+    a time.
+    """
     test_re = re.compile(r'^(allmydata\.test\.\S+) \.\.\.')
     time_re = re.compile(r'^\(([\d\.]+) secs\)')
-    for line in log.readlines():
+
+    def __init__(self):
+        self.last_test = None
+        self.tests = []
+
+    def feed(self, line):
         line = line.strip()
-        mo = test_re.search(line)
+        mo = self.test_re.search(line)
         if mo:
-            last_test = mo.group(1)
-            continue
-        if not last_test:
-            continue
-        mo = time_re.search(line.strip())
+            self.last_test = mo.group(1)
+            return
+        if not self.last_test:
+            return
+        mo = self.time_re.search(line)
         if mo:
-            t0 = float(mo.group(1))
-            tests.append( (t0, last_test) )
-            last_test = None
-    tests.sort()
-    tests.reverse()
-    if tests:
-        timings = "\n".join(["%7s seconds: %s" % (("%.3f" % t[0]), t[1])
-                             for t in tests]) + "\n"
-        return timings
-    return None
+            self.tests.append( (float(mo.group(1)), self.last_test) )
+            self.last_test = None
+
+    def format(self):
+        # show a sorted list with the most time-consuming test at the top
+        if not self.tests:
+            return None
+        tests = sorted(self.tests, reverse=True)
+        return "\n".join(["%7s seconds: %s" % (("%.3f" % t[0]), t[1])
+                          for t in tests]) + "\n"
+
+def read_timings(log):
+    timings = TestTimings()
+    for line in log.readlines():
+        timings.feed(line)
+    return timings
+
+def parse_timings(log):
+    # scan the log, measure time consumed per test, show a sorted list
+    # with the most time-consuming test at the top
+    return read_timings(log).format()
+
+def record_test_history(step, history, timings, outcomes={}):
+    # remember this build's per-test durations and outcomes (see
+    # testhistory.py)
+    revision = (step.getProperty("got_revision", None) or
+                step.getProperty("revision", None))
+    try:
+        history.record(step.getProperty("buildername"),
+                       step.getProperty("buildnumber"),
+                       revision, timings.tests, outcomes)
+    except Exception:
+        log.err(None, "unable to record test history")
+
+def index_warnings(step, index, warnings):
+    # fingerprint this build's warnings (a dict of warning text to count)
+    # and remember them, see warningindex.py. Returns the number of
+    # fingerprints no earlier build had, or None if the index couldn't be
+    # updated.
+    grouped = fingerprint_warnings(warnings)
+    revision = (step.getProperty("got_revision", None) or
+                step.getProperty("revision", None))
+    try:
+        new = index.record(step.getProperty("buildername"),
+                           step.getProperty("buildnumber"),
+                           revision, grouped, step.name)
+    except Exception:
+        log.err(None, "unable to record warnings")
+        return None
+    step.setProperty("warnings-distinct", len(grouped), "WarningIndex")
+    step.setProperty("warnings-new", len(new), "WarningIndex")
+    if new:
+        lines = []
+        for fp in new:
+            example = grouped[fp][1]
+            if not example.endswith("\n"):
+                example += "\n"
+            lines.append("%s in %s (%d times):\n%s\n"
+                         % (fp[0], fp[1] or "unknown module", grouped[fp][0],
+                            example))
+        step.addCompleteLog("new-warnings", "".join(lines))
+    return len(new)
+
+def new_warnings_text(new):
+    if not new:
+        return []
+    return ["%d new %s" % (new, new == 1 and "warning" or "warnings")]
 
 class BuiltTest(PythonCommand):
     """
@@ -117,188 +273,424 @@ class BuiltTest(PythonCommand):
     descriptionDone = ["test"]
     logfiles = {"test.log": "_trial_temp/test.log"}
 
-    def __init__(self, test_suite=None, *args, **kwargs):
+    def __init__(self, test_suite=None, history=None, *args, **kwargs):
         python_command = ["setup.py", "test", "--reporter=timing"]
         if test_suite is not None:
             python_command.extend(["--suite", test_suite])
         kwargs["python_command"] = python_command
         PythonCommand.__init__(self, *args, **kwargs)
-        self.addFactoryArguments(test_suite=test_suite)
+        self.addFactoryArguments(test_suite=test_suite, history=history)
+        self.history = history
 
     def createSummary(self, log):
-        timings = parse_timings(log)
-        if timings:
-            self.addCompleteLog("timings", timings)
+        timings = read_timings(log)
+        if timings.tests:
+            self.addCompleteLog("timings", timings.format())
+        if self.history is not None:
+            record_test_history(self, self.history, timings)
+
+class TrialWarningParser(LogLineObserver):
+    """
+    Pick the warnings out of trial output (or out of a parallel trial
+    worker's err.log) into 'warnings', a dict of warning to count that may
+    be shared with other parsers.
+    """
+    def __init__(self, warnings):
+        LogLineObserver.__init__(self)
+        self.warnings = warnings
+        self.pending_warning = None
+
+    def outLineReceived(self, line):
+        self.feed(line + "\n")
+
+    errLineReceived = outLineReceived
+
+    def feed(self, line):
+        if self.pending_warning is not None:
+            # this line is the source of the previous warning
+            self.addWarning(self.pending_warning + line)
+            self.pending_warning = None
+            return
+        if line.find(" exceptions.DeprecationWarning: ") != -1:
+            # no source
+            self.addWarning(line) # TODO: consider stripping basedir prefix here
+        elif (line.find(" DeprecationWarning: ") != -1 or
+              line.find(" UserWarning: ") != -1):
+            # next line is the source
+            self.pending_warning = line
+        elif line.find("Warning: ") != -1:
+            self.addWarning(line)
+
+    def addWarning(self, warning):
+        self.warnings[warning] = self.warnings.get(warning, 0) + 1
+
+    def finish(self):
+        if self.pending_warning is not None:
+            self.addWarning(self.pending_warning)
+            self.pending_warning = None
+
+class TrialOutputParser(LogLineObserver):
+    """
+    Watch trial output as it arrives from the slave and pick out the summary
+    counts, warnings, the problems section (with its per-test results) and
+    the per-test timings, so that TrialCommand never has to read the whole
+    stdio log back.
+    """
+    # countFailedTests only looks at the last 10kB of output
+    tail_size = 10000
+
+    result_re = re.compile(r'^([^:]+): (\w+) \(([\w\.]+)\)')
+    result_map = {'SKIPPED': SKIPPED,
+                  'EXPECTED FAILURE': SUCCESS,
+                  'UNEXPECTED SUCCESS': WARNINGS,
+                  'FAILURE': FAILURE,
+                  'ERROR': FAILURE,
+                  'SUCCESS': SUCCESS,  # not reported
+                  }
+    # trial 16 starts each problem with one of these instead, and lists the
+    # tests that had it at the end
+    flavor_map = {'[FAIL]': (FAILURE, ['failure']),
+                  '[ERROR]': (FAILURE, ['error']),
+                  '[SKIPPED]': (SKIPPED, ['skipped']),
+                  '[TODO]': (SUCCESS, ['expected', 'failure']),
+                  '[SUCCESS!?!]': (WARNINGS, ['unexpected', 'success']),
+                  }
+
+    def __init__(self, problems_log="problems"):
+        LogLineObserver.__init__(self)
+        self.problems_log = problems_log
+        self.tail = deque()
+        self.tail_length = 0
+        self.warnings = {}
+        self.warning_parser = TrialWarningParser(self.warnings)
+        self.timings = TestTimings()
+        self.problems = None # the 'problems' log, once we reach that section
+        self.problems_done = False
+        self.problem = None # (results, text, testnames or None, lines)
+        self.expect_dashes = False
+
+    def outLineReceived(self, line):
+        self.tail.append(line)
+        self.tail_length += len(line) + 1
+        while self.tail_length > self.tail_size and len(self.tail) > 1:
+            self.tail_length -= len(self.tail.popleft()) + 1
+        self.timings.feed(line)
+        line += "\n"
+        if self.problems is not None:
+            self.problemLine(line)
+            return
+        self.warning_parser.feed(line)
+
+        if line.find("=" * 60) == 0 or line.find("-" * 60) == 0:
+            # the first separator line is copied to the log but not parsed
+            self.problems = self.step.addLog(self.problems_log)
+            self.problems.addStdout(line)
+
+    errLineReceived = outLineReceived
+
+    def problemLine(self, line):
+        self.problems.addStdout(line)
+        if self.problems_done:
+            return
+        if self.expect_dashes:
+            # the line after an old-style result header is all dashes
+            self.problem[3].append(line)
+            self.expect_dashes = False
+        elif line.find("=" * 60) == 0:
+            self.finishProblem()
+        elif line.find("-" * 60) == 0:
+            # the last case has --- as a separator before the summary counts
+            # are printed
+            self.finishProblem()
+            self.problems_done = True
+        elif self.problem is None:
+            self.startProblem(line)
+        else:
+            # the rest goes into the log
+            self.problem[3].append(line)
+
+    def startProblem(self, line):
+        # the first line after the === is, from trial 16:
+        # [FAIL]
+        # followed by the traceback (or the reason), a blank line, and the
+        # ids of all the tests that failed the same way, one per line.
+        # Older trials name the one test in the first line instead:
+        # EXPECTED FAILURE: testLackOfTB (twisted.test.test_failure.FailureTestCase)
+        # SKIPPED: testRETR (twisted.test.test_ftp.TestFTPServer)
+        # FAILURE: testBatchFile (twisted.conch.test.test_sftp.TestOurServerBatchFile)
+        flavor = self.flavor_map.get(line.strip())
+        if flavor is not None:
+            results, text = flavor
+            self.problem = (results, text, None, [line])
+            return
+        r = self.result_re.search(line)
+        if not r:
+            # TODO: cleanup, if there are no problems, we hit here
+            return
+        result, name, case = r.groups()
+        self.problem = (self.result_map.get(result, WARNINGS),
+                        result.lower().split(),
+                        [tuple(case.split(".") + [name])], [line])
+        self.expect_dashes = True
+
+    def finishProblem(self):
+        if self.problem is None:
+            return
+        results, text, testnames, lines = self.problem
+        self.problem = None
+        if testnames is None:
+            # the test ids are the lines after the last blank one
+            testnames = []
+            for line in reversed(lines[1:]):
+                if len(line.split()) != 1:
+                    break
+                testnames.insert(0, tuple(line.strip().split(".")))
+        tlog = "".join(lines)
+        for testname in testnames:
+            self.step.addTestResult(testname, results, text, tlog)
+
+    def countFailedTests(self):
+        return countFailedTests("\n".join(self.tail) + "\n")
+
+    def finish(self):
+        self.warning_parser.finish()
+        if self.problems is not None:
+            if not self.problems_done:
+                self.finishProblem()
+                self.problems_done = True
+            self.problems.finish()
+
+def summarize_trial_counts(counts, failed):
+    # turn countFailedTests() output, and whether the command failed, into
+    # (results, text, text2) for the status display
+    total = counts['total']
+    failures, errors = counts['failures'], counts['errors']
+    parsed = (total is not None)
+    text = []
+    text2 = ""
+
+    if not failed:
+        if parsed:
+            results = SUCCESS
+            if total:
+                text += ["%d %s" %
+                         (total,
+                          total == 1 and "test" or "tests"),
+                         "passed"]
+            else:
+                text += ["no tests", "run"]
+        else:
+            results = FAILURE
+            text += ["testlog", "unparseable"]
+            text2 = "tests"
+    else:
+        # something failed
+        results = FAILURE
+        if parsed:
+            text.append("tests")
+            if failures:
+                text.append("%d %s" %
+                            (failures,
+                             failures == 1 and "failure" or "failures"))
+            if errors:
+                text.append("%d %s" %
+                            (errors,
+                             errors == 1 and "error" or "errors"))
+            count = failures + errors
+            text2 = "%d tes%s" % (count, (count == 1 and 't' or 'ts'))
+        else:
+            text += ["tests", "failed"]
+            text2 = "tests"
+
+    if counts['skips']:
+        text.append("%d %s" %
+                    (counts['skips'],
+                     counts['skips'] == 1 and "skip" or "skips"))
+    if counts['expectedFailures']:
+        text.append("%d %s" %
+                    (counts['expectedFailures'],
+                     counts['expectedFailures'] == 1 and "todo"
+                     or "todos"))
+        if 0:  # TODO
+            results = WARNINGS
+            if not text2:
+                text2 = "todo"
+
+    if 0:
+        # ignore unexpectedSuccesses for now, but it should really mark
+        # the build WARNING
+        if counts['unexpectedSuccesses']:
+            text.append("%d surprises" % counts['unexpectedSuccesses'])
+            results = WARNINGS
+            if not text2:
+                text2 = "tests"
+
+    return results, text, text2
+
+class CountCores(PythonCommand):
+    """
+    Find out how many cores the buildslave has. Sets 'cpu-count', and
+    'trial-jobs' (the same, but at most max_jobs) for TrialJobs.
+    """
+    name = "count-cores"
+    description = ["counting", "cores"]
+    descriptionDone = ["cores"]
+    flunkOnFailure = False
+    warnOnFailure = False
+    python_command = ["-c", "import multiprocessing;"
+                      " print(multiprocessing.cpu_count())"]
+
+    def __init__(self, max_jobs=None, *args, **kwargs):
+        PythonCommand.__init__(self, *args, **kwargs)
+        self.addFactoryArguments(max_jobs=max_jobs)
+        self.max_jobs = max_jobs
+        self.cores = None
+
+    def createSummary(self, log):
+        for line in log.readlines():
+            if line.strip().isdigit():
+                self.cores = int(line.strip())
+        jobs = self.cores or 1
+        if self.max_jobs:
+            jobs = min(jobs, self.max_jobs)
+        if self.cores is not None:
+            self.setProperty("cpu-count", self.cores, "CountCores")
+        self.setProperty("trial-jobs", jobs, "CountCores")
+
+    def getText(self, cmd, results):
+        if self.cores is None:
+            return ["cores", "unknown"]
+        return ["%d" % self.cores, "cores"]
+
+class TrialJobs:
+    """
+    Render to trial's --jobs option, for as many workers as CountCores
+    decided on.
+    """
+    implements(IRenderable)
+
+    def getRenderingFor(self, props):
+        return "--jobs=%d" % (props.getProperty("trial-jobs", None) or 1)
 
 class TrialCommand(ShellCommand):
-    # a ShellCommand, but parses trial output
+    # a ShellCommand, but parses trial output.
+    #
+    # With parallel=True the command is expected to run trial with
+    # TrialJobs() (--jobs=N, N from CountCores). Each worker then runs in
+    # _trial_temp/<n>/ with its own test.log, and its stdout and stderr go
+    # to out.log and err.log there instead of to our stdio, so we collect
+    # the warnings from every err.log. Trial reports each test's results
+    # in one piece once a worker has finished it, so the stdio parsing
+    # stays the same, but the per-test times it prints are only the time it
+    # took to report the test, and are not kept. (A worker's test.log only
+    # has a '--> test id <--' line as each test starts, without times, so
+    # there is nothing to take them from instead.)
     progressMetrics = ('output', 'tests', 'test.log')
     logfiles = {"test.log": "_trial_temp/test.log"}
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, history=None, shard=None, parallel=False,
+                 warning_index=None, *args, **kwargs):
         ShellCommand.__init__(self, *args, **kwargs)
+        self.addFactoryArguments(history=history, shard=shard,
+                                 parallel=parallel,
+                                 warning_index=warning_index)
+        self.history = history
+        self.shard = shard
+        self.parallel = parallel
+        self.warning_index = warning_index
+        self.test_outcomes = {}
+        self.test_problems = []
         self.addLogObserver('stdio', TrialTestCaseCounter())
+        self.parser = TrialOutputParser()
+        self.addLogObserver('stdio', self.parser)
+        self.worker_parsers = []
+
+    def start(self):
+        if self.parallel:
+            jobs = self.getProperty("trial-jobs", None) or 1
+            self.logfiles.pop("test.log", None)
+            for worker in range(jobs):
+                self.logfiles["test.log.%d" % worker] = \
+                    "_trial_temp/%d/test.log" % worker
+                self.logfiles["err.log.%d" % worker] = \
+                    "_trial_temp/%d/err.log" % worker
+                parser = TrialWarningParser(self.parser.warnings)
+                self.addLogObserver("err.log.%d" % worker, parser)
+                self.worker_parsers.append(parser)
+        return ShellCommand.start(self)
 
     def commandComplete(self, cmd):
         # figure out all status, then let the various hook functions return
         # different pieces of it
 
-        # 'cmd' is the original trial command, so cmd.logs['stdio'] is the
-        # trial output. We don't have access to test.log from here.
-        output = cmd.logs['stdio'].getText()
-        counts = countFailedTests(output)
+        # the parser has been watching the trial output as it arrived, so
+        # we only need the tail it kept around for the summary counts
+        counts = self.parser.countFailedTests()
+        self.counts = counts
+        self.command_failed = cmd.didFail()
 
-        total = counts['total']
-        failures, errors = counts['failures'], counts['errors']
-        parsed = (total is not None)
-        text = []
-        text2 = ""
-
-        if not cmd.didFail():
-            if parsed:
-                results = SUCCESS
-                if total:
-                    text += ["%d %s" %
-                             (total,
-                              total == 1 and "test" or "tests"),
-                             "passed"]
-                else:
-                    text += ["no tests", "run"]
-            else:
-                results = FAILURE
-                text += ["testlog", "unparseable"]
-                text2 = "tests"
-        else:
-            # something failed
-            results = FAILURE
-            if parsed:
-                text.append("tests")
-                if failures:
-                    text.append("%d %s" %
-                                (failures,
-                                 failures == 1 and "failure" or "failures"))
-                if errors:
-                    text.append("%d %s" %
-                                (errors,
-                                 errors == 1 and "error" or "errors"))
-                count = failures + errors
-                text2 = "%d tes%s" % (count, (count == 1 and 't' or 'ts'))
-            else:
-                text += ["tests", "failed"]
-                text2 = "tests"
-
-        if counts['skips']:
-            text.append("%d %s" %
-                        (counts['skips'],
-                         counts['skips'] == 1 and "skip" or "skips"))
-        if counts['expectedFailures']:
-            text.append("%d %s" %
-                        (counts['expectedFailures'],
-                         counts['expectedFailures'] == 1 and "todo"
-                         or "todos"))
-            if 0:  # TODO
-                results = WARNINGS
-                if not text2:
-                    text2 = "todo"
-
-        if 0:
-            # ignore unexpectedSuccesses for now, but it should really mark
-            # the build WARNING
-            if counts['unexpectedSuccesses']:
-                text.append("%d surprises" % counts['unexpectedSuccesses'])
-                results = WARNINGS
-                if not text2:
-                    text2 = "tests"
-
-        self.results = results
-        self.text = text
+        self.results, self.text, text2 = summarize_trial_counts(counts,
+                                                                self.command_failed)
         self.text2 = [text2]
 
     def createSummary(self, loog):
-        output = loog.getText()
-        problems = ""
-        sio = StringIO.StringIO(output)
-        warnings = {}
-        while True:
-            line = sio.readline()
-            if line == "":
-                break
-            if line.find(" exceptions.DeprecationWarning: ") != -1:
-                # no source
-                warning = line  # TODO: consider stripping basedir prefix here
-                warnings[warning] = warnings.get(warning, 0) + 1
-            elif (line.find(" DeprecationWarning: ") != -1 or
-                  line.find(" UserWarning: ") != -1):
-                # next line is the source
-                warning = line + sio.readline()
-                warnings[warning] = warnings.get(warning, 0) + 1
-            elif line.find("Warning: ") != -1:
-                warning = line
-                warnings[warning] = warnings.get(warning, 0) + 1
-
-            if line.find("=" * 60) == 0 or line.find("-" * 60) == 0:
-                problems += line
-                problems += sio.read()
-                break
-
-        if problems:
-            self.addCompleteLog("problems", problems)
-            # now parse the problems for per-test results
-            pio = StringIO.StringIO(problems)
-            pio.readline()  # eat the first separator line
-            testname = None
-            done = False
-            while not done:
-                while True:
-                    line = pio.readline()
-                    if line == "":
-                        done = True
-                        break
-                    if line.find("=" * 60) == 0:
-                        break
-                    if line.find("-" * 60) == 0:
-                        # the last case has --- as a separator before the
-                        # summary counts are printed
-                        done = True
-                        break
-                    if testname is None:
-                        # the first line after the === is like:
-                        # EXPECTED FAILURE: testLackOfTB (twisted.test.test_failure.FailureTestCase)
-                        # SKIPPED: testRETR (twisted.test.test_ftp.TestFTPServer)
-                        # FAILURE: testBatchFile (twisted.conch.test.test_sftp.TestOurServerBatchFile)
-                        r = re.search(r'^([^:]+): (\w+) \(([\w\.]+)\)', line)
-                        if not r:
-                            # TODO: cleanup, if there are no problems,
-                            # we hit here
-                            continue
-                        result, name, case = r.groups()
-                        testname = tuple(case.split(".") + [name])
-                        results = {'SKIPPED': SKIPPED,
-                                   'EXPECTED FAILURE': SUCCESS,
-                                   'UNEXPECTED SUCCESS': WARNINGS,
-                                   'FAILURE': FAILURE,
-                                   'ERROR': FAILURE,
-                                   'SUCCESS': SUCCESS,  # not reported
-                                   }.get(result, WARNINGS)
-                        text = result.lower().split()
-                        loog = line
-                        # the next line is all dashes
-                        loog += pio.readline()
-                    else:
-                        # the rest goes into the log
-                        loog += line
-                if testname:
-                    self.addTestResult(testname, results, text, loog)
-                    testname = None
+        # by now the parser has seen all of the output, and has already
+        # written the 'problems' log and the per-test results
+        self.parser.finish()
+        for parser in self.worker_parsers:
+            parser.finish()
 
+        warnings = self.parser.warnings
         if warnings:
             lines = sorted(warnings.keys())
             self.addCompleteLog("warnings", "".join(lines))
+        # a sharded build's warnings are indexed by MergeTestShards
+        if self.warning_index is not None and self.shard is None:
+            new = index_warnings(self, self.warning_index, warnings)
+            self.text.extend(new_warnings_text(new))
 
-        timings = parse_timings(loog)
+        if self.parallel:
+            self.timings = TestTimings()
+        else:
+            self.timings = self.parser.timings
+        timings = self.timings.format()
         if timings:
             self.addCompleteLog("timings", timings)
 
+        if self.history is not None:
+            record_test_history(self, self.history, self.timings,
+                                self.test_outcomes)
+
+        if self.shard is not None:
+            self.publishShard()
+
+        # for RetryFailedTests
+        self.setProperty("failed-tests", failed_tests(self.test_outcomes),
+                         "TrialCommand")
+        self.setProperty("trial-results", self.results, "TrialCommand")
+
+    def addTestResult(self, testname, results, text, tlog):
+        self.test_outcomes[".".join(testname)] = " ".join(text)
+        if self.shard is not None:
+            self.test_problems.append( (testname, results, text, tlog) )
+        tr = TestResult(testname, results, text, logs={'log': tlog})
+        self.build.build_status.addTestResult(tr)
+
+    def publishShard(self):
+        # hand our results to MergeTestShards in the build that triggered us
+        token = self.getProperty("shard_token", None)
+        if token not in shard_results:
+            # no build is waiting for it any more
+            return
+        shard_results[token][1][self.shard] = {
+            "counts": self.counts,
+            "failed": self.command_failed,
+            "warnings": self.parser.warnings,
+            "timings": self.timings.tests,
+            "outcomes": self.test_outcomes,
+            "problems": self.test_problems,
+            }
+
     def evaluateCommand(self, cmd):
         return self.results
 
@@ -308,6 +700,381 @@ class TrialCommand(ShellCommand):
     def getText2(self, cmd, results):
         return self.text2
 
+def failed_tests(outcomes):
+    # the test ids worth rerunning, from a test_outcomes dict
+    return sorted([testid for (testid, outcome) in outcomes.items()
+                   if outcome in ("failure", "error")])
+
+class RetryFailedTests(ShellCommand):
+    """
+    Rerun the tests that the TrialCommand before us reported as failed or
+    errored, in the environment it left behind, up to 'attempts' times:
+    'command' followed by the test ids that are still failing. A test that
+    passes on a rerun is flaky, one that fails every time is a confirmed
+    failure; with 'history', both are recorded for TestHistory.flakiness().
+
+    This step decides how the tests went: the TrialCommand has to be told
+    flunkOnFailure=False, haltOnFailure=False. If it failed without any
+    failed tests (the environment didn't build, the output couldn't be
+    parsed), or with more than 'max_tests' of them, that is a FAILURE
+    without any reruns. All tests passing on a rerun is WARNINGS.
+    """
+    name = "retry-failed-tests"
+    description = ["rerunning", "failed", "tests"]
+    descriptionDone = ["reran", "failed", "tests"]
+    flunkOnFailure = True
+    haltOnFailure = True
+
+    def __init__(self, attempts=2, max_tests=20, history=None,
+                 *args, **kwargs):
+        ShellCommand.__init__(self, *args, **kwargs)
+        self.addFactoryArguments(attempts=attempts, max_tests=max_tests,
+                                 history=history)
+        self.attempts = attempts
+        self.max_tests = max_tests
+        self.history = history
+        self.attempt_outcomes = {}
+
+    def start(self):
+        results = self.getProperty("trial-results", None)
+        failed = self.getProperty("failed-tests", None) or []
+        if results is None:
+            # the tests didn't run at all
+            self.step_status.setText(["no", "tests", "to", "rerun"])
+            self.finished(SKIPPED)
+            return
+        if results != FAILURE:
+            self.step_status.setText(["tests", "passed"])
+            self.finished(SKIPPED)
+            return
+        if not failed or len(failed) > self.max_tests:
+            text = ["tests", "failed"]
+            if failed:
+                text.extend(["%d failures" % len(failed), "not", "rerun"])
+            self.step_status.setText(text)
+            self.finished(FAILURE)
+            return
+        d = self.rerun(failed)
+        d.addCallback(self.finished)
+        d.addErrback(self.failed)
+
+    @defer.inlineCallbacks
+    def rerun(self, failed):
+        remaining = list(failed)
+        # testid -> (attempts, "flaky" or "confirmed")
+        retried = {}
+        attempt = 0
+        while remaining and attempt < self.attempts:
+            attempt += 1
+            self.step_status.setText(["rerunning", "%d" % len(remaining),
+                                      "tests", "(%d)" % attempt])
+            still_failing = yield self.runAttempt(attempt, remaining)
+            for testid in remaining:
+                if testid not in still_failing:
+                    retried[testid] = (attempt, "flaky")
+            remaining = [testid for testid in remaining
+                         if testid in still_failing]
+        for testid in remaining:
+            retried[testid] = (attempt, "confirmed")
+
+        flaky = sorted([t for t in retried if retried[t][1] == "flaky"])
+        confirmed = sorted([t for t in retried if retried[t][1] == "confirmed"])
+        self.setProperty("tests-flaky", flaky, "RetryFailedTests")
+        self.setProperty("tests-confirmed", confirmed, "RetryFailedTests")
+        self.addCompleteLog("retries",
+                            "".join(["%s after %d: %s\n"
+                                     % (retried[t][1], retried[t][0], t)
+                                     for t in sorted(retried)]))
+        if self.history is not None:
+            try:
+                self.history.record_retries(
+                    self.getProperty("buildername"),
+                    self.getProperty("buildnumber"),
+                    (self.getProperty("got_revision", None) or
+                     self.getProperty("revision", None)),
+                    retried)
+            except Exception:
+                log.err(None, "unable to record test retries")
+
+        text = []
+        if confirmed:
+            text.append("%d failed" % len(confirmed))
+        if flaky:
+            text.append("%d flaky" % len(flaky))
+        self.step_status.setText(["tests"] + text)
+        if confirmed:
+            defer.returnValue(FAILURE)
+        defer.returnValue(WARNINGS)
+
+    @defer.inlineCallbacks
+    def runAttempt(self, attempt, tests):
+        # returns the set of 'tests' that still failed
+        logname = "attempt %d" % attempt
+        parser = TrialOutputParser(problems_log="problems %d" % attempt)
+        self.addLogObserver(logname, parser)
+        self.attempt_outcomes = {}
+        kwargs = self.buildCommandKwargs([])
+        kwargs["command"] = kwargs["command"] + list(tests)
+        kwargs["logfiles"] = {}
+        kwargs["stdioLogName"] = logname
+        cmd = RemoteShellCommand(**kwargs)
+        self.setupEnvironment(cmd)
+        cmd.useLog(self.addLog(logname), True)
+        self.cmd = cmd # so we can interrupt it
+        yield self.runCommand(cmd)
+        parser.finish()
+        counts = parser.countFailedTests()
+        if counts["total"] is None:
+            # trial didn't get as far as a summary; we can't tell
+            defer.returnValue(set(tests))
+        defer.returnValue(set(failed_tests(self.attempt_outcomes)))
+
+    def addTestResult(self, testname, results, text, tlog):
+        # called by the parser of the current attempt
+        self.attempt_outcomes[".".join(testname)] = " ".join(text)
+
+def plan_shards(weights, count):
+    """
+    Split the test modules in 'weights' (a dict mapping module name to its
+    expected run time in seconds) into 'count' shards of roughly equal total
+    time. This is the longest-processing-time-first heuristic: hand the
+    slowest remaining module to whichever shard has the least work so far.
+    Returns a list of (expected seconds, [modules]), one per shard.
+    """
+    shards = [(0.0, i, []) for i in range(count)]
+    heapq.heapify(shards)
+    for module, seconds in sorted(weights.items(), key=lambda w: (-w[1], w[0])):
+        total, i, modules = heapq.heappop(shards)
+        modules.append(module)
+        heapq.heappush(shards, (total + seconds, i, modules))
+    shards.sort(key=lambda shard: shard[1])
+    return [(total, sorted(modules)) for (total, i, modules) in shards]
+
+def module_weights(modules, durations):
+    """
+    Add up the per-test 'durations' (testid -> seconds) for each of the test
+    'modules'. Modules we have no history for (new ones, usually) are
+    assumed to take as long as an average module.
+    """
+    weights = dict([(module, 0.0) for module in modules])
+    known = set()
+    for testid, seconds in durations.items():
+        # allmydata.test.test_foo.FooTests.test_bar belongs to the longest
+        # module name that is a prefix of it
+        parts = testid.split(".")
+        for i in range(len(parts) - 1, 0, -1):
+            module = ".".join(parts[:i])
+            if module in weights:
+                weights[module] += seconds
+                known.add(module)
+                break
+    if known:
+        average = sum([weights[m] for m in known]) / len(known)
+    else:
+        average = 1.0
+    for module in modules:
+        if module not in known:
+            weights[module] = average
+    return weights
+
+# results of shard builds, waiting for MergeTestShards in the build that
+# triggered them to collect them: shard_token -> (when PlanTestShards
+# registered it, {shard: results}). The shards and their parent all run in
+# this buildmaster, so this doesn't need to be any more durable than a dict.
+# MergeTestShards always runs and removes its token, shards only report to
+# tokens that are still there, and PlanTestShards expires the ones whose
+# build went away some other way (a reconfig in between, say) after
+# SHARD_RESULTS_MAX_AGE seconds.
+shard_results = {}
+SHARD_RESULTS_MAX_AGE = 24*3600
+
+def expire_shard_results(now=None):
+    now = now or time.time()
+    for token in list(shard_results.keys()):
+        if now - shard_results[token][0] > SHARD_RESULTS_MAX_AGE:
+            del shard_results[token]
+
+class ShardTests:
+    """
+    Render to 'command' followed by this shard's share of the test modules,
+    as planned by PlanTestShards in the build that triggered us.
+    """
+    implements(IRenderable)
+
+    def __init__(self, command, shard):
+        self.command = command
+        self.shard = shard
+
+    def getRenderingFor(self, props):
+        d = props.render(self.command)
+        d.addCallback(lambda command: command + shard_tests(props, self.shard))
+        return d
+
+def shard_tests(props, shard):
+    # 'props' can be a step or a Properties instance
+    plan = props.getProperty("shard_plan", None) or []
+    if shard >= len(plan):
+        return []
+    return plan[shard].split()
+
+class PlanTestShards(ShellCommand):
+    """
+    List the test modules in the checkout and divide them into shards of
+    roughly equal run time, based on the per-test durations of earlier
+    builds. The plan goes into the 'shard_plan' property (one
+    space-separated list of modules per shard), for the sharded builds that
+    a following Trigger step starts.
+    """
+    name = "plan-shards"
+    description = ["planning", "shards"]
+    descriptionDone = ["shards"]
+    flunkOnFailure = True
+    haltOnFailure = True
+
+    def __init__(self, shards, test_suite="allmydata", history=None,
+                 history_builders=None, testdir="src/allmydata/test",
+                 *args, **kwargs):
+        kwargs["command"] = ["git", "ls-files", testdir]
+        ShellCommand.__init__(self, *args, **kwargs)
+        self.addFactoryArguments(shards=shards, test_suite=test_suite,
+                                 history=history,
+                                 history_builders=history_builders,
+                                 testdir=testdir)
+        self.shards = shards
+        self.test_suite = test_suite
+        self.history = history
+        self.history_builders = history_builders
+        self.plan = []
+
+    def createSummary(self, loog):
+        # src/allmydata/test/cli/test_cli.py -> allmydata.test.cli.test_cli
+        modules = []
+        for line in loog.readlines():
+            path = line.strip()
+            filename = path.split("/")[-1]
+            if not (filename.startswith("test_") and filename.endswith(".py")):
+                continue
+            module = ".".join(path[:-len(".py")].split("/")[1:])
+            if (module == self.test_suite or
+                module.startswith(self.test_suite + ".")):
+                modules.append(module)
+        if not modules:
+            # test_suite is narrower than a single module, so there is
+            # nothing to divide up
+            modules = [self.test_suite]
+
+        durations = {}
+        if self.history is not None:
+            builders = (self.history_builders or
+                        [self.getProperty("buildername")])
+            try:
+                durations = self.history.median_durations(builders)
+            except Exception:
+                log.err(None, "unable to read test history")
+        weights = module_weights(modules, durations)
+        self.plan = plan_shards(weights, self.shards)
+
+        self.setProperty("shard_plan",
+                         [" ".join(shard_modules)
+                          for (seconds, shard_modules) in self.plan],
+                         "PlanTestShards")
+        token = "%s/%s" % (self.getProperty("buildername"),
+                           self.getProperty("buildnumber"))
+        expire_shard_results()
+        shard_results[token] = (time.time(), {})
+        self.setProperty("shard_token", token, "PlanTestShards")
+        self.addCompleteLog("shard-plan", "".join(
+            ["shard %d: %d modules, about %ds\n    %s\n"
+             % (i, len(shard_modules), seconds, "\n    ".join(shard_modules))
+             for i, (seconds, shard_modules) in enumerate(self.plan)]))
+
+    def getText(self, cmd, results):
+        text = ["%d" % len(self.plan), "shards"]
+        for (seconds, shard_modules) in self.plan:
+            text.append("%dm" % (seconds / 60))
+        return text
+
+class MergeTestShards(BuildStep):
+    """
+    Gather up what the TrialCommand in each sharded build reported and
+    summarize it as if the whole suite had run in this build: one set of
+    counts, one 'warnings' and 'timings' log, and per-test results. It
+    runs even when the build was stopped, so that what the shards left in
+    shard_results is always cleared.
+    """
+    name = "merge-shards"
+    description = ["merging", "shards"]
+    descriptionDone = ["tests"]
+    flunkOnFailure = True
+    alwaysRun = True
+
+    def __init__(self, history=None, warning_index=None, **kwargs):
+        BuildStep.__init__(self, **kwargs)
+        self.addFactoryArguments(history=history, warning_index=warning_index)
+        self.history = history
+        self.warning_index = warning_index
+
+    def start(self):
+        token = self.getProperty("shard_token", None)
+        if token is None:
+            # PlanTestShards didn't get that far
+            self.step_status.setText(["no", "shards"])
+            self.finished(SKIPPED)
+            return
+        plan = self.getProperty("shard_plan", None) or []
+        shards = shard_results.pop(token, (None, {}))[1]
+
+        counts = {'total': 0, 'failures': 0, 'errors': 0, 'skips': 0,
+                  'expectedFailures': 0, 'unexpectedSuccesses': 0}
+        parsed = True
+        failed = False
+        missing = []
+        warnings = {}
+        timings = TestTimings()
+        outcomes = {}
+        for i, tests in enumerate(plan):
+            if i not in shards:
+                # an empty shard doesn't run trial at all
+                if tests:
+                    missing.append(i)
+                continue
+            shard = shards[i]
+            failed = failed or shard["failed"]
+            for name in counts:
+                value = shard["counts"].get(name)
+                if name == 'total' and value is None:
+                    parsed = False
+                counts[name] += value or 0
+            for warning, count in shard["warnings"].items():
+                warnings[warning] = warnings.get(warning, 0) + count
+            timings.tests.extend(shard["timings"])
+            outcomes.update(shard["outcomes"])
+            for (testname, results, text, tlog) in shard["problems"]:
+                tr = TestResult(testname, results, text,
+                                logs={'log': "shard %d:\n%s" % (i, tlog)})
+                self.build.build_status.addTestResult(tr)
+
+        if not parsed:
+            counts['total'] = None
+        results, text, text2 = summarize_trial_counts(counts,
+                                                      bool(failed or missing))
+        if missing:
+            text.extend(["missing", "shard%s" % (len(missing) > 1 and "s" or ""),
+                         ",".join(["%d" % i for i in missing])])
+        if warnings:
+            self.addCompleteLog("warnings", "".join(sorted(warnings.keys())))
+        if self.warning_index is not None:
+            new = index_warnings(self, self.warning_index, warnings)
+            text.extend(new_warnings_text(new))
+        if timings.tests:
+            self.addCompleteLog("timings", timings.format())
+        if self.history is not None:
+            record_test_history(self, self.history, timings, outcomes)
+
+        self.step_status.setText(text)
+        self.step_status.setText2([text2])
+        self.finished(results)
+
 class TestDeprecations(PythonCommand):
     warnOnFailure = False
     flunkOnFailure = False
@@ -316,22 +1083,32 @@ class TestDeprecations(PythonCommand):
     descriptionDone = ["test", "deprecations"]
     logfiles = {"test.log": "_trial_temp/test.log"}
     python_command = ["setup.py", "test"]
+    new_warnings = None
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, warning_index=None, *args, **kwargs):
         kwargs["env"] = {"PYTHONWARNINGS": "default::DeprecationWarning"}
         PythonCommand.__init__(self, *args, **kwargs)
+        self.addFactoryArguments(warning_index=warning_index)
+        self.warning_index = warning_index
 
     def createSummary(self, log):
         # create a logfile with the de-duped DeprecationWarning messages
-        warnings = set()
+        warnings = {}
         warn_re = re.compile(r'DeprecationWarning: ')
         for line in log.readlines(): # add stderr
             line = line.strip()
             mo = warn_re.search(line)
             if mo:
-                warnings.add(line)
+                warnings[line] = warnings.get(line, 0) + 1
         if warnings:
             self.addCompleteLog("warnings", "\n".join(sorted(warnings))+"\n")
+        if self.warning_index is not None:
+            self.new_warnings = index_warnings(self, self.warning_index,
+                                               warnings)
+
+    def getText(self, cmd, results):
+        text = ShellCommand.getText(self, cmd, results)
+        return text + new_warnings_text(self.new_warnings)
 
 class TestDeprecationsWithTox(ShellCommand):
     warnOnFailure = True
@@ -342,9 +1119,22 @@ class TestDeprecationsWithTox(ShellCommand):
     logfiles = {"test.log": "_trial_temp/test.log",
                 "warnings": "_trial_temp/deprecation-warnings.log"}
     deprecation_count = None
+    new_warnings = None
+
+    def __init__(self, warning_index=None, *args, **kwargs):
+        ShellCommand.__init__(self, *args, **kwargs)
+        self.addFactoryArguments(warning_index=warning_index)
+        self.warning_index = warning_index
 
     def createSummary(self, log):
-        self.deprecation_count = len(self.getLog("warnings").readlines())
+        lines = self.getLog("warnings").readlines()
+        self.deprecation_count = len(lines)
+        if self.warning_index is not None:
+            warnings = {}
+            for line in lines:
+                warnings[line] = warnings.get(line, 0) + 1
+            self.new_warnings = index_warnings(self, self.warning_index,
+                                               warnings)
 
     def getText(self, cmd, results):
         text = ShellCommand.getText(self, cmd, results)
@@ -352,6 +1142,10 @@ class TestDeprecationsWithTox(ShellCommand):
             return text
         elif self.deprecation_count == 0:
             return text + ["clean"]
+        elif self.new_warnings is not None:
+            # the rest were there before, see the 'new-warnings' log
+            return text + (new_warnings_text(self.new_warnings) or
+                           ["no new warnings"])
         else:
             return text + ["%d warnings" % self.deprecation_count]
 
@@ -360,6 +1154,102 @@ class TestUpcomingDeprecationsWithTox(TestDeprecationsWithTox):
     description = ["testing", "upcoming", "deprecations"]
     descriptionDone = ["test", "upcoming", "deprecations"]
 
+class ToxEnvCache(PythonCommand):
+    """
+    Restore tox environments from the buildslave's cache before tox runs
+    (action="restore"), or put them back afterwards (action="save"). See
+    toxcache.py, which has to have been sent to 'script' first. With no
+    'toxenvs', it uses the envlist from tox.ini.
+    """
+    flunkOnFailure = False
+    warnOnFailure = True
+    toxcache_re = re.compile(r'^toxcache: (\S+) (hit|miss|saved|unfinished) \S+$')
+
+    def __init__(self, action, toxenvs=[], script="../toxcache.py",
+                 cache="../../tox-cache", max_size=5.0, *args, **kwargs):
+        kwargs["python_command"] = [script, "--cache", cache,
+                                    "--fingerprint",
+                                    Property("python-fingerprint", default=""),
+                                    "--max-size", str(max_size),
+                                    action] + list(toxenvs)
+        kwargs.setdefault("name", "%s-tox-envs" % action)
+        kwargs.setdefault("description", [action, "tox", "envs"])
+        kwargs.setdefault("descriptionDone", [action, "tox", "envs"])
+        PythonCommand.__init__(self, *args, **kwargs)
+        self.addFactoryArguments(action=action, toxenvs=toxenvs, script=script,
+                                 cache=cache, max_size=max_size)
+        self.action = action
+        self.outcomes = []
+
+    def createSummary(self, log):
+        for line in log.readlines():
+            mo = self.toxcache_re.search(line.strip())
+            if mo:
+                toxenv, outcome = mo.groups()
+                self.outcomes.append((toxenv, outcome))
+                if self.action == "restore":
+                    self.setProperty("tox-cache-%s" % toxenv, outcome,
+                                     "ToxEnvCache")
+
+    def getText(self, cmd, results):
+        text = ShellCommand.getText(self, cmd, results)
+        for (toxenv, outcome) in self.outcomes:
+            text.append("%s: %s" % (toxenv, outcome))
+        return text
+
+class BuildArtifactCache(PythonCommand):
+    """
+    Restore compiled artifacts ('paths', e.g. build/ or the dependency
+    eggs) from the buildslave's cache before the step that compiles them
+    (action="restore"), or put them there afterwards (action="save"). They
+    are keyed on the files matching 'sources', the interpreter's ABI and
+    compiler, ToolVersions' python-fingerprint and 'flags'. See
+    buildcache.py, which has to have been sent to 'script' first. A restore
+    sets the build-cache property to hit or miss.
+    """
+    flunkOnFailure = False
+    warnOnFailure = True
+    buildcache_re = re.compile(r'^buildcache: (hit|miss|saved|empty) (\S+)')
+
+    def __init__(self, action, paths, sources, flags=[],
+                 script="../buildcache.py", cache="../../build-cache",
+                 max_size=2.0, *args, **kwargs):
+        python_command = [script, "--cache", cache,
+                          "--fingerprint",
+                          Property("python-fingerprint", default=""),
+                          "--max-size", str(max_size)]
+        for source in sources:
+            python_command.extend(["--source", source])
+        for flag in flags:
+            python_command.extend(["--flag", flag])
+        kwargs["python_command"] = python_command + [action] + list(paths)
+        kwargs.setdefault("name", "%s-build-cache" % action)
+        kwargs.setdefault("description", [action, "build", "cache"])
+        kwargs.setdefault("descriptionDone", [action, "build", "cache"])
+        PythonCommand.__init__(self, *args, **kwargs)
+        self.addFactoryArguments(action=action, paths=paths, sources=sources,
+                                 flags=flags, script=script, cache=cache,
+                                 max_size=max_size)
+        self.action = action
+        self.outcome = None
+
+    def createSummary(self, log):
+        for line in log.readlines():
+            mo = self.buildcache_re.search(line.strip())
+            if mo:
+                self.outcome, key = mo.groups()
+                if self.action == "restore":
+                    self.setProperty("build-cache", self.outcome,
+                                     "BuildArtifactCache")
+                    self.setProperty("build-cache-key", key,
+                                     "BuildArtifactCache")
+
+    def getText(self, cmd, results):
+        text = ShellCommand.getText(self, cmd, results)
+        if self.outcome:
+            text.append(self.outcome)
+        return text
+
 class TestOldDep(PythonCommand):
     """
     Run a special test to confirm that the build system builds a new
@@ -474,6 +1364,75 @@ class UnarchiveCoverage(ShellCommand):
         ShellCommand.__init__(self, *args, **kwargs)
         self.addFactoryArguments(unarch_furlfile=unarch_furlfile)
 
+class StreamCoverage(ShellCommand):
+    """
+    Render the coverage HTML and stream it, with the coverage data, to the
+    server behind 'stream_furlfile' in a single pipeline, sending only the
+    HTML files that changed since the last set we published (see
+    covarchive.py, which has to have been sent to 'script' first). If the
+    server doesn't have that set any more, send everything. This does what
+    ArchiveCoverage, UploadCoverage and UnarchiveCoverage do.
+    """
+
+    flunkOnFailure = True
+    name = "stream-coverage"
+    description = ["streaming", "coverage"]
+    descriptionDone = ["stream", "coverage"]
+    PACK_TEMPL = '%(python)s %(script)s pack --published %(published)s'
+    SEND_TEMPL = ' | flappclient --furlfile %(furlfile)s run-command'
+    COMMAND_TEMPL = ('( ' + PACK_TEMPL + SEND_TEMPL + ' || '
+                     + PACK_TEMPL + ' --full' + SEND_TEMPL + ' ) && '
+                     '%(python)s %(script)s published --published %(published)s')
+    packed_re = re.compile(r'^covarchive: packed (\d+) changed files, (\d+) unchanged,'
+                           r' (\d+) deleted, (\d+) bytes with (\S+) in ([\d.]+)s$')
+    unpacked_re = re.compile(r'^covarchive: unpacked (\d+) files into (\S+) in ([\d.]+)s$')
+
+    def __init__(self, stream_furlfile, python="python",
+                 script="../covarchive.py",
+                 published="../../coverage-published.json", *args, **kwargs):
+        ShellCommand.__init__(self, *args, **kwargs)
+        self.addFactoryArguments(stream_furlfile=stream_furlfile, python=python,
+                                 script=script, published=published)
+        self.command = self.COMMAND_TEMPL % {"python": python, "script": script,
+                                             "published": published,
+                                             "furlfile": stream_furlfile}
+        self.stages = {}
+
+    def createSummary(self, log):
+        # covarchive.py reports on stderr (its stdout is the archive), which
+        # readlines() leaves out
+        for line in log.getText().splitlines():
+            line = line.strip()
+            mo = self.packed_re.search(line)
+            if mo:
+                # after a --full retry, the last one is what got through
+                self.stages["files-sent"] = int(mo.group(1))
+                self.stages["files-unchanged"] = int(mo.group(2))
+                self.stages["archive-bytes"] = int(mo.group(4))
+                self.stages["archive-seconds"] = float(mo.group(6))
+            mo = self.unpacked_re.search(line)
+            if mo:
+                self.stages["unpack-seconds"] = float(mo.group(3))
+        # the stages overlap, so this is the time for all of them
+        self.stages["upload-seconds"] = round(time.time() -
+                                              self.step_status.getTimes()[0], 1)
+        for name, value in self.stages.items():
+            self.setProperty("coverage-" + name, value, "StreamCoverage")
+
+    def getText(self, cmd, results):
+        text = ShellCommand.getText(self, cmd, results)
+        if "files-sent" in self.stages:
+            text.append("sent %d of %d files"
+                        % (self.stages["files-sent"],
+                           self.stages["files-sent"] + self.stages["files-unchanged"]))
+            text.append("%.1fMB" % (self.stages["archive-bytes"] / 1e6))
+            text.append("arch %.1fs" % self.stages["archive-seconds"])
+        if "unpack-seconds" in self.stages:
+            text.append("unpack %.1fs" % self.stages["unpack-seconds"])
+        if "upload-seconds" in self.stages:
+            text.append("total %.1fs" % self.stages["upload-seconds"])
+        return text
+
 class PushCoverage(ShellCommand):
     UPLOAD_HOST = "buildslave@dev.allmydata.com"
     COVERAGEDIR = "coverage-results-%d"
@@ -510,6 +1469,7 @@ class CoverageDeltaHTML(ShellCommand):
     Create HTML code coverage display, after test-coverage has been run. We
     also fetch the previous code-coverage data from tahoe-lafs.org, so we can
     compute a delta (lines newly covered, lines no longer covered).
+    CoverageDelta does the same without the fetch.
     """
     name = "coverage-html"
     description = ["rendering", "coverage", "html"]
@@ -552,6 +1512,444 @@ class CoverageDeltaHTML(ShellCommand):
             text.append("%d not covered" % self.counts["uncovered-lines"])
         return text
 
+def read_upload(step, uploads):
+    # what a FileUpload step put in <uploads>/BUILDER-NUMBER.json for this
+    # build, removed once read; None if it isn't there
+    filename = os.path.join(uploads, "%s-%d.json"
+                            % (step.getProperty("buildername"),
+                               step.getProperty("buildnumber")))
+    try:
+        with open(filename) as f:
+            uploaded = json.load(f)
+    except (IOError, ValueError) as e:
+        step.addCompleteLog("error", "unable to read %s: %s\n" % (filename, e))
+        return None
+    os.unlink(filename)
+    return uploaded
+
+class CoverageDelta(BuildStep):
+    """
+    Compare this build's coverage against the last one recorded for the
+    same branch (or for 'default_branch', if this branch has none yet),
+    and then record it. This replaces CoverageDeltaHTML's
+    network fetch and make run: the buildslave uploads what
+    'covarchive.py lines' wrote to <uploads>/<buildername>-<buildnumber>.json
+    and the delta is computed here, against the CoverageHistory, setting
+    the same coverage-* properties plus a per-file 'delta' log.
+    """
+    name = "coverage-delta"
+    description = ["comparing", "coverage"]
+    descriptionDone = ["coverage", "delta"]
+    warnOnFailure = True
+    flunkOnFailure = False
+
+    def __init__(self, history, uploads="coverage-uploads",
+                 default_branch="master", **kwargs):
+        BuildStep.__init__(self, **kwargs)
+        self.addFactoryArguments(history=history, uploads=uploads,
+                                 default_branch=default_branch)
+        self.history = history
+        self.uploads = uploads
+        self.default_branch = default_branch
+
+    def start(self):
+        buildername = self.getProperty("buildername")
+        buildnumber = self.getProperty("buildnumber")
+        uploaded = read_upload(self, self.uploads)
+        if uploaded is None:
+            self.step_status.setText(["coverage", "delta", "no", "data"])
+            self.finished(FAILURE)
+            return
+        files = {}
+        for (name, (statements, covered)) in uploaded.items():
+            files[name] = (set(statements), set(covered))
+
+        branch = self.getProperty("branch", None) or self.default_branch
+        revision = (self.getProperty("got_revision", None) or
+                    self.getProperty("revision", None))
+        baseline = self.history.latest(branch)
+        baseline_branch = branch
+        if baseline is None and branch != self.default_branch:
+            # the first build of a new branch (every new PR) is compared
+            # with the branch it most likely started from
+            baseline = self.history.latest(self.default_branch)
+            baseline_branch = self.default_branch
+        if baseline is None:
+            totals, changed = coverage_delta({}, files)
+        else:
+            totals, changed = coverage_delta(baseline[2], files)
+        for (name, value) in totals.items():
+            if baseline is None and name in ("lines-added", "lines-removed"):
+                # everything would count as gained
+                continue
+            self.setProperty("coverage-" + name, value, "CoverageDelta")
+
+        if baseline is None:
+            lines = ["no earlier coverage for branch %s\n" % branch]
+        else:
+            lines = ["against build %d (%s) of branch %s\n"
+                     % (baseline[0], baseline[1] or "unknown revision",
+                        baseline_branch)]
+            lines.append("%8s %8s %16s  %s\n"
+                         % ("gained", "lost", "covered", "file"))
+            for (name, gained, lost, covered, statements) in changed:
+                lines.append("%8d %8d %7d/%-8d  %s\n"
+                             % (gained, lost, covered, statements, name))
+        lines.append("\n")
+        for name in sorted(totals):
+            lines.append("%s: %s\n" % (name, totals[name]))
+        self.addCompleteLog("delta", "".join(lines))
+
+        try:
+            self.history.record(branch, buildername, buildnumber, revision,
+                                files)
+        except Exception:
+            log.err(None, "unable to record coverage history")
+
+        text = ["coverage"]
+        if baseline is not None:
+            if totals["lines-removed"]:
+                text.append("%d lost" % totals["lines-removed"])
+            if totals["lines-added"]:
+                text.append("%d gained" % totals["lines-added"])
+        text.append("%d not covered" % totals["uncovered-lines"])
+        self.step_status.setText(text)
+        self.finished(SUCCESS)
+
+class RecordTestImpact(BuildStep):
+    """
+    Store the test map that 'covarchive.py impact' wrote and a FileUpload
+    step put in <uploads>/<buildername>-<buildnumber>.json in the
+    TestImpactMap, if this is a build of one of 'branches' (the map should
+    describe master, not whatever a PR did to the tests).
+    """
+    name = "record-test-map"
+    description = ["recording", "test", "map"]
+    descriptionDone = ["test", "map"]
+    warnOnFailure = True
+    flunkOnFailure = False
+
+    def __init__(self, impact, uploads="test-impact-uploads",
+                 branches=["master"], **kwargs):
+        BuildStep.__init__(self, **kwargs)
+        self.addFactoryArguments(impact=impact, uploads=uploads,
+                                 branches=branches)
+        self.impact = impact
+        self.uploads = uploads
+        self.branches = branches
+
+    def start(self):
+        files = read_upload(self, self.uploads)
+        if files is None:
+            self.step_status.setText(["test", "map", "no", "data"])
+            self.finished(FAILURE)
+            return
+        branch = self.getProperty("branch", None)
+        if branch not in self.branches:
+            self.step_status.setText(["test", "map", "not", "recorded"])
+            self.finished(SKIPPED)
+            return
+        if not files:
+            # coverage without contexts; keep the map we have
+            self.step_status.setText(["test", "map", "empty"])
+            self.finished(WARNINGS)
+            return
+        revision = (self.getProperty("got_revision", None) or
+                    self.getProperty("revision", None))
+        try:
+            self.impact.record(self.getProperty("buildername"),
+                               self.getProperty("buildnumber"),
+                               revision, files)
+        except Exception:
+            log.err(None, "unable to record the test map")
+            self.step_status.setText(["test", "map", "failed"])
+            self.finished(FAILURE)
+            return
+        self.step_status.setText(["test", "map", "%d files" % len(files)])
+        self.finished(SUCCESS)
+
+def branch_changed_files(rc, stdout, stderr):
+    # BranchChanges' extract_fn, for 'git diff --name-status --no-renames'
+    # ("M\tpath" lines): every path, and separately the deleted ones
+    if rc != 0:
+        return {}
+    changed, removed = [], []
+    for line in stdout.splitlines():
+        fields = line.strip().split("\t", 1)
+        if len(fields) != 2:
+            continue
+        changed.append(fields[1])
+        if fields[0] == "D":
+            removed.append(fields[1])
+    return {"changed_files": changed, "removed_files": removed}
+
+class BranchChanges(SetPropertyFromCommand):
+    """
+    Set 'changed_files' to the files the checked-out branch changed since
+    it left 'base' of 'repourl' (the upstream repository, a string or a
+    renderable), by diffing against their merge base, for
+    SelectImpactedTests: a PR's Changes only name the files of its latest
+    push. 'removed_files' gets those of them it deleted (a rename counts
+    as a deletion and an addition). Builds of 'base' itself skip it, and
+    if git fails the properties are left unset.
+    """
+    name = "branch-changes"
+    description = ["listing", "branch", "changes"]
+    descriptionDone = ["branch", "changes"]
+    flunkOnFailure = False
+    warnOnFailure = True
+
+    def __init__(self, repourl, base="master", **kwargs):
+        kwargs["command"] = ["sh", "-c",
+                             'git fetch --quiet --no-tags "$0" "$1"'
+                             ' && git diff --name-status --no-renames'
+                             ' FETCH_HEAD...HEAD',
+                             repourl, base]
+        kwargs["extract_fn"] = branch_changed_files
+        kwargs.setdefault("doStepIf", lambda step:
+                          step.getProperty("branch", None) not in (None, base))
+        SetPropertyFromCommand.__init__(self, **kwargs)
+        self.addFactoryArguments(repourl=repourl, base=base)
+
+class SelectImpactedTests(BuildStep):
+    """
+    Decide which test modules this build runs. Builds of 'full_branches',
+    and builds without changed files (forced ones), run all of
+    'test_suite'; the others run only the modules of 'test_suite' that the
+    TestImpactMap says their changed files affect, or all of it when the
+    map can't tell (see testimpact.py). The result goes into the
+    'test_modules' property, space-separated and empty if nothing is
+    affected, for an ImpactedTests command to use.
+
+    The changed files are the 'changed_files' property, everything the
+    branch changed since it left master (see BranchChanges), or, without
+    it, the files of the Changes in this build, which are only those of
+    the latest push.
+    """
+    name = "select-tests"
+    description = ["selecting", "tests"]
+    descriptionDone = ["tests"]
+    flunkOnFailure = False
+
+    def __init__(self, impact, test_suite="allmydata",
+                 full_branches=["master"], **kwargs):
+        BuildStep.__init__(self, **kwargs)
+        self.addFactoryArguments(impact=impact, test_suite=test_suite,
+                                 full_branches=full_branches)
+        self.impact = impact
+        self.test_suite = test_suite
+        self.full_branches = full_branches
+
+    def start(self):
+        branch = self.getProperty("branch", None)
+        changed = self.getProperty("changed_files", None)
+        if changed is None:
+            changed = self.build.allFiles()
+        changed = sorted(set(changed))
+        modules = None
+        if branch is None or branch in self.full_branches:
+            reason = "branch %s runs everything" % branch
+        elif not changed:
+            reason = "no changed files"
+        else:
+            try:
+                removed = self.getProperty("removed_files", None) or []
+                modules, reason = self.impact.select(changed, removed=removed)
+            except Exception:
+                log.err(None, "unable to read the test map")
+                reason = "unable to read the test map"
+        if modules is None:
+            selected = [self.test_suite]
+            text = ["all", "tests"]
+        else:
+            selected = [m for m in modules
+                        if m == self.test_suite or
+                        m.startswith(self.test_suite + ".")]
+            text = ["%d" % len(selected), "test", "modules"]
+        self.setProperty("test_modules", " ".join(selected),
+                         "SelectImpactedTests")
+        self.addCompleteLog("selection",
+                            "%s\n\nchanged:\n%s\nselected:\n%s"
+                            % (reason,
+                               "".join(["  %s\n" % f for f in changed]),
+                               "".join(["  %s\n" % m for m in selected])))
+        self.step_status.setText(text)
+        self.finished(SUCCESS)
+
+class ImpactedTests:
+    """
+    Render to 'command' followed by the test modules SelectImpactedTests
+    chose, or 'test_suite' if it didn't run.
+    """
+    implements(IRenderable)
+
+    def __init__(self, command, test_suite):
+        self.command = command
+        self.test_suite = test_suite
+
+    def getRenderingFor(self, props):
+        d = props.render(self.command)
+        d.addCallback(lambda command:
+                      command + impacted_tests(props, self.test_suite))
+        return d
+
+def impacted_tests(props, test_suite):
+    # 'props' can be a step or a Properties instance
+    modules = props.getProperty("test_modules", None)
+    if modules is None:
+        return [test_suite]
+    return modules.split()
+
+
+def builder_fingerprint(step):
+    # the fingerprint of the factory this build was made from, computed
+    # once per factory (a reconfig makes new ones)
+    factory = step.build.builder.config.factory
+    if getattr(factory, "_fingerprint", None) is None:
+        factory._fingerprint = factory_fingerprint(factory)
+    return factory._fingerprint
+
+class ReuseBuildResult(BuildStep):
+    """
+    If this builder has built the checked-out tree (the 'tree_hash'
+    property) before, with the same factory, and that build succeeded,
+    finish this build with its result instead of building it again: the
+    summary properties are set again, the summary logs of the earlier
+    build are copied, and the remaining steps (except alwaysRun ones) are
+    skipped. Builds with the 'no_reuse' property set always run. See
+    resultcache.py.
+    """
+    name = "reuse"
+    description = ["looking", "for", "earlier", "result"]
+    descriptionDone = ["earlier", "result"]
+    flunkOnFailure = False
+
+    def __init__(self, cache, copy_logs=["problems", "warnings",
+                                         "new-warnings", "retries",
+                                         "timings"], **kwargs):
+        BuildStep.__init__(self, **kwargs)
+        self.addFactoryArguments(cache=cache, copy_logs=copy_logs)
+        self.cache = cache
+        self.copy_logs = copy_logs
+
+    def start(self):
+        tree = self.getProperty("tree_hash", None)
+        if self.getProperty("no_reuse", False):
+            self.step_status.setText(["not", "reused", "(forced)"])
+            self.finished(SKIPPED)
+            return
+        if not tree:
+            self.step_status.setText(["no", "tree", "hash"])
+            self.finished(SKIPPED)
+            return
+        buildername = self.getProperty("buildername")
+        try:
+            cached = self.cache.lookup(buildername, tree,
+                                       builder_fingerprint(self))
+        except Exception:
+            log.err(None, "unable to read the result cache")
+            cached = None
+        if cached is None:
+            self.step_status.setText(["tree", "not", "built", "before"])
+            self.finished(SUCCESS)
+            return
+
+        number = cached["buildnumber"]
+        for (name, value) in cached["properties"].items():
+            self.setProperty(name, value, "ReuseBuildResult")
+        self.setProperty("reused-build", number, "ReuseBuildResult")
+        self.addCompleteLog("reused",
+                            "tree %s was built by build #%d (revision %s)"
+                            " in %.1f minutes:\n\n%s"
+                            % (tree, number, cached["revision"],
+                               cached["duration"] / 60,
+                               "".join(["  %s: %s\n" % (name, " ".join(text))
+                                        for (name, text)
+                                        in cached["summary"]])))
+        self.copyLogs(number)
+        try:
+            self.cache.record_reuse(buildername,
+                                    self.getProperty("buildnumber"), tree,
+                                    number, cached["duration"])
+        except Exception:
+            log.err(None, "unable to record a result reuse")
+        # like haltOnFailure, but without the failure
+        self.build.terminate = True
+        self.step_status.setText(["reused", "#%d" % number, "saved",
+                                  "%d min" % (cached["duration"] / 60)])
+        self.finished(cached["results"])
+
+    def copyLogs(self, number):
+        # the logs of builds past logHorizon are gone, that's fine
+        try:
+            earlier = self.build.builder.builder_status.getBuild(number)
+            if earlier is None:
+                return
+            for step in earlier.getSteps():
+                for steplog in step.getLogs():
+                    if steplog.getName() in self.copy_logs \
+                            and steplog.old_hasContents():
+                        self.addCompleteLog("%s.%s" % (step.getName(),
+                                                       steplog.getName()),
+                                            steplog.getText())
+        except Exception:
+            log.err(None, "unable to copy the logs of build #%d" % number)
+
+class RecordBuildResult(BuildStep):
+    """
+    Store the result of this build in the ResultCache, for ReuseBuildResult
+    to find when the same tree is built again, if everything so far
+    succeeded. Put it last, and use doStepIf to leave out builds that
+    didn't run everything (a PR build that ran only some tests).
+    """
+    name = "record-result"
+    description = ["recording", "result"]
+    descriptionDone = ["result"]
+    flunkOnFailure = False
+    warnOnFailure = True
+
+    def __init__(self, cache, properties=["tahoe-version", "trial-results",
+                                          "tests-*", "warnings-*"],
+                 **kwargs):
+        BuildStep.__init__(self, **kwargs)
+        self.addFactoryArguments(cache=cache, properties=properties)
+        self.cache = cache
+        self.properties = properties
+
+    def start(self):
+        tree = self.getProperty("tree_hash", None)
+        results = self.build.result
+        if not tree or results not in (SUCCESS, WARNINGS) \
+                or self.getProperty("reused-build", None) is not None:
+            self.step_status.setText(["result", "not", "recorded"])
+            self.finished(SKIPPED)
+            return
+        properties = {}
+        for (name, (value, source)) in \
+                self.build.getProperties().asDict().items():
+            for pattern in self.properties:
+                if fnmatch.fnmatch(name, pattern):
+                    properties[name] = value
+        summary = [(step.getName(), step.getText())
+                   for step in self.build.build_status.getSteps()
+                   if step.isFinished() and step.getText()]
+        started = self.build.build_status.getTimes()[0]
+        try:
+            self.cache.record(self.getProperty("buildername"), tree,
+                              builder_fingerprint(self),
+                              self.getProperty("buildnumber"),
+                              (self.getProperty("got_revision", None) or
+                               self.getProperty("revision", None)),
+                              results, summary, properties,
+                              time.time() - started)
+        except Exception:
+            log.err(None, "unable to record the build result")
+            self.step_status.setText(["result", "not", "recorded"])
+            self.finished(FAILURE)
+            return
+        self.step_status.setText(["result", "recorded"])
+        self.finished(SUCCESS)
+
 
 class TahoeVersion(PythonCommand):
     """
@@ -666,123 +2064,102 @@ class UpdateAptRepo(ShellCommand):
         ShellCommand.__init__(self, *args, **kwargs)
         self.addFactoryArguments(update_furlfile=update_furlfile)
 
-class CreateEgg(PythonCommand):
+class BuildWheel(PythonCommand):
     """
-    Step to create an egg so that we can test an egg-installation of Tahoe.
+    Build the checkout into a wheel in 'dist', once; InstallWheel makes
+    each layout from it. See wheeltest.py, which has to have been sent to
+    'script' first. Sets the 'wheel' property to the wheel's filename.
     """
-
     flunkOnFailure = True
-    description = ["create-egg"]
-    name = "create-egg"
-    python_command = ["setup.py", "bdist_egg"]
-
-class InstallToEgg(PythonCommand):
-    """
-    Step to install the Tahoe egg into a temporary install directory.
-    """
+    haltOnFailure = True
+    name = "build-wheel"
+    description = ["building", "wheel"]
+    descriptionDone = ["wheel"]
+    built_re = re.compile(r'^wheeltest: built (\S+)$')
 
-    # If your buildslave doesn't have "easy_install" installed, then this
-    # test will fail, but that's okay.
-    flunkOnFailure = False
-    description = ["install-to-egg"]
-    name = "install-to-egg"
-
-    def __init__(self, egginstalldir="egginstalldir", *args, **kwargs):
-        # This does the equivalent of:
-        #  mkdir _install_temp egginstalldir
-        #  cd _install_temp
-        #  PYTHONPATH=../egginstalldir easy_install -d ../egginstalldir ../dist/*.egg
-        #
-        # The temporary directory is necessary to keep certain versions of
-        # setuptools (at least distribute-0.6.10, as used on the troublesome
-        # buildslave) from seeing the Twisted egg that gets put into the
-        # source directory (due to a setup_requires= line that may be
-        # obsolete by now). If it sees that egg, it won't install Twisted
-        # into the egginstalldir, and then TestFromEgg doesn't work. See
-        # #2378 for details.
-
-        python_command = ["-c", ("import glob, os, subprocess, sys;"
-                                 " os.mkdir('_install_temp');"
-                                 " os.mkdir('"+egginstalldir+"');"
-                                 " tahoe_egg = os.path.realpath(glob.glob(os.path.join('dist', '*.egg'))[0]);"
-                                 " os.chdir('_install_temp');"
-                                 " sys.exit(subprocess.call(['easy_install', '-d', '../"+egginstalldir+"', tahoe_egg]))")]
-
-        kwargs['env'] = {"PYTHONPATH": "../"+egginstalldir}
-        kwargs['python_command'] = python_command
+    def __init__(self, script="../wheeltest.py", dist="dist", *args, **kwargs):
+        kwargs["python_command"] = [script, "--dist", dist, "build"]
         PythonCommand.__init__(self, *args, **kwargs)
-        self.addFactoryArguments(egginstalldir=egginstalldir)
+        self.addFactoryArguments(script=script, dist=dist)
+        self.wheel = None
+
+    def createSummary(self, log):
+        for line in log.readlines():
+            mo = self.built_re.search(line.strip())
+            if mo:
+                self.wheel = mo.group(1)
+                self.setProperty("wheel", self.wheel, "BuildWheel")
 
-class TestFromEggTrial(PythonCommand):
+    def getText(self, cmd, results):
+        text = ShellCommand.getText(self, cmd, results)
+        if self.wheel:
+            text.append(self.wheel)
+        return text
+
+class InstallWheel(PythonCommand):
     """
-    Step to run the Tahoe-LAFS tests from the egg-installation. With Trial!
+    Install the wheel BuildWheel made into 'installdir' as a 'layout':
+    "venv" (an isolated environment, kept between builds while the
+    dependencies and the interpreter stay the same, so put it outside the
+    checkout), "prefix" (pip install --prefix) or "egg" (an unpacked .egg,
+    and a zipped one in 'dist' for UploadEgg). A venv install sets the
+    wheel-env property to hit or miss.
     """
     flunkOnFailure = True
-    description = ["test-from-egg"]
-    name = "test-from-egg"
+    haltOnFailure = True
+    env_re = re.compile(r'^wheeltest: env (hit|miss) \S+$')
+
+    def __init__(self, layout="venv", installdir="../wheel-env", requires=[],
+                 script="../wheeltest.py", dist="dist", *args, **kwargs):
+        python_command = [script, "--dist", dist, "install", layout,
+                          installdir, "--fingerprint",
+                          Property("python-fingerprint", default="")]
+        for requirement in requires:
+            python_command.extend(["--require", requirement])
+        kwargs["python_command"] = python_command
+        kwargs.setdefault("name", "install-to-%s" % layout)
+        kwargs.setdefault("description", ["install", "to", layout])
+        kwargs.setdefault("descriptionDone", ["install", "to", layout])
+        PythonCommand.__init__(self, *args, **kwargs)
+        self.addFactoryArguments(layout=layout, installdir=installdir,
+                                 requires=requires, script=script, dist=dist)
+        self.outcome = None
 
-    def __init__(self, testsuite=None, egginstalldir="egginstalldir", srcbasedir=".", *args, **kwargs):
-        if testsuite:
-            assert isinstance(testsuite, basestring)
-            pcmd = (
-                "import glob,os,subprocess,sys;"
-                "os.chdir('"+srcbasedir+"');"
-                "eggs=[os.path.realpath(egg) for egg in glob.glob('*.egg')];"
-                "testsuite='"+testsuite+"';"
-                "os.chdir('"+egginstalldir+"');"
-                "eggs+=[os.path.realpath(egg) for egg in glob.glob('*.egg')];"
-                "os.environ['PATH']=os.getcwd()+os.pathsep+os.environ['PATH'];"
-                "os.environ['PYTHONPATH']=os.pathsep.join(eggs)+os.pathsep+os.environ.get('PYTHONPATH','');"
-                "sys.exit(subprocess.call(['trial', testsuite], env=os.environ))")
+    def createSummary(self, log):
+        for line in log.readlines():
+            mo = self.env_re.search(line.strip())
+            if mo:
+                self.outcome = mo.group(1)
+                self.setProperty("wheel-env", self.outcome, "InstallWheel")
 
-        else:
-            pcmd = (
-                "import glob,os,subprocess,sys;"
-                "os.chdir('"+srcbasedir+"');"
-                "eggs=[os.path.realpath(egg) for egg in glob.glob('*.egg')];"
-                "testsuite=subprocess.Popen([sys.executable, 'setup.py', '--name'], stdout=subprocess.PIPE).communicate()[0].strip()+'.test';"
-                "os.chdir('"+egginstalldir+"');"
-                "eggs+=[os.path.realpath(egg) for egg in glob.glob('*.egg')];"
-                "os.environ['PATH']=os.getcwd()+os.pathsep+os.environ['PATH'];"
-                "os.environ['PYTHONPATH']=os.pathsep.join(eggs)+os.pathsep+os.environ.get('PYTHONPATH','');"
-                "sys.exit(subprocess.call(['trial', testsuite], env=os.environ))")
-
-        python_command = ["-c", pcmd]
-        logfiles = {"test.log": egginstalldir+"/_trial_temp/test.log"}
-        kwargs['python_command'] = python_command
-        kwargs['logfiles'] = logfiles
-        PythonCommand.__init__(self, *args, **kwargs)
-        self.addFactoryArguments(testsuite=testsuite, egginstalldir=egginstalldir, srcbasedir=srcbasedir)
+    def getText(self, cmd, results):
+        text = ShellCommand.getText(self, cmd, results)
+        if self.outcome:
+            text.append("env %s" % self.outcome)
+        return text
 
-class TestFromEgg(PythonCommand):
+class TestInstalledWheel(PythonCommand):
     """
-    Step to run the Tahoe-LAFS tests from the egg-installation.
+    Run trial on 'testsuite' (by default the package's own .test) against
+    what InstallWheel put in 'installdir', after checking that the package
+    is imported from there rather than from the checkout.
     """
     flunkOnFailure = True
-    description = ["test-from-egg"]
-    name = "test-from-egg"
-
-    def __init__(self, testsuite=None, egginstalldir="egginstalldir", srcbasedir=".", *args, **kwargs):
-        pcmd = (
-            "import glob,os,subprocess,sys;"
-            "os.chdir('"+srcbasedir+"');"
-            "os.chdir('"+egginstalldir+"');"
-            "os.environ['PATH']=os.getcwd()+os.pathsep+os.environ['PATH'];"
-            "os.environ['PYTHONPATH']=os.path.realpath('.')+os.pathsep+os.environ.get('PYTHONPATH','');"
-            )
-        if testsuite:
-            assert isinstance(testsuite, basestring)
-            pcmd += ("sys.exit(subprocess.call([sys.executable, 'tahoe', 'debug', 'trial', '%s'], env=os.environ))"
-                     % (testsuite,))
-        else:
-            pcmd += ("sys.exit(subprocess.call([sys.executable, 'tahoe', 'debug', 'trial'], env=os.environ))")
 
-        python_command = ["-c", pcmd]
-        logfiles = {"test.log": egginstalldir+"/_trial_temp/test.log"}
-        kwargs['python_command'] = python_command
-        kwargs['logfiles'] = logfiles
+    def __init__(self, layout="venv", installdir="../wheel-env",
+                 testsuite=None, script="../wheeltest.py", dist="dist",
+                 *args, **kwargs):
+        python_command = [script, "--dist", dist, "test", layout, installdir]
+        if testsuite:
+            python_command.append(testsuite)
+        kwargs["python_command"] = python_command
+        kwargs["logfiles"] = {"test.log": installdir+"/_trial_temp/test.log"}
+        kwargs.setdefault("name", "test-from-%s" % layout)
+        kwargs.setdefault("description", ["test", "from", layout])
+        kwargs.setdefault("descriptionDone", ["test", "from", layout])
         PythonCommand.__init__(self, *args, **kwargs)
-        self.addFactoryArguments(testsuite=testsuite, egginstalldir=egginstalldir, srcbasedir=srcbasedir)
+        self.addFactoryArguments(layout=layout, installdir=installdir,
+                                 testsuite=testsuite, script=script, dist=dist)
 
 class LineCount(ShellCommand):
     name = "line-count"
@@ -820,12 +2197,45 @@ class CheckMemory(ShellCommand):
                 "nodelog": "_test_memory/client.log",
                 "driver": "_test_memory/driver.log",
                 }
-
-    def __init__(self, platform, command, *args, **kwargs):
+    # we want to make these as short as possible to keep the column
+    # narrow, so strings like "up-10k: 22M" and "POST-10M: 54M".
+    abbreviations = {"upload": "up",
+                     "upload-POST": "post",
+                     "upload-self": "self",
+                     "download": "down",
+                     "download-GET": "get",
+                     "download-GET-slow": "slow",
+                     "receive": "rx",
+                     }
+
+    def __init__(self, platform, command, history=None, min_slope=0.1,
+                 superlinear_ratio=2.0, min_growth=10e6, baseline=10,
+                 *args, **kwargs):
+        # For each mode we fit memory = A*size + B. A mode is "superlinear"
+        # when the slope between its two largest files is more than
+        # 'superlinear_ratio' times the slope below them, and memory grew
+        # by more than 'min_growth' bytes more between them than that
+        # slope below accounts for (so a flat mode's noise, against a
+        # slope of about zero, doesn't count). With a
+        # MetricHistory (see metrichistory.py), a slope that is more than
+        # 'min_slope' (bytes of memory per byte of file) above the median
+        # of the last 'baseline' builds is a jump. Either one fails the
+        # step.
         ShellCommand.__init__(self, *args, **kwargs)
-        self.addFactoryArguments(platform=platform, command=command)
+        self.addFactoryArguments(platform=platform, command=command,
+                                 history=history, min_slope=min_slope,
+                                 superlinear_ratio=superlinear_ratio,
+                                 min_growth=min_growth, baseline=baseline)
         self.platform = platform
         self.command = command
+        self.history = history
+        self.min_slope = min_slope
+        self.superlinear_ratio = superlinear_ratio
+        self.min_growth = min_growth
+        self.baseline = baseline
+        self.memstats = []
+        self.fits = {}
+        self.problems = []
 
     def createSummary(self, cmd):
         self.memstats = []
@@ -845,6 +2255,77 @@ class CheckMemory(ShellCommand):
             self.setProperty("memory-usage-%s" % name, value)
             self.memstats.append( (name,value) )
         fn.close()
+        self.fitModes()
+        self.checkHistory()
+
+    def fitModes(self):
+        samples = {}
+        for name, value in self.memstats:
+            mode, size = name.split()
+            if size != "init":
+                samples.setdefault(mode, []).append((self._convert(size), value))
+        report = []
+        for mode in sorted(samples):
+            points = sorted(samples[mode])
+            fit = linear_fit(points)
+            if fit is None:
+                continue
+            slope, intercept = fit
+            self.fits[mode] = fit
+            self.setProperty("memory-slope-%s" % mode, slope, "CheckMemory")
+            self.setProperty("memory-intercept-%s" % mode, intercept,
+                             "CheckMemory")
+            report.append("%s: %.3f * size + %d\n" % (mode, slope, intercept))
+            if len(points) < 3:
+                continue
+            # compare the slope across the last step in file size against
+            # the slope up to there
+            (x0, y0), (x1, y1), (x2, y2) = points[0], points[-2], points[-1]
+            below = (y1 - y0) / float(x1 - x0)
+            top = (y2 - y1) / float(x2 - x1)
+            excess = (y2 - y1) - max(below, 0) * (x2 - x1)
+            report.append("  slope below %d: %.3f, above: %.3f (%dMB more"
+                          " than the slope below)\n"
+                          % (x1, below, top, excess / 1e6))
+            if (top > self.min_slope and
+                top > self.superlinear_ratio * max(below, 0) and
+                excess > self.min_growth):
+                self.problems.append("%s superlinear" % self.abbreviations.get(mode, mode))
+        if report:
+            self.addCompleteLog("growth", "".join(report))
+
+    def checkHistory(self):
+        if self.history is None or not self.fits:
+            return
+        series = "memory-%s" % self.platform
+        builder = self.getProperty("buildername")
+        buildnumber = self.getProperty("buildnumber")
+        revision = (self.getProperty("got_revision", None) or
+                    self.getProperty("revision", None))
+        values = {}
+        try:
+            for mode in sorted(self.fits):
+                slope, intercept = self.fits[mode]
+                baseline = self.history.values(series, builder, "%s-slope" % mode,
+                                               count=self.baseline,
+                                               before=buildnumber)
+                if len(baseline) >= 5:
+                    old = median(baseline)
+                    if slope - old > self.min_slope:
+                        self.problems.append("%s slope %.2f->%.2f"
+                                             % (self.abbreviations.get(mode, mode),
+                                                old, slope))
+                values["%s-slope" % mode] = slope
+                values["%s-intercept" % mode] = intercept
+            self.history.record(series, builder, buildnumber, revision, values)
+        except Exception:
+            log.err(None, "unable to use memory history")
+
+    def evaluateCommand(self, cmd):
+        rc = ShellCommand.evaluateCommand(self, cmd)
+        if self.problems:
+            rc = FAILURE
+        return rc
 
     def getText(self, cmd, results):
         text = ["memory", "usage"]
@@ -859,18 +2340,9 @@ class CheckMemory(ShellCommand):
             #  download-GET-slow {0B,10kB,10MB,50MB}
             #  receive {0B,10kB,10MB,50MB}
             #
-            # we want to make these as short as possible to keep the column
-            # narrow, so strings like "up-10k: 22M" and "POST-10M: 54M".
-            # Also, only show the largest test of each type.
+            # Only show the largest test of each type.
             mode, size = name.split()
-            mode = {"upload": "up",
-                    "upload-POST": "post",
-                    "upload-self": "self",
-                    "download": "down",
-                    "download-GET": "get",
-                    "download-GET-slow": "slow",
-                    "receive": "rx",
-                    }.get(mode, mode)
+            mode = self.abbreviations.get(mode, mode)
             if value >= 1e6:
                 value_s = "%dM" % (value / 1e6)
             elif value >= 1e3:
@@ -891,6 +2363,7 @@ class CheckMemory(ShellCommand):
         for mode in modes:
             size, size_s, value_s = peaks[mode]
             text.append("%s-%s: %s" % (mode, size_s, value_s))
+        text.extend(self.problems)
         return text
 
     def _convert(self, value):
@@ -903,16 +2376,49 @@ class CheckMemory(ShellCommand):
         else:
             return int(value)
 
+# the CheckSpeed properties we keep history for, and whether bigger is
+# better: the -A values are rates, the -B values are per-file times
+SPEED_METRICS = {"upload-A": True,
+                 "upload-B": False,
+                 "download-A": True,
+                 "download-B": False,
+                 "upload-B-RTT": False,
+                 "download-B-RTT": False,
+                 "create-B-SSK": False,
+                 "upload-A-SSK": True,
+                 "upload-B-SSK": False,
+                 "download-A-SSK": True,
+                 "download-B-SSK": False,
+                 }
+
 class CheckSpeed(ShellCommand):
     name = "check-speed"
     description = ["running", "speed", "test"]
     descriptionDone = ["speed", "test"]
 
-    def __init__(self, clientdir, linkname, MAKE, *args, **kwargs):
+    def __init__(self, clientdir, linkname, MAKE, history=None,
+                 warn_percent=10.0, fail_percent=25.0, baseline=10,
+                 wrapper=[], *args, **kwargs):
+        # with a MetricHistory (see metrichistory.py), each measurement is
+        # compared against the last 'baseline' builds of this builder: a
+        # significant slowdown of more than 'warn_percent' turns the step
+        # WARNINGS, more than 'fail_percent' turns it FAILURE. 'wrapper' is
+        # put in front of the make command, e.g. to run it inside a local
+        # grid (see localgrid.py).
         ShellCommand.__init__(self, *args, **kwargs)
-        self.addFactoryArguments(clientdir=clientdir, linkname=linkname, MAKE=MAKE)
-        self.command = [MAKE, "check-speed", "TESTCLIENTDIR=%s" % clientdir]
+        self.addFactoryArguments(clientdir=clientdir, linkname=linkname, MAKE=MAKE,
+                                 history=history, warn_percent=warn_percent,
+                                 fail_percent=fail_percent, baseline=baseline,
+                                 wrapper=wrapper)
+        self.command = list(wrapper) + [MAKE, "check-speed",
+                                        "TESTCLIENTDIR=%s" % clientdir]
         self.linkname = linkname
+        self.history = history
+        self.warn_percent = warn_percent
+        self.fail_percent = fail_percent
+        self.baseline = baseline
+        self.regressions = []
+        self.trends = {}
 
     def createSummary(self, cmd):
         for l in self.step_status.getLogs():
@@ -953,6 +2459,60 @@ class CheckSpeed(ShellCommand):
                 self.setProperty("download-B-SSK", self.parse_seconds(value))
             elif name.startswith("download speed SSK ("):
                 self.setProperty("download-A-SSK", self.parse_rate(value))
+        self.checkHistory()
+
+    def checkHistory(self):
+        if self.history is None:
+            return
+        values = {}
+        for name in SPEED_METRICS:
+            value = self.getProperty(name, None)
+            if value is not None:
+                values[name] = value
+        if not values:
+            return
+        series = "speed-%s" % self.linkname
+        builder = self.getProperty("buildername")
+        buildnumber = self.getProperty("buildnumber")
+        revision = (self.getProperty("got_revision", None) or
+                    self.getProperty("revision", None))
+        regressions = []
+        trend = []
+        try:
+            for name in sorted(values):
+                baseline = self.history.values(series, builder, name,
+                                               count=self.baseline,
+                                               before=buildnumber)
+                percent = check_regression(baseline, values[name],
+                                           SPEED_METRICS[name],
+                                           threshold=self.warn_percent)
+                if percent is not None:
+                    regressions.append((percent, name))
+                self.trends[name] = baseline + [values[name]]
+                trend.append(u"%-16s %s %s%s\n"
+                             % (name, sparkline(self.trends[name]),
+                                values[name],
+                                percent and u" (%.1f%% worse)" % percent or u""))
+            self.history.record(series, builder, buildnumber, revision, values)
+        except Exception:
+            log.err(None, "unable to use speed history")
+            return
+        regressions.sort(reverse=True)
+        self.regressions = regressions
+        self.setProperty("speed-regressions",
+                         dict([(name, round(percent, 1))
+                               for (percent, name) in regressions]),
+                         "CheckSpeed")
+        self.addCompleteLog("trend", u"".join(trend).encode("utf-8"))
+
+    def evaluateCommand(self, cmd):
+        rc = ShellCommand.evaluateCommand(self, cmd)
+        if rc == SUCCESS and self.regressions:
+            if self.regressions[0][0] >= self.fail_percent:
+                rc = FAILURE
+            else:
+                rc = WARNINGS
+        return rc
 
     def parse_seconds(self, value):
         if value.endswith("s"):
@@ -1039,15 +2599,28 @@ class CheckSpeed(ShellCommand):
             pass
 
         f.close()
+
+        for name in ["upload-A", "download-A"]:
+            if len(self.trends.get(name, [])) > 1:
+                text.append(u"%s %s" % (name.split("-")[0],
+                                        sparkline(self.trends[name])))
+        for percent, name in self.regressions:
+            text.append("%s %d%% slower" % (name, percent))
         return text
 
 class FilteredGitHubStatus(GitHubStatus):
     """
-    Only report status for builders with the `supported` tag.
+    Only report status for builders with the `supported` tag. Statuses go
+    through a queue that survives restarts, see githubqueue.py.
     """
     def __init__(self, tags, *a, **kw):
         self._required_tags = tags
+        queue_file = kw.pop("queue_file", "github-status.sqlite")
         GitHubStatus.__init__(self, *a, **kw)
+        self._delivery = GitHubStatusDelivery(StatusQueue(queue_file),
+                                              self._github.oauth2_token,
+                                              baseURL=kw.get("baseURL"))
+        self._delivery.setServiceParent(self)
 
     def builderAdded(self, name_, builder_):
         if builder_.matchesAnyTag(self._required_tags):
@@ -1070,26 +2643,8 @@ class FilteredGitHubStatus(GitHubStatus):
 
     def _sendGitHubStatus(self, status):
         """
-        Send status to GitHub API.
+        Queue the status for GitHub, replacing an unsent one for the same
+        sha and context.
         """
-        d = self._github.repos.createStatus(
-            repo_user=status['repoOwner'].encode('utf-8'),
-            repo_name=status['repoName'].encode('utf-8'),
-            sha=status['sha'].encode('utf-8'),
-            state=status['state'].encode('utf-8'),
-            target_url=status['targetURL'].encode('utf-8'),
-            description=status['description'].encode('utf-8'),
-            context=status['context'].encode('utf-8'),
-        )
-
-        success_message = (
-            'Status "%(state)s" sent for '
-            '%(repoOwner)s/%(repoName)s at %(sha)s.'
-        ) % status
-        error_message = (
-            'Fail to send status "%(state)s" for '
-            '%(repoOwner)s/%(repoName)s at %(sha)s.'
-        ) % status
-        d.addCallback(lambda result: log.msg(success_message))
-        d.addErrback(lambda failure: log.err(failure, error_message))
-        return d
+        self._delivery.enqueue(status)
+        return defer.succeed(None)
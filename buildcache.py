@@ -0,0 +1,257 @@
+"""
+A per-buildslave cache of compiled build artifacts
+
+BuildTahoe ('setup.py build') and pycryptopp's compile steps build their C
+and C++ extensions (pycryptopp and its Crypto++, zfec) from source in every
+build, since the checkout's 'git clean -x' throws the last build's
+artifacts away. On the ARM and older BSD buildslaves that is most of the
+build. This script keeps them between builds instead.
+
+It runs on the buildslave: master.cfg sends it over with a FileDownload
+step, and then runs, from the top of the checkout,
+
+  python ../buildcache.py --cache ../../build-cache --fingerprint FP \\
+      --source 'setup.py' --source 'src/*.cpp' restore build
+  python setup.py build
+  python ../buildcache.py --cache ../../build-cache --fingerprint FP \\
+      --source 'setup.py' --source 'src/*.cpp' save build
+
+The artifacts (here 'build', but any files or directories, with shell
+wildcards) are stored under a key that hashes:
+
+ - the contents of every file matching a --source pattern
+ - the interpreter's ABI: version, unicode width, word size, platform tag
+   and SOABI, from the python running this script
+ - the compiler and flags python builds extensions with, and CC, CXX,
+   CFLAGS, CXXFLAGS, CPPFLAGS and LDFLAGS from the environment
+ - FP, what ToolVersions reported for the interpreter, and any --flag
+   (e.g. the build command's options)
+
+so the same artifacts are shared by every builder on the buildslave that
+builds the same sources the same way. 'restore' copies a cached entry into
+the tree on a hit and makes every restored file newer than the sources,
+so distutils doesn't rebuild them; 'save' copies the artifacts in after a
+successful build and then evicts the least recently used entries until the
+cache fits in --max-size.
+
+'bench' times a build with an empty cache (cold) and again, from a clean
+tree, with what the first one saved (warm):
+
+  python ../buildcache.py --cache /tmp/bc --source 'src/*.cpp' \\
+      bench build -- python setup.py build
+"""
+
+import os, sys, glob, time, shutil, fnmatch, hashlib, argparse, subprocess
+import tempfile
+try:
+    import sysconfig
+except ImportError:
+    # python 2.6
+    from distutils import sysconfig
+
+ENVIRONMENT = ("CC", "CXX", "CFLAGS", "CXXFLAGS", "CPPFLAGS", "LDFLAGS")
+# don't hash these when walking the tree for --source patterns
+SKIP_DIRS = (".git", ".tox", "build", ".eggs", "_trial_temp")
+
+def abi_tag():
+    from distutils.util import get_platform
+    parts = ["%d.%d.%d" % sys.version_info[:3], "%d" % sys.maxunicode,
+             "%d" % sys.maxsize, get_platform()]
+    for name in ("SOABI", "CC", "CFLAGS", "LDSHARED"):
+        parts.append("%s" % (sysconfig.get_config_var(name),))
+    return parts
+
+def source_files(patterns):
+    found = []
+    for dirpath, dirnames, filenames in os.walk("."):
+        dirnames[:] = sorted([name for name in dirnames
+                              if name not in SKIP_DIRS])
+        for name in sorted(filenames):
+            path = os.path.normpath(os.path.join(dirpath, name))
+            if [p for p in patterns if fnmatch.fnmatch(path, p)]:
+                found.append(path)
+    return found
+
+def cache_key(options):
+    h = hashlib.sha256()
+    for path in source_files(options.sources):
+        h.update(path.encode("utf-8") + b"\0")
+        with open(path, "rb") as f:
+            h.update(f.read())
+    parts = abi_tag() + [options.fingerprint] + list(options.flags)
+    parts += ["%s=%s" % (name, os.environ.get(name, ""))
+              for name in ENVIRONMENT]
+    for part in parts:
+        h.update(b"\0" + part.encode("utf-8"))
+    return h.hexdigest()[:24]
+
+def tree_size(path):
+    if not os.path.isdir(path):
+        return os.lstat(path).st_size
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return size
+
+def remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+def copy(source, target):
+    if os.path.isdir(source) and not os.path.islink(source):
+        shutil.copytree(source, target, symlinks=True)
+    else:
+        shutil.copy2(source, target)
+
+def touch_all(path, now):
+    # newer than any source file, so distutils' newer() checks skip them
+    if not os.path.isdir(path):
+        os.utime(path, (now, now))
+        return
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            filename = os.path.join(dirpath, name)
+            if not os.path.islink(filename):
+                os.utime(filename, (now, now))
+
+def expand(patterns, top="."):
+    # the paths (relative to 'top') that match the patterns
+    found = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(os.path.join(top, pattern))):
+            path = os.path.relpath(path, top)
+            if path not in found:
+                found.append(path)
+    return found
+
+def report(what, key, detail=""):
+    # BuildArtifactCache in bbsupport.py reads these
+    sys.stdout.write("buildcache: %s %s%s\n" % (what, key, detail))
+    sys.stdout.flush()
+
+def restore(options):
+    key = cache_key(options)
+    cached = os.path.join(options.cache, key)
+    if not os.path.isdir(cached):
+        report("miss", key)
+        return key, False
+    now = time.time()
+    # entries keep the artifacts' paths relative to the checkout
+    for path in expand(options.paths, cached):
+        remove(path)
+        parent = os.path.dirname(path)
+        if parent and not os.path.isdir(parent):
+            os.makedirs(parent)
+        copy(os.path.join(cached, path), path)
+        touch_all(path, now)
+    # for the LRU
+    os.utime(cached, None)
+    report("hit", key, " (%dMB)" % (tree_size(cached) // 1000000))
+    return key, True
+
+def save(options):
+    key = cache_key(options)
+    cached = os.path.join(options.cache, key)
+    paths = expand(options.paths)
+    if not paths:
+        report("empty", key)
+        return key
+    if not os.path.isdir(options.cache):
+        os.makedirs(options.cache)
+    # copy it in under a temporary name, so that a half-copied entry (a
+    # full disk, an interrupted build) is never restored
+    partial = cached + ".partial"
+    remove(partial)
+    os.makedirs(partial)
+    for path in paths:
+        target = os.path.join(partial, path)
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        copy(path, target)
+    remove(cached)
+    os.rename(partial, cached)
+    report("saved", key, " (%dMB)" % (tree_size(cached) // 1000000))
+    evict(options.cache, options.max_size * 1e9)
+    return key
+
+def evict(cache, max_bytes):
+    entries = []
+    for name in os.listdir(cache):
+        path = os.path.join(cache, name)
+        if not name.endswith(".partial"):
+            entries.append((os.stat(path).st_mtime, tree_size(path), path))
+    total = sum([size for (used, size, path) in entries])
+    entries.sort()
+    while entries and total > max_bytes:
+        used, size, path = entries.pop(0)
+        remove(path)
+        total -= size
+        sys.stdout.write("buildcache: evicted %s (%dMB, last used %s)\n"
+                         % (path, size // 1000000,
+                            time.strftime("%Y-%m-%d", time.localtime(used))))
+    sys.stdout.write("buildcache: %dMB in %s\n" % (total // 1000000, cache))
+
+def bench(options):
+    if not options.command:
+        sys.stderr.write("bench needs a build command after --\n")
+        return 1
+    options.cache = tempfile.mkdtemp(prefix="buildcache-bench-")
+    times = []
+    try:
+        for run in ("cold", "warm"):
+            for path in expand(options.paths):
+                remove(path)
+            start = time.time()
+            key, hit = restore(options)
+            if subprocess.call(options.command) != 0:
+                sys.stderr.write("the %s build failed\n" % run)
+                return 1
+            if not hit:
+                save(options)
+            times.append((run, hit, time.time() - start))
+    finally:
+        remove(options.cache)
+    for (run, hit, elapsed) in times:
+        sys.stdout.write("%s: %s, %.1fs\n"
+                         % (run, hit and "hit" or "miss", elapsed))
+    sys.stdout.write("speedup: %.1fx\n" % (times[0][2] / max(times[1][2],
+                                                            0.001)))
+    return 0
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="cache compiled artifacts")
+    parser.add_argument("--cache", default="../../build-cache")
+    parser.add_argument("--fingerprint", default="")
+    parser.add_argument("--source", dest="sources", action="append",
+                        default=[], help="pattern of files the artifacts"
+                        " are built from (repeatable)")
+    parser.add_argument("--flag", dest="flags", action="append", default=[],
+                        help="anything else that changes the artifacts")
+    parser.add_argument("--max-size", type=float, default=2.0,
+                        help="in GB (default 2)")
+    parser.add_argument("action", choices=["restore", "save", "bench"])
+    parser.add_argument("paths", nargs="+",
+                        help="the artifacts, relative to the checkout")
+    # for bench: ... -- BUILD COMMAND
+    command = []
+    if "--" in argv:
+        command = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+    options = parser.parse_args(argv)
+    options.command = command
+    if options.action == "restore":
+        restore(options)
+    elif options.action == "save":
+        save(options)
+    else:
+        return bench(options)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,216 @@
+"""
+Build logs stored as compressed chunks
+
+buildbot compresses a finished step log into one bz2 (or gzip) stream. That
+is small, but every read of it starts from the beginning: the web log
+viewer, a re-parse of a test.log and the 'problems' and 'timings' logs all
+decompress everything before the part they want, and LogFile.getChunks
+seeks back on every 2k read, which BZ2File answers by decompressing the log
+from the start again.
+
+With install(), a finished log is instead written as '<log>.chunked': the
+log in independently zlib-compressed chunks of 'chunk_size' bytes, followed
+by an index of where each chunk starts and a fixed-size trailer:
+
+  chunk 0, chunk 1, ..., index (one >Q offset per chunk, and one for the
+  end of the last), trailer (>8sIQQ: MAGIC, chunk_size, length, index offset)
+
+so reading from any offset decompresses one chunk. Decompressed chunks are
+kept in an LRU cache of at most 'cache_bytes', shared by all logs, so
+paging through a log (or reading it again for a summary) mostly doesn't
+decompress at all. Logs that were compressed before are still read as they
+were.
+
+This only changes how logs are kept; how many are kept is up to the
+logHorizon and buildHorizon settings in master.cfg.
+
+In master.cfg:
+
+  import chunkedlogs
+  chunkedlogs.install(chunk_size=64*1024, cache_bytes=32*1024*1024)
+"""
+
+import os, struct, zlib
+from collections import OrderedDict
+
+MAGIC = b"BBCHUNK1"
+TRAILER = struct.Struct(">8sIQQ")
+OFFSET = struct.Struct(">Q")
+
+def write_chunked(infile, filename, chunk_size=64*1024, level=6):
+    """
+    Compress everything read from 'infile' into 'filename'. Returns the
+    uncompressed length.
+    """
+    offsets = []
+    length = 0
+    f = open(filename, "wb")
+    try:
+        while True:
+            data = infile.read(chunk_size)
+            if not data:
+                break
+            offsets.append(f.tell())
+            f.write(zlib.compress(data, level))
+            length += len(data)
+            if len(data) < chunk_size:
+                break
+        index_offset = f.tell()
+        offsets.append(index_offset)
+        f.write(b"".join([OFFSET.pack(offset) for offset in offsets]))
+        f.write(TRAILER.pack(MAGIC, chunk_size, length, index_offset))
+    finally:
+        f.close()
+    return length
+
+class ChunkCache:
+    """
+    Decompressed chunks, most recently used last, up to 'max_bytes' of
+    them.
+    """
+    def __init__(self, max_bytes=32*1024*1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = self.misses = 0
+        self._chunks = OrderedDict()
+
+    def get(self, key):
+        data = self._chunks.pop(key, None)
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._chunks[key] = data
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        old = self._chunks.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self._chunks[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            key, old = self._chunks.popitem(last=False)
+            self.size -= len(old)
+
+chunk_cache = ChunkCache()
+
+class ChunkedLogReader:
+    """
+    A read-only, seekable file object for a '.chunked' log, which is what
+    LogFile.getFile() returns for one.
+    """
+    def __init__(self, filename, cache=None):
+        self.filename = filename
+        self.cache = cache if cache is not None else chunk_cache
+        self._f = open(filename, "rb")
+        st = os.fstat(self._f.fileno())
+        # a log can be rewritten under the same name if the buildmaster
+        # reuses a build number, so the cache key includes the mtime
+        self._key = (filename, st.st_mtime, st.st_size)
+        self._f.seek(-TRAILER.size, 2)
+        magic, self.chunk_size, self.length, index_offset = \
+            TRAILER.unpack(self._f.read(TRAILER.size))
+        if magic != MAGIC:
+            raise IOError("%s is not a chunked log" % filename)
+        self._f.seek(index_offset)
+        index = self._f.read(st.st_size - TRAILER.size - index_offset)
+        self._offsets = [OFFSET.unpack(index[i:i+OFFSET.size])[0]
+                         for i in range(0, len(index), OFFSET.size)]
+        self.pos = 0
+
+    def _chunk(self, number):
+        key = self._key + (number,)
+        data = self.cache.get(key)
+        if data is None:
+            start, end = self._offsets[number], self._offsets[number+1]
+            self._f.seek(start)
+            data = zlib.decompress(self._f.read(end - start))
+            self.cache.put(key, data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.length
+        self.pos = max(0, offset)
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length - self.pos
+        pieces = []
+        while size > 0 and self.pos < self.length:
+            number, start = divmod(self.pos, self.chunk_size)
+            data = self._chunk(number)[start:start+size]
+            pieces.append(data)
+            self.pos += len(data)
+            size -= len(data)
+        return b"".join(pieces)
+
+    def read_range(self, offset, size):
+        self.seek(offset)
+        return self.read(size)
+
+    def close(self):
+        self._f.close()
+
+def install(chunk_size=64*1024, cache_bytes=32*1024*1024, level=6):
+    """
+    Make buildbot's LogFile write finished logs as '.chunked' files and
+    read them through 'chunk_cache'. Safe to call again on reconfig, which
+    only changes the settings.
+    """
+    from twisted.internet import threads
+    from twisted.python import log
+    from buildbot.status.logfile import LogFile, _tryremove
+
+    chunk_cache.max_bytes = cache_bytes
+    LogFile.chunk_settings = (chunk_size, level)
+    if getattr(LogFile, "_original_getFile", None) is not None:
+        return
+    LogFile._original_getFile = LogFile.getFile
+    LogFile._original_old_hasContents = LogFile.old_hasContents
+
+    def getFile(self):
+        if self.openfile:
+            return self.openfile
+        chunked = self.getFilename() + ".chunked"
+        if os.path.exists(chunked):
+            return ChunkedLogReader(chunked)
+        return self._original_getFile()
+
+    def old_hasContents(self):
+        return (os.path.exists(self.getFilename() + ".chunked") or
+                self._original_old_hasContents())
+
+    def compressLog(self):
+        # stepFinished calls this for logs over logCompressionLimit
+        filename = self.getFilename()
+        chunked = filename + ".chunked"
+        chunk_size, level = self.chunk_settings
+        def _compress():
+            infile = open(filename, "rb")
+            try:
+                write_chunked(infile, chunked + ".tmp", chunk_size, level)
+            finally:
+                infile.close()
+            os.rename(chunked + ".tmp", chunked)
+        d = threads.deferToThread(_compress)
+        def _remove_uncompressed(res):
+            _tryremove(filename, 1, 5)
+        def _failed(f):
+            log.err(f, "failed to compress %s" % filename)
+            if os.path.exists(chunked + ".tmp"):
+                _tryremove(chunked + ".tmp", 1, 5)
+        d.addCallbacks(_remove_uncompressed, _failed)
+        return d
+
+    LogFile.getFile = getFile
+    LogFile.old_hasContents = old_hasContents
+    LogFile.compressLog = compressLog
@@ -0,0 +1,485 @@
+"""
+Streaming coverage uploads
+
+The old coverage steps ran 'coverage html', made a cov-VER.tar.bz2 of the
+.coverage data, the results and the whole htmlcov tree with a
+single-threaded bzip2, uploaded that file with 'flappclient upload-file',
+and then asked the server to unpack it with a second flappclient call.
+Most of the HTML doesn't change from one build to the next.
+
+This script does both ends of a quicker pipeline:
+
+  (on the buildslave)
+  python ../covarchive.py pack --published ../../coverage-published.json \\
+    | flappclient --furlfile ../../stream-coverage.furl run-command
+
+  (on the coverage server, as the run-command service behind that furl,
+  added with 'flappserver add BASEDIR run-command --accept-stdin --send-stdout
+  ROOT python covarchive.py unpack .')
+
+'pack' writes a tar stream to stdout, compressed with 'zstd -T0' or 'pigz'
+(both use every core) if the buildslave has one, or with gzip -1 otherwise.
+The first member is a manifest with a content hash of every file under
+htmlcov/. Only the files whose hash differs from the last published
+manifest are put in the stream, along with the .coverage data and results.
+The manifest names its base, the digest of the published manifest it was
+computed against.
+
+'unpack' reads the stream from stdin. It builds htmlcov-VER by hard-linking
+the previous set and then replacing only the changed files, so unchanged
+files take no space. If the server's latest manifest isn't the base the
+stream was computed against, it refuses. Then 'pack --full' sends
+everything. After a successful unpack, 'published' records the new
+manifest on the buildslave.
+
+Each end reports what it did and how long it took on a 'covarchive:' line,
+and the StreamCoverage step turns those into build properties.
+
+'lines' writes the executable and covered lines of every source file to a
+JSON file, for the CoverageDelta step on the buildmaster.
+
+'rcfile' writes a copy of .coveragerc that also records which test
+function ran each line (coverage 5 or later), for the coverage run to use
+through COVERAGE_RCFILE (or in place of .coveragerc). 'impact' then writes
+which test modules ran each source file, for the RecordTestImpact step
+(see testimpact.py). It imports the test modules to find out which of them
+run the tests they inherit, so it has to run with their interpreter.
+"""
+
+import os, sys, json, time, shutil, hashlib, tarfile, argparse, subprocess
+import gzip, bz2, io, threading
+
+MANIFEST = "MANIFEST.json"
+LATEST = "latest-manifest.json"
+
+def say(message):
+    # stderr on the buildslave: stdout is the archive
+    sys.stderr.write("covarchive: %s\n" % message)
+    sys.stderr.flush()
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(65536)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+def tree_hashes(top):
+    hashes = {}
+    for dirpath, dirnames, filenames in os.walk(top):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            hashes[os.path.relpath(path, top).replace(os.sep, "/")] = file_hash(path)
+    return hashes
+
+def manifest_digest(manifest):
+    # of the file set only, so the same tree always has the same digest
+    canonical = json.dumps(sorted(manifest["files"].items()))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def find_on_path(program):
+    for directory in os.environ.get("PATH", "").split(os.pathsep):
+        candidate = os.path.join(directory, program)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+class Compressor:
+    """
+    A file-like object that compresses what is written to it onto 'out',
+    through zstd or pigz in a subprocess if we have one.
+    """
+    def __init__(self, out):
+        self.out = out
+        self.proc = None
+        for (codec, command) in [("zstd", ["zstd", "-T0", "-3", "-q", "-c"]),
+                                 ("pigz", ["pigz", "-c"])]:
+            if find_on_path(command[0]):
+                self.codec = codec
+                self.proc = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                             stdout=subprocess.PIPE)
+                # copy its output from a thread, so we can count it
+                self.copier = threading.Thread(target=shutil.copyfileobj,
+                                               args=(self.proc.stdout, out))
+                self.copier.daemon = True
+                self.copier.start()
+                self.stream = self.proc.stdin
+                return
+        self.codec = "gzip"
+        self.stream = gzip.GzipFile(fileobj=out, mode="wb", compresslevel=1)
+
+    def write(self, data):
+        self.stream.write(data)
+
+    def close(self):
+        self.stream.close()
+        if self.proc is not None:
+            self.copier.join()
+            if self.proc.wait() != 0:
+                raise RuntimeError("%s failed" % self.codec)
+
+def stdout_bytes():
+    return getattr(sys.stdout, "buffer", sys.stdout)
+
+def stdin_bytes():
+    return getattr(sys.stdin, "buffer", sys.stdin)
+
+class CountingWriter:
+    def __init__(self, out):
+        self.out = out
+        self.count = 0
+    def write(self, data):
+        self.count += len(data)
+        self.out.write(data)
+    def flush(self):
+        self.out.flush()
+
+def pack(options):
+    started = time.time()
+    if subprocess.call(["coverage", "html"], stdout=sys.stderr):
+        raise SystemExit("coverage html failed")
+    name = options.name or version_name()
+    hashes = tree_hashes("htmlcov")
+    published = None
+    if not options.full and os.path.exists(options.published):
+        with open(options.published) as f:
+            published = json.load(f)
+    old = published and published["files"] or {}
+    changed = sorted([path for (path, h) in hashes.items() if old.get(path) != h])
+    deleted = sorted([path for path in old if path not in hashes])
+    manifest = {"name": name,
+                "base": published and manifest_digest(published) or None,
+                "files": hashes,
+                "deleted": deleted,
+                }
+    # keep it until the server has it, see 'published'
+    with open(options.published + ".pending", "w") as f:
+        json.dump(manifest, f)
+
+    out = stdout_bytes()
+    counter = CountingWriter(out)
+    compressor = Compressor(counter)
+    tar = tarfile.open(fileobj=compressor, mode="w|")
+    data = json.dumps(manifest).encode("utf-8")
+    info = tarfile.TarInfo(MANIFEST)
+    info.size = len(data)
+    info.mtime = time.time()
+    tar.addfile(info, io.BytesIO(data))
+    for (source, target) in [(".coverage", "coverage-%s" % name),
+                             (".coverage-results", "coverage-results-%s" % name)]:
+        if os.path.exists(source):
+            tar.add(source, target)
+    for path in changed:
+        tar.add(os.path.join("htmlcov", *path.split("/")),
+                "htmlcov-%s/%s" % (name, path))
+    tar.close()
+    compressor.close()
+    out.flush()
+    say("packed %d changed files, %d unchanged, %d deleted, %d bytes with %s in %.1fs"
+        % (len(changed), len(hashes) - len(changed), len(deleted),
+           counter.count, compressor.codec, time.time() - started))
+
+def version_name():
+    def setup(arg):
+        return subprocess.check_output([sys.executable, "setup.py", arg]
+                                       ).decode("utf-8").strip().splitlines()[-1]
+    return "%s-%s" % (setup("--name"), setup("--version"))
+
+def published(options):
+    os.rename(options.published + ".pending", options.published)
+
+class Decompressor:
+    """
+    Work out the codec from the first bytes of 'source' and return a
+    file-like object of the decompressed data.
+    """
+    def __init__(self, source):
+        self.proc = None
+        head = source.read(4)
+        if head.startswith(b"\x28\xb5\x2f\xfd"):
+            self.proc = subprocess.Popen(["zstd", "-d", "-q", "-c"],
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE)
+            # feed it from a thread, so that we can read its output here
+            def feed():
+                self.proc.stdin.write(head)
+                shutil.copyfileobj(source, self.proc.stdin)
+                self.proc.stdin.close()
+            self.feeder = threading.Thread(target=feed)
+            self.feeder.daemon = True
+            self.feeder.start()
+            self.stream = self.proc.stdout
+        elif head.startswith(b"\x1f\x8b"):
+            self.stream = gzip.GzipFile(fileobj=Prefixed(head, source), mode="rb")
+        elif head.startswith(b"BZh"):
+            self.stream = bz2.BZ2File(Prefixed(head, source), "rb")
+        else:
+            raise SystemExit("unknown archive format")
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    def close(self):
+        if self.proc is not None:
+            self.feeder.join()
+            if self.proc.wait() != 0:
+                raise SystemExit("zstd failed, truncated upload?")
+
+class Prefixed:
+    def __init__(self, head, source):
+        self.head = head
+        self.source = source
+    def read(self, size=-1):
+        if self.head:
+            if size < 0:
+                data, self.head = self.head + self.source.read(), b""
+                return data
+            data, self.head = self.head[:size], self.head[size:]
+            if len(data) < size:
+                data += self.source.read(size - len(data))
+            return data
+        return self.source.read(size)
+
+def safe_path(root, name):
+    path = os.path.normpath(os.path.join(root, name))
+    if os.path.isabs(name) or not path.startswith(os.path.abspath(root) + os.sep):
+        raise SystemExit("refusing to write %r" % name)
+    return path
+
+def link_tree(source, target):
+    for dirpath, dirnames, filenames in os.walk(source):
+        destdir = os.path.join(target, os.path.relpath(dirpath, source))
+        if not os.path.isdir(destdir):
+            os.makedirs(destdir)
+        for name in filenames:
+            os.link(os.path.join(dirpath, name), os.path.join(destdir, name))
+
+def unpack(options):
+    started = time.time()
+    root = os.path.abspath(options.root)
+    stream = Decompressor(stdin_bytes())
+    tar = tarfile.open(fileobj=stream, mode="r|")
+    first = tar.next()
+    if first is None or first.name != MANIFEST:
+        raise SystemExit("the stream doesn't start with a manifest")
+    manifest = json.loads(tar.extractfile(first).read().decode("utf-8"))
+    name = manifest["name"]
+    latest_file = os.path.join(root, LATEST)
+    latest = None
+    if os.path.exists(latest_file):
+        with open(latest_file) as f:
+            latest = json.load(f)
+    if manifest["base"] is not None:
+        if latest is None or manifest_digest(latest) != manifest["base"]:
+            sys.stdout.write("covarchive: base mismatch, send everything\n")
+            sys.exit(3)
+
+    staging = os.path.join(root, ".incoming-%s" % name)
+    if os.path.exists(staging):
+        shutil.rmtree(staging)
+    os.makedirs(staging)
+    htmlcov = "htmlcov-%s" % name
+    if manifest["base"] is not None:
+        link_tree(os.path.join(root, "htmlcov-%s" % latest["name"]),
+                  os.path.join(staging, htmlcov))
+        for path in manifest["deleted"]:
+            target = safe_path(staging, "%s/%s" % (htmlcov, path))
+            if os.path.exists(target):
+                os.unlink(target)
+    written = 0
+    while True:
+        # (iterating over 'tar' would start again from the manifest)
+        member = tar.next()
+        if member is None:
+            break
+        if not member.isfile():
+            continue
+        target = safe_path(staging, member.name)
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        # never write through a hard link into the previous set
+        if os.path.exists(target):
+            os.unlink(target)
+        with open(target, "wb") as f:
+            shutil.copyfileobj(tar.extractfile(member), f)
+        written += 1
+    tar.close()
+    stream.close()
+
+    got = tree_hashes(os.path.join(staging, htmlcov))
+    if got != manifest["files"]:
+        shutil.rmtree(staging)
+        raise SystemExit("unpacked tree doesn't match its manifest")
+    for entry in os.listdir(staging):
+        target = os.path.join(root, entry)
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+        elif os.path.exists(target):
+            os.unlink(target)
+        os.rename(os.path.join(staging, entry), target)
+    os.rmdir(staging)
+    with open(latest_file + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.rename(latest_file + ".tmp", latest_file)
+    # and point 'current' at it, like 'make update-tahoe-coverage' did
+    current = os.path.join(root, "current")
+    if os.path.lexists(current + ".tmp"):
+        os.unlink(current + ".tmp")
+    os.symlink(htmlcov, current + ".tmp")
+    os.rename(current + ".tmp", current)
+    sys.stdout.write("covarchive: unpacked %d files into %s in %.1fs\n"
+                     % (written, htmlcov, time.time() - started))
+
+def lines(options):
+    # executable and covered lines of every source file under the
+    # checkout, for CoverageDelta on the buildmaster (see
+    # coveragehistory.py)
+    import coverage
+    cov = getattr(coverage, "Coverage", None) or coverage.coverage
+    cov = cov()
+    cov.load()
+    if hasattr(cov, "get_data"):
+        measured = cov.get_data().measured_files()
+    else:
+        measured = cov.data.measured_files()
+    top = os.path.abspath(".") + os.sep
+    files = {}
+    for filename in measured:
+        if not os.path.abspath(filename).startswith(top):
+            continue
+        try:
+            _, statements, excluded, missing, _ = cov.analysis2(filename)
+        except Exception:
+            # the source is gone, or isn't python
+            continue
+        relative = os.path.relpath(filename).replace(os.sep, "/")
+        files[relative] = [sorted(statements),
+                           sorted(set(statements) - set(missing))]
+    with open(options.output, "w") as f:
+        json.dump(files, f)
+    sys.stdout.write("covarchive: wrote line sets for %d files to %s\n"
+                     % (len(files), options.output))
+
+def rcfile(options):
+    try:
+        from ConfigParser import RawConfigParser
+    except ImportError:
+        from configparser import RawConfigParser
+    config = RawConfigParser()
+    config.read(".coveragerc")
+    if not config.has_section("run"):
+        config.add_section("run")
+    config.set("run", "dynamic_context", "test_function")
+    with open(options.output, "w") as f:
+        config.write(f)
+    sys.stdout.write("covarchive: wrote %s\n" % options.output)
+
+def module_name(filename, srcdir):
+    # src/allmydata/test/cli/test_cli.py -> allmydata.test.cli.test_cli
+    return os.path.relpath(filename, srcdir)[:-len(".py")].replace(os.sep, ".")
+
+def test_runners(modules, srcdir):
+    # {"module.Class": set of test modules} for every class whose test
+    # methods the TestCases of a test module run: the TestCases themselves
+    # and everything they inherit from, mixins and base classes included,
+    # wherever those are defined. Trial runs every TestCase it finds in a
+    # test module's namespace, imported ones too.
+    import inspect, unittest
+    sys.path.insert(0, os.path.abspath(srcdir))
+    runners = {}
+    for module in modules:
+        try:
+            __import__(module)
+        except Exception as e:
+            sys.stdout.write("covarchive: unable to import %s: %s\n"
+                             % (module, e))
+            continue
+        for (name, value) in vars(sys.modules[module]).items():
+            if name.startswith("_") or not inspect.isclass(value) \
+                    or not issubclass(value, unittest.TestCase):
+                continue
+            for cls in inspect.getmro(value):
+                runners.setdefault("%s.%s" % (cls.__module__, cls.__name__),
+                                   set()).add(module)
+    return runners
+
+def impact(options):
+    # which test modules ran each source file, from the test_function
+    # contexts that 'rcfile' turned on
+    import coverage
+    cov = coverage.Coverage()
+    cov.load()
+    data = cov.get_data()
+    files = {}
+    if not hasattr(data, "contexts_by_lineno"):
+        sys.stdout.write("covarchive: coverage %s doesn't record contexts\n"
+                         % coverage.__version__)
+    else:
+        top = os.path.abspath(".") + os.sep
+        testdir = os.path.abspath(options.testdir) + os.sep
+        measured = [filename for filename in data.measured_files()
+                    if os.path.abspath(filename).startswith(top)]
+        # contexts are dotted test names, module.Class.test_method, named
+        # after the class that defines the method. That is a mixin's for
+        # an inherited test, so the modules are the ones whose TestCases
+        # inherit from that class, plus the longest prefix that is one of
+        # the test files (for plain test functions)
+        modules = set([module_name(os.path.abspath(filename), options.srcdir)
+                       for filename in measured
+                       if os.path.abspath(filename).startswith(testdir)
+                       and os.path.basename(filename).startswith("test_")])
+        runners = test_runners(sorted(modules), options.srcdir)
+        owners = {}
+        for filename in measured:
+            tests = set()
+            for contexts in data.contexts_by_lineno(filename).values():
+                for context in contexts:
+                    if context not in owners:
+                        owners[context] = set(runners.get(
+                            context.rsplit(".", 1)[0], ()))
+                        parts = context.split(".")
+                        for i in range(len(parts), 0, -1):
+                            if ".".join(parts[:i]) in modules:
+                                owners[context].add(".".join(parts[:i]))
+                                break
+                    tests.update(owners[context])
+            if tests:
+                relative = os.path.relpath(filename).replace(os.sep, "/")
+                files[relative] = sorted(tests)
+    with open(options.output, "w") as f:
+        json.dump(files, f)
+    sys.stdout.write("covarchive: wrote test modules for %d files to %s\n"
+                     % (len(files), options.output))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="stream coverage results")
+    subparsers = parser.add_subparsers(dest="action")
+    p = subparsers.add_parser("pack")
+    p.add_argument("--published", required=True,
+                   help="the manifest of the last published set")
+    p.add_argument("--name", help="default: NAME-VERSION from setup.py")
+    p.add_argument("--full", action="store_true",
+                   help="send every file, whatever was published")
+    p = subparsers.add_parser("published")
+    p.add_argument("--published", required=True)
+    p = subparsers.add_parser("unpack")
+    p.add_argument("root")
+    p = subparsers.add_parser("lines")
+    p.add_argument("output")
+    p = subparsers.add_parser("rcfile")
+    p.add_argument("output")
+    p = subparsers.add_parser("impact")
+    p.add_argument("--srcdir", default="src")
+    p.add_argument("--testdir", default="src/allmydata/test")
+    p.add_argument("output")
+    options = parser.parse_args(argv)
+    {"pack": pack, "published": published, "unpack": unpack,
+     "lines": lines, "rcfile": rcfile,
+     "impact": impact}[options.action](options)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
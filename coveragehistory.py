@@ -0,0 +1,157 @@
+"""
+Coverage baselines kept on the buildmaster
+
+A CoverageHistory stores the last 'keep' coverage datasets of the default
+branch, and the newest one of every other branch (for at most 'max_age'
+seconds), one row per source file with its executable and covered line
+sets, for the CoverageDelta step to compare a build against.
+
+In master.cfg:
+
+  from coveragehistory import CoverageHistory
+  coverage_history = CoverageHistory("coverage-history.sqlite", keep=10,
+                                     max_age=30*24*3600)
+
+The buildslave sends over a JSON file made by 'covarchive.py lines':
+{filename: [[executable lines], [covered lines]]}.
+"""
+
+import time
+from sqlitestore import SqliteStore
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS datasets (
+         id INTEGER PRIMARY KEY,
+         branch TEXT NOT NULL,
+         builder TEXT NOT NULL,
+         buildnumber INTEGER NOT NULL,
+         revision TEXT,
+         recorded_at REAL NOT NULL
+       )""",
+    "CREATE INDEX IF NOT EXISTS datasets_branch ON datasets (branch, id)",
+    """CREATE TABLE IF NOT EXISTS file_lines (
+         dataset INTEGER NOT NULL,
+         filename TEXT NOT NULL,
+         statements TEXT NOT NULL,
+         covered TEXT NOT NULL
+       )""",
+    "CREATE INDEX IF NOT EXISTS file_lines_dataset"
+    " ON file_lines (dataset, filename)",
+    ]
+
+def encode_lines(lines):
+    # 1,2,3,5,7,8 -> "1-3,5,7-8"
+    ranges = []
+    for line in sorted(lines):
+        if ranges and ranges[-1][1] == line - 1:
+            ranges[-1][1] = line
+        else:
+            ranges.append([line, line])
+    return ",".join([start == end and "%d" % start or "%d-%d" % (start, end)
+                     for (start, end) in ranges])
+
+def decode_lines(text):
+    lines = set()
+    for part in text.split(","):
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            lines.update(range(int(start), int(end) + 1))
+        else:
+            lines.add(int(part))
+    return lines
+
+def coverage_delta(old, new):
+    """
+    Compare two datasets, each {filename: (statements, covered)} with sets
+    of line numbers. Return (totals, files): 'totals' has count-files,
+    source-lines, covered-lines, uncovered-lines, lines-added,
+    lines-removed and coverage-percentage, 'files' is [(filename, gained, lost, covered,
+    statements)] for every file whose coverage changed, most lost first.
+    A file we have no baseline for counts as all gained.
+    """
+    files = []
+    added = removed = source = covered_total = 0
+    for filename, (statements, covered) in new.items():
+        source += len(statements)
+        covered_total += len(covered)
+        old_covered = old.get(filename, (set(), set()))[1]
+        gained = len(covered - old_covered)
+        lost = len(old_covered - covered)
+        added += gained
+        removed += lost
+        if gained or lost:
+            files.append((filename, gained, lost, len(covered), len(statements)))
+    for filename, (statements, covered) in old.items():
+        if filename not in new and covered:
+            removed += len(covered)
+            files.append((filename, 0, len(covered), 0, 0))
+    files.sort(key=lambda f: (-f[2], -f[1], f[0]))
+    totals = {"count-files": len(new),
+              "source-lines": source,
+              "covered-lines": covered_total,
+              "uncovered-lines": source - covered_total,
+              "lines-added": added,
+              "lines-removed": removed,
+              "coverage-percentage": source and round(100.0 * covered_total / source, 2) or 0.0,
+              }
+    return totals, files
+
+class CoverageHistory(SqliteStore):
+    schema = SCHEMA
+
+    def __init__(self, filename="coverage-history.sqlite", keep=10,
+                 default_branch="master", max_age=30*24*3600):
+        SqliteStore.__init__(self, filename)
+        self.keep = keep
+        self.default_branch = default_branch
+        self.max_age = max_age
+
+    def latest(self, branch):
+        """
+        Return (buildnumber, revision, {filename: (statements, covered)})
+        for the newest dataset of 'branch', or None if we have none.
+        """
+        db = self._connect()
+        row = db.execute("SELECT id, buildnumber, revision FROM datasets"
+                         " WHERE branch=? ORDER BY id DESC LIMIT 1",
+                         (branch,)).fetchone()
+        if row is None:
+            return None
+        dataset, buildnumber, revision = row
+        files = {}
+        for (filename, statements, covered) in db.execute(
+            "SELECT filename, statements, covered FROM file_lines"
+            " WHERE dataset=?", (dataset,)):
+            files[filename] = (decode_lines(statements), decode_lines(covered))
+        return buildnumber, revision, files
+
+    def record(self, branch, builder, buildnumber, revision, files, now=None):
+        """
+        Store one build's dataset, {filename: (statements, covered)}, and
+        forget all but the newest 'keep' datasets of the default branch,
+        all but the newest one of 'branch' if it is another, and those of
+        other branches older than 'max_age'.
+        """
+        now = now or time.time()
+        db = self._connect()
+        c = db.execute("INSERT INTO datasets (branch, builder, buildnumber,"
+                       " revision, recorded_at) VALUES (?,?,?,?,?)",
+                       (branch, builder, buildnumber, revision, now))
+        dataset = c.lastrowid
+        db.executemany("INSERT INTO file_lines VALUES (?,?,?,?)",
+                       [(dataset, filename, encode_lines(statements),
+                         encode_lines(covered))
+                        for (filename, (statements, covered)) in files.items()])
+        keep = branch == self.default_branch and self.keep or 1
+        old = [row[0] for row in db.execute(
+            "SELECT id FROM datasets WHERE branch=? ORDER BY id DESC"
+            " LIMIT -1 OFFSET ?", (branch, keep))]
+        old.extend([row[0] for row in db.execute(
+            "SELECT id FROM datasets WHERE branch!=? AND recorded_at<?",
+            (self.default_branch, now - self.max_age))])
+        for dataset in old:
+            db.execute("DELETE FROM file_lines WHERE dataset=?", (dataset,))
+            db.execute("DELETE FROM datasets WHERE id=?", (dataset,))
+        db.commit()
@@ -0,0 +1,366 @@
+"""
+Keeping the buildmaster's state.sqlite small and quick
+
+Every master keeps its changes, buildsets, build requests and their
+properties in state.sqlite, and buildbot never deletes any of them
+(changeHorizon counts changes, it doesn't look at their age, and we never
+set it). Years of webhook traffic are all still there, in tables the
+schedulers and the build request distributor query all the time.
+
+A DBMaintenance is a status receiver (so master.cfg can add it like any
+other) that, every 'interval' seconds:
+
+ - makes sure the database is in WAL mode, so readers don't wait for
+   writers, and that the indexes in INDEXES exist (for the queries the
+   schedulers and the build request distributor make, and for the deletes
+   below)
+ - deletes completed buildsets older than 'horizon' days with their build
+   requests, claims, builds, properties and the source stamps (and
+   patches) nothing else uses any more, and then changes older than that
+   with their files, properties and scheduler classifications
+ - logs the row count of every table, the size of the file and how long
+   each query in HOT_QUERIES took
+
+The deletes run 'batch' rows at a time in a thread of their own, each
+batch in a short transaction of its own, 'pause' seconds apart, so neither
+the reactor nor buildbot's own database threads wait on them for long.
+Which tables and columns exist is looked up first, so the same code works
+on the schema of buildbot 0.8.5 (zfec) and 0.8.12 (tahoe, pycryptopp).
+
+Buildbot's own connections also get the PRAGMAS below when they are
+opened.
+
+In master.cfg:
+
+  from dbmaintenance import DBMaintenance
+  c['status'].append(DBMaintenance("state.sqlite", horizon=90))
+
+and, by hand, from the buildmaster's basedir:
+
+  python ../dbmaintenance.py state.sqlite report
+  python ../dbmaintenance.py state.sqlite prune 90
+"""
+
+import os, time, sqlite3
+from twisted.internet import defer, reactor, task, threads
+from twisted.python import log
+from buildbot.status.base import StatusReceiverMultiService
+
+# for every connection buildbot opens
+PRAGMAS = ["PRAGMA synchronous = NORMAL",
+           "PRAGMA temp_store = MEMORY",
+           "PRAGMA cache_size = -16000",
+           "PRAGMA busy_timeout = 10000",
+           ]
+
+# (name, table, columns); created only if the table has those columns
+INDEXES = [
+    ("maint_buildrequests_builder_complete", "buildrequests",
+     ["buildername", "complete"]),
+    ("maint_buildsets_complete_at", "buildsets", ["complete", "complete_at"]),
+    ("maint_buildsets_sourcestampsetid", "buildsets", ["sourcestampsetid"]),
+    ("maint_buildsets_sourcestampid", "buildsets", ["sourcestampid"]),
+    ("maint_sourcestamp_changes_changeid", "sourcestamp_changes",
+     ["changeid"]),
+    ("maint_sourcestamps_set", "sourcestamps", ["sourcestampsetid"]),
+    ]
+
+# (description, query, parameters), timed for the report; a query for a
+# table this schema doesn't have is left out
+HOT_QUERIES = [
+    ("unclaimed requests of a builder",
+     "SELECT br.id FROM buildrequests br"
+     " LEFT JOIN buildrequest_claims c ON br.id = c.brid"
+     " WHERE br.buildername = ? AND br.complete = 0 AND c.brid IS NULL",
+     ("",)),
+    ("incomplete buildsets",
+     "SELECT id FROM buildsets WHERE complete = 0", ()),
+    ("requests of a buildset",
+     "SELECT id FROM buildrequests WHERE buildsetid = ?", (0,)),
+    ("latest change", "SELECT MAX(changeid) FROM changes", ()),
+    ("recent changes on a branch",
+     "SELECT changeid FROM changes WHERE branch = ?"
+     " ORDER BY changeid DESC LIMIT 50", ("master",)),
+    ("scheduler classifications",
+     "SELECT changeid, important FROM scheduler_changes WHERE objectid = ?",
+     (0,)),
+    ]
+
+def placeholders(values):
+    return ",".join(["?"] * len(values))
+
+class StateDatabase:
+    """
+    Maintenance operations on one state.sqlite, through a connection of
+    its own. Each method is meant to run in a thread, and commits what it
+    did before it returns.
+    """
+    def __init__(self, filename, timeout=10.0):
+        self.filename = filename
+        self.db = sqlite3.connect(filename, timeout=timeout,
+                                  check_same_thread=False)
+        self._columns = {}
+
+    def close(self):
+        self.db.close()
+
+    def columns(self, table):
+        if table not in self._columns:
+            self._columns[table] = set([row[1] for row in self.db.execute(
+                "PRAGMA table_info(%s)" % table)])
+        return self._columns[table]
+
+    def tables(self):
+        return sorted([row[0] for row in self.db.execute(
+            "SELECT name FROM sqlite_master WHERE type='table'"
+            " AND name NOT LIKE 'sqlite_%'")])
+
+    def indexes(self, table):
+        # the leading columns of each index on 'table', for every length
+        indexed = []
+        for row in self.db.execute("PRAGMA index_list(%s)" % table).fetchall():
+            columns = [info[2] for info in self.db.execute(
+                "PRAGMA index_info(%s)" % row[1])]
+            indexed.extend([columns[:n] for n in range(1, len(columns) + 1)])
+        return indexed
+
+    def tables_with(self, column, exclude=()):
+        return [table for table in self.tables()
+                if column in self.columns(table) and table not in exclude]
+
+    def tune(self):
+        """
+        Switch to WAL and create the missing INDEXES. Returns the names of
+        the indexes that were created.
+        """
+        self.db.execute("PRAGMA journal_mode = WAL")
+        created = []
+        for (name, table, columns) in INDEXES:
+            if not set(columns) <= self.columns(table):
+                continue
+            if columns in self.indexes(table):
+                # ours, or one that buildbot has made since
+                continue
+            self.db.execute("CREATE INDEX %s ON %s (%s)"
+                            % (name, table, ", ".join(columns)))
+            self.db.commit()
+            created.append(name)
+        if created:
+            self.db.execute("ANALYZE")
+            self.db.commit()
+        return created
+
+    def _delete(self, table, column, values):
+        if not values or column not in self.columns(table):
+            return 0
+        return self.db.execute("DELETE FROM %s WHERE %s IN (%s)"
+                               % (table, column, placeholders(values)),
+                               values).rowcount
+
+    def _ids(self, query, values):
+        if not values:
+            return []
+        return [row[0] for row in self.db.execute(
+            query % placeholders(values), values)]
+
+    def prune_buildsets(self, cutoff, batch=500):
+        """
+        Delete up to 'batch' completed buildsets that completed before
+        'cutoff', and everything that belongs only to them. Returns the
+        number of buildsets deleted.
+        """
+        bs_columns = self.columns("buildsets")
+        if "complete_at" not in bs_columns:
+            return 0
+        if "sourcestampsetid" in bs_columns:
+            ss_column = "sourcestampsetid"
+        else:
+            ss_column = "sourcestampid"
+        rows = self.db.execute("SELECT id, %s FROM buildsets WHERE"
+                               " complete = 1 AND complete_at < ?"
+                               " ORDER BY id LIMIT ?" % ss_column,
+                               (cutoff, batch)).fetchall()
+        if not rows:
+            return 0
+        bsids = [row[0] for row in rows]
+        brids = self._ids("SELECT id FROM buildrequests"
+                          " WHERE buildsetid IN (%s)", bsids)
+        for table in self.tables_with("brid"):
+            self._delete(table, "brid", brids)
+        for table in self.tables_with("buildsetid"):
+            self._delete(table, "buildsetid", bsids)
+        self._delete("buildsets", "id", bsids)
+
+        # source stamps that no remaining buildset refers to
+        candidates = list(set([row[1] for row in rows
+                               if row[1] is not None]))
+        used = set(self._ids("SELECT %s FROM buildsets WHERE %s IN (%%s)"
+                             % (ss_column, ss_column), candidates))
+        orphans = [ssid for ssid in candidates if ssid not in used]
+        if ss_column == "sourcestampsetid":
+            sets = orphans
+            ssids = self._ids("SELECT id FROM sourcestamps"
+                              " WHERE sourcestampsetid IN (%s)", sets)
+        else:
+            sets = []
+            ssids = orphans
+        patchids = [p for p in self._ids("SELECT patchid FROM sourcestamps"
+                                         " WHERE id IN (%s)", ssids)
+                    if p is not None]
+        self._delete("sourcestamp_changes", "sourcestampid", ssids)
+        self._delete("sourcestamps", "id", ssids)
+        self._delete("patches", "id", patchids)
+        if "sourcestampsets" in self.tables():
+            self._delete("sourcestampsets", "id", sets)
+        self.db.commit()
+        return len(bsids)
+
+    def prune_changes(self, cutoff, batch=500):
+        """
+        Delete up to 'batch' changes from before 'cutoff', with their rows
+        in every other table that has a changeid. The newest change is
+        always kept, the schedulers start from it. Returns the number of
+        changes deleted.
+        """
+        changeids = [row[0] for row in self.db.execute(
+            "SELECT changeid FROM changes WHERE when_timestamp < ?"
+            " AND changeid < (SELECT MAX(changeid) FROM changes)"
+            " ORDER BY changeid LIMIT ?", (cutoff, batch))]
+        if not changeids:
+            return 0
+        for table in self.tables_with("changeid", exclude=("changes",)):
+            self._delete(table, "changeid", changeids)
+        self._delete("changes", "changeid", changeids)
+        self.db.commit()
+        return len(changeids)
+
+    def report(self):
+        """
+        Return (file size in bytes, free bytes, [(table, rows)],
+        [(query description, milliseconds)]).
+        """
+        page_size = self.db.execute("PRAGMA page_size").fetchone()[0]
+        pages = self.db.execute("PRAGMA page_count").fetchone()[0]
+        free = self.db.execute("PRAGMA freelist_count").fetchone()[0]
+        rows = [(table, self.db.execute("SELECT COUNT(*) FROM %s"
+                                        % table).fetchone()[0])
+                for table in self.tables()]
+        timings = []
+        for (description, query, params) in HOT_QUERIES:
+            start = time.time()
+            try:
+                self.db.execute(query, params).fetchall()
+            except sqlite3.OperationalError:
+                continue
+            timings.append((description, 1000 * (time.time() - start)))
+        return page_size * pages, page_size * free, rows, timings
+
+def report_text(report):
+    size, free, rows, timings = report
+    lines = ["%.1f MB, %.1f MB free" % (size / 1e6, free / 1e6)]
+    lines.extend(["%9d %s" % (count, table) for (table, count) in rows])
+    lines.extend(["%8.2fms %s" % (ms, description)
+                  for (description, ms) in timings])
+    return "\n".join(lines) + "\n"
+
+def tune_engine(engine, pragmas=PRAGMAS):
+    # buildbot opens a new connection for each query on sqlite, so the
+    # pragmas go in a listener
+    if engine.dialect.name != "sqlite" or getattr(engine, "_tuned", False):
+        return
+    from sqlalchemy import event
+    def connect(dbapi_connection, record):
+        for pragma in pragmas:
+            dbapi_connection.execute(pragma)
+    event.listen(engine.pool, "connect", connect)
+    engine._tuned = True
+
+class DBMaintenance(StatusReceiverMultiService):
+    compare_attrs = ["filename", "horizon", "interval", "batch", "pause"]
+
+    def __init__(self, filename="state.sqlite", horizon=90,
+                 interval=6*3600, batch=500, pause=1.0):
+        StatusReceiverMultiService.__init__(self)
+        self.filename = filename
+        self.horizon = horizon
+        self.interval = interval
+        self.batch = batch
+        self.pause = pause
+        self.running_maintenance = False
+        self._loop = None
+
+    def startService(self):
+        StatusReceiverMultiService.startService(self)
+        # buildbot 0.8.5 makes status targets children of the master
+        # itself, 0.8.12 of master.status
+        master = getattr(self.parent, "master", self.parent)
+        try:
+            tune_engine(master.db.pool.engine)
+        except Exception:
+            log.err(None, "unable to set the database pragmas")
+        self._loop = task.LoopingCall(self.maintain)
+        self._loop.start(self.interval, now=False)
+
+    def stopService(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        return StatusReceiverMultiService.stopService(self)
+
+    @defer.inlineCallbacks
+    def maintain(self):
+        if self.running_maintenance or not os.path.exists(self.filename):
+            return
+        self.running_maintenance = True
+        state = StateDatabase(self.filename)
+        try:
+            start = time.time()
+            created = yield threads.deferToThread(state.tune)
+            if created:
+                log.msg("%s: created indexes %s"
+                        % (self.filename, ", ".join(created)))
+            cutoff = time.time() - self.horizon * 24 * 3600
+            buildsets = changes = 0
+            for prune in (state.prune_buildsets, state.prune_changes):
+                while self.running:
+                    count = yield threads.deferToThread(prune, cutoff,
+                                                        self.batch)
+                    if prune == state.prune_buildsets:
+                        buildsets += count
+                    else:
+                        changes += count
+                    if count < self.batch:
+                        break
+                    yield task.deferLater(reactor, self.pause, lambda: None)
+            report = yield threads.deferToThread(state.report)
+            log.msg("%s: pruned %d buildsets and %d changes older than %d"
+                    " days in %.1fs\n%s"
+                    % (self.filename, buildsets, changes, self.horizon,
+                       time.time() - start, report_text(report).rstrip()))
+        except Exception:
+            log.err(None, "maintenance of %s failed" % self.filename)
+        finally:
+            state.close()
+            self.running_maintenance = False
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) < 3 or not os.path.exists(sys.argv[1]):
+        sys.stderr.write("usage: dbmaintenance.py DBFILE report\n"
+                         "       dbmaintenance.py DBFILE prune DAYS\n")
+        sys.exit(1)
+    state = StateDatabase(sys.argv[1])
+    if sys.argv[2] == "prune" and len(sys.argv) > 3:
+        cutoff = time.time() - float(sys.argv[3]) * 24 * 3600
+        for name in state.tune():
+            sys.stdout.write("created index %s\n" % name)
+        batch = 500
+        for prune in (state.prune_buildsets, state.prune_changes):
+            total = 0
+            while True:
+                count = prune(cutoff, batch)
+                total += count
+                if count < batch:
+                    break
+            sys.stdout.write("%s: %d\n" % (prune.__name__, total))
+    sys.stdout.write(report_text(state.report()))
+    state.close()
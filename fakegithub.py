@@ -0,0 +1,102 @@
+"""
+A local stand-in for GitHub's commit statuses API
+
+It answers POST /repos/OWNER/NAME/statuses/SHA the way GitHub does, with
+X-RateLimit-Limit/Remaining/Reset headers on every response and a 403
+once the 'limit' calls of the current 'window' seconds are used up, and
+fails a 'fail' fraction of the calls with a 502. It remembers the last
+state posted for each (sha, context), so a test can compare that with
+what it meant to send.
+
+  python fakegithub.py 8080 --limit 100 --window 60 --fail 0.1
+
+and point FilteredGitHubStatus(baseURL="http://localhost:8080/") at it.
+githubqueue.py's bench uses it in-process through listen().
+"""
+
+import re, json, time, random
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+status_path_re = re.compile(r"^/repos/([^/]+)/([^/]+)/statuses/([0-9a-f]+)$")
+
+class FakeGitHub(Resource):
+    isLeaf = True
+
+    def __init__(self, limit=5000, window=3600.0, fail=0.0):
+        Resource.__init__(self)
+        self.limit = limit
+        self.window = window
+        self.fail = fail
+        self.window_start = time.time()
+        self.used = 0
+        self.calls = self.accepted = self.failed = self.limited = 0
+        # (sha, context) -> state
+        self.statuses = {}
+
+    def render_POST(self, request):
+        self.calls += 1
+        now = time.time()
+        if now >= self.window_start + self.window:
+            self.window_start = now
+            self.used = 0
+        request.setHeader("content-type", "application/json")
+        request.setHeader("x-ratelimit-limit", "%d" % self.limit)
+        request.setHeader("x-ratelimit-reset",
+                          "%d" % (self.window_start + self.window + 1))
+        if self.used >= self.limit:
+            self.limited += 1
+            request.setHeader("x-ratelimit-remaining", "0")
+            request.setResponseCode(403)
+            return json.dumps({"message": "API rate limit exceeded"})
+        self.used += 1
+        request.setHeader("x-ratelimit-remaining",
+                          "%d" % (self.limit - self.used))
+        if not (request.getHeader("authorization") or "").startswith("token "):
+            request.setResponseCode(401)
+            return json.dumps({"message": "Requires authentication"})
+        mo = status_path_re.match(request.path)
+        if not mo:
+            request.setResponseCode(404)
+            return json.dumps({"message": "Not Found"})
+        if random.random() < self.fail:
+            self.failed += 1
+            request.setResponseCode(502)
+            return json.dumps({"message": "Server Error"})
+        try:
+            payload = json.loads(request.content.read())
+        except ValueError:
+            request.setResponseCode(400)
+            return json.dumps({"message": "Problems parsing JSON"})
+        if payload.get("state") not in ("pending", "success", "error",
+                                        "failure"):
+            request.setResponseCode(422)
+            return json.dumps({"message": "Validation Failed"})
+        context = payload.get("context", "default")
+        self.statuses[(mo.group(3), context)] = payload["state"]
+        self.accepted += 1
+        request.setResponseCode(201)
+        return json.dumps({"state": payload["state"], "context": context})
+
+def listen(port=0, **kwargs):
+    """
+    Start a FakeGitHub on 'port' (0 for any free one) of localhost.
+    Returns (the FakeGitHub, the listening port).
+    """
+    from twisted.internet import reactor
+    fake = FakeGitHub(**kwargs)
+    listening = reactor.listenTCP(port, Site(fake), interface="127.0.0.1")
+    return fake, listening
+
+if __name__ == "__main__":
+    import argparse
+    from twisted.internet import reactor
+    parser = argparse.ArgumentParser()
+    parser.add_argument("port", type=int)
+    parser.add_argument("--limit", type=int, default=5000)
+    parser.add_argument("--window", type=float, default=3600.0)
+    parser.add_argument("--fail", type=float, default=0.0)
+    options = parser.parse_args()
+    listen(options.port, limit=options.limit, window=options.window,
+           fail=options.fail)
+    reactor.run()
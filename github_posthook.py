@@ -19,18 +19,111 @@ That will create the necessary Resource, attach it to your webstatus in the
 right place, and glue it into a new ChangeSource.
 
 Then, on your Github repo, use the Admin page, under 'Service Hooks', and add
-this URL into the 'Post-Receive URLs' section.
+this URL into the 'Post-Receive URLs' section. Either content type
+(application/x-www-form-urlencoded or application/json) will do.
 
+Each commit used to become its own Change, so a 200-commit push meant 200
+database transactions and 200 scheduler wakeups, for what the schedulers'
+treeStableTimer then merges into a single build anyway. Now a push becomes
+at most max_changes Changes (by default just one, for the new branch head):
+the older commits are folded into the first of them, with their files and
+a one-line summary of each. Commits we have already seen on the same
+branch of the same repository (hook re-deliveries, or the same commits
+pushed again) are dropped, using a bounded record of recent ones.
+
+Run 'python github_posthook.py' to replay some large pushes against a
+stand-in buildmaster and compare against one Change per commit.
 """
 
 import json
+from collections import OrderedDict
 from twisted.internet import defer
+from twisted.python import log
 from twisted.web.resource import Resource
 
 from buildbot.changes.base import ChangeSource
 from iso9601 import parse_iso9601
 
+class SeenChanges:
+    """
+    Remember the most recent 'size' (repository, revision, branch) triples,
+    forgetting the oldest first.
+    """
+    def __init__(self, size=10000):
+        self.size = size
+        self.seen = OrderedDict()
+
+    def add(self, key):
+        # returns False if we already had it
+        if key in self.seen:
+            return False
+        self.seen[key] = None
+        while len(self.seen) > self.size:
+            self.seen.popitem(last=False)
+        return True
+
+    def forget(self, key):
+        self.seen.pop(key, None)
+
+def collapse_commits(commits, max_changes):
+    """
+    Return at most 'max_changes' commits (in the same oldest-first order),
+    with the files and messages of any older ones folded into the first. If
+    max_changes is None, return them all.
+    """
+    if max_changes is None or len(commits) <= max_changes:
+        return commits
+    older, kept = commits[:-max_changes], commits[-max_changes:]
+    first = dict(kept[0])
+    files = []
+    seen_files = set()
+    for c in older + [first]:
+        for f in c["modified"] + c["added"]:
+            if f not in seen_files:
+                seen_files.add(f)
+                files.append(f)
+    summary = ["%s %s" % (c["id"][:12], c["message"].split("\n")[0])
+               for c in older]
+    if len(summary) > 100:
+        summary = summary[:50] + ["..."] + summary[-49:]
+    first["modified"] = files
+    first["added"] = []
+    first["message"] = ("%s\n\nThis change also includes %d earlier commit%s"
+                        " from the same push:\n%s" %
+                        (first["message"], len(older),
+                         len(older) > 1 and "s" or "", "\n".join(summary)))
+    return [first] + kept[1:]
+
 class GithubHookChangeSource(ChangeSource):
+    def __init__(self, max_changes=1, seen_size=10000, project=""):
+        ChangeSource.__init__(self)
+        self.max_changes = max_changes
+        # what the Changes are tagged with, for a buildmaster that builds
+        # more than one project (see multimaster.py)
+        self.project = project
+        self.seen = SeenChanges(seen_size)
+
+    def addChangesFromHook(self, payload, commits, branch):
+        repository = payload["repository"]["url"]
+        new = []
+        keys = []
+        for c in commits:
+            key = (repository, c["id"], branch)
+            if self.seen.add(key):
+                new.append(c)
+                keys.append(key)
+        d = defer.succeed(None)
+        for c in collapse_commits(new, self.max_changes):
+            d.addCallback(self.addChangeFromHook, payload=payload, change=c,
+                          branch=branch)
+        def _forget(f):
+            # let a re-delivery of this push try again
+            for key in keys:
+                self.seen.forget(key)
+            return f
+        d.addErrback(_forget)
+        return d
+
     def addChangeFromHook(self, ign, payload, change, branch):
         p = payload
         c = change
@@ -42,6 +135,7 @@ class GithubHookChangeSource(ChangeSource):
                                   branch=branch,
                                   # guard this with a GoodRepo!
                                   repository=p["repository"]["url"],
+                                  project=self.project,
                                   revlink=c["url"])
         return d
 
@@ -59,12 +153,15 @@ class GithubHook(Resource):
         # https://github.com/github/github-services/blob/master/services/web.rb
         # for details), including .content_type="json", which will give you
         # application/json that could be parsed by json.load(request.content)
-        p = json.loads(request.args["payload"][0])
+        content_type = request.getHeader("content-type") or ""
+        if content_type.split(";")[0].strip() == "application/json":
+            p = json.load(request.content)
+        else:
+            p = json.loads(request.args["payload"][0])
         d = defer.succeed(None)
-        for c in p["commits"]:
+        if p["commits"]:
             branch = p["ref"].split("/",2)[2]
-            d.addCallback(self.cs.addChangeFromHook, payload=p, change=c,
-                          branch=branch)
+            d = self.cs.addChangesFromHook(p, p["commits"], branch)
         if not p["commits"] and p["ref"].startswith("refs/tags/"):
             # a tag was pushed. Pretend the new value was just committed.
             # Note that if you push a new branch tip and a tag at the same
@@ -83,9 +180,65 @@ class GithubHook(Resource):
                 branch = None
             d.addCallback(self.cs.addChangeFromHook, payload=p,
                           change=p["head_commit"], branch=branch)
+        d.addErrback(log.err, "unable to add changes from github hook")
         request.setHeader("content-type", "text/plain")
         return "Thanks!\n"
 
-def setup(c, ws, url_path="github_hook"):
-    c['change_source'] = cs = GithubHookChangeSource()
+def setup(c, ws, url_path="github_hook", max_changes=1, project=""):
+    c['change_source'] = cs = GithubHookChangeSource(max_changes=max_changes,
+                                                     project=project)
     ws.putChild(url_path, GithubHook(cs))
+
+def replay(pushes, max_changes, repeats=2, transaction_time=0.002):
+    # replay each push 'repeats' times (the extra times standing in for
+    # hook re-deliveries) against a buildmaster whose addChange just takes
+    # 'transaction_time' seconds, and count what it was asked to do
+    import time
+    from StringIO import StringIO
+    from twisted.web.test.requesthelper import DummyRequest
+
+    class StandInMaster:
+        changes = 0
+        def addChange(self, **kwargs):
+            time.sleep(transaction_time)
+            self.changes += 1
+            return defer.succeed(None)
+
+    cs = GithubHookChangeSource(max_changes=max_changes)
+    cs.master = StandInMaster()
+    hook = GithubHook(cs)
+    start = time.time()
+    for i in range(repeats):
+        for push in pushes:
+            request = DummyRequest([""])
+            request.method = "POST"
+            request.requestHeaders.setRawHeaders("content-type",
+                                                 ["application/json"])
+            request.content = StringIO(json.dumps(push))
+            hook.render_POST(request)
+    return cs.master.changes, time.time() - start
+
+def make_push(branch, commits, first=0):
+    return {"ref": "refs/heads/" + branch,
+            "repository": {"url": "https://github.com/tahoe-lafs/tahoe-lafs"},
+            "commits": [{"id": "%040x" % (first + i),
+                         "message": "commit %d\n\ndetails" % (first + i),
+                         "timestamp": "2016-02-02T18:55:34Z",
+                         "url": "https://github.com/tahoe-lafs/tahoe-lafs/commit/%040x" % (first + i),
+                         "author": {"email": "dev@example.org"},
+                         "modified": ["src/allmydata/f%d.py" % (i % 50)],
+                         "added": []}
+                        for i in range(commits)]}
+
+if __name__ == "__main__":
+    import sys
+    pushes = [make_push("master", 200),
+              # the same commits again, rebased onto another branch
+              make_push("feature", 200),
+              make_push("master", 500, first=1000)]
+    sys.stdout.write("%-22s %8s %8s\n" % ("", "changes", "seconds"))
+    for name, max_changes in [("one change per commit", None),
+                              ("max_changes=1", 1),
+                              ("max_changes=5", 5)]:
+        changes, seconds = replay(pushes, max_changes)
+        sys.stdout.write("%-22s %8d %8.2f\n" % (name, changes, seconds))
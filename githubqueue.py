@@ -0,0 +1,340 @@
+"""
+Commit statuses for GitHub, queued on the buildmaster
+
+FilteredGitHubStatus puts statuses into a StatusQueue, keyed by
+(repository, sha, context), instead of calling the statuses API from
+buildStarted/buildFinished. A newer status for the same key replaces
+one that hasn't been sent yet, so a "pending" that is still waiting when
+the build finishes is never sent at all. A GitHubStatusDelivery sends
+the queue one status at a time, at most one every 'interval' seconds:
+
+ - 2xx: done
+ - 403/429 with X-RateLimit-Remaining: 0 or a Retry-After header: the whole
+   queue waits until X-RateLimit-Reset (or Retry-After), and the status is
+   sent again then; so does a success that leaves fewer than 'reserve'
+   calls
+ - 5xx, 408 or no response within 'timeout' seconds: the status is tried
+   again after an exponential backoff, up to 'max_attempts' times
+ - anything else (a sha GitHub doesn't know, a bad token): logged and
+   dropped
+
+Whatever is still queued when the buildmaster stops is sent after it
+starts again.
+
+fakegithub.py is a local stand-in for the statuses API with a rate limit
+and random failures; 'python githubqueue.py bench' pushes a burst of
+statuses through it and checks that GitHub ends up with the last state of
+each one.
+"""
+
+import json, random
+from io import BytesIO
+from twisted.application import service
+from twisted.internet import defer, reactor
+from twisted.python import log
+from twisted.web.client import Agent, FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
+from sqlitestore import SqliteStore
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS statuses (
+         id INTEGER PRIMARY KEY AUTOINCREMENT,
+         repo_owner TEXT NOT NULL,
+         repo_name TEXT NOT NULL,
+         sha TEXT NOT NULL,
+         context TEXT NOT NULL,
+         state TEXT NOT NULL,
+         target_url TEXT,
+         description TEXT,
+         attempts INTEGER NOT NULL,
+         not_before REAL NOT NULL
+       )""",
+    "CREATE UNIQUE INDEX IF NOT EXISTS statuses_key"
+    " ON statuses (repo_owner, repo_name, sha, context)",
+    ]
+
+COLUMNS = ("id", "repo_owner", "repo_name", "sha", "context", "state",
+           "target_url", "description", "attempts")
+
+class StatusQueue(SqliteStore):
+    schema = SCHEMA
+
+    def __init__(self, filename="github-status.sqlite"):
+        SqliteStore.__init__(self, filename)
+
+    def put(self, status, now):
+        """
+        Queue 'status' (the dict GitHubStatus builds) in place of any
+        unsent one for the same sha and context. Returns True if it
+        replaced one.
+        """
+        db = self._connect()
+        key = (status["repoOwner"], status["repoName"], status["sha"],
+               status["context"])
+        c = db.execute("DELETE FROM statuses WHERE repo_owner=? AND"
+                       " repo_name=? AND sha=? AND context=?", key)
+        db.execute("INSERT INTO statuses (repo_owner, repo_name, sha,"
+                   " context, state, target_url, description, attempts,"
+                   " not_before) VALUES (?,?,?,?,?,?,?,0,?)",
+                   key + (status["state"], status.get("targetURL"),
+                          status.get("description"), now))
+        db.commit()
+        return c.rowcount > 0
+
+    def next(self, now):
+        """
+        Return the oldest status that is due as a dict with the COLUMNS
+        as keys, or None.
+        """
+        row = self._connect().execute(
+            "SELECT %s FROM statuses WHERE not_before <= ?"
+            " ORDER BY id LIMIT 1" % ", ".join(COLUMNS), (now,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(COLUMNS, row))
+
+    def next_time(self):
+        # when the next status is due, or None if the queue is empty
+        return self._connect().execute(
+            "SELECT MIN(not_before) FROM statuses").fetchone()[0]
+
+    def pending(self):
+        return self._connect().execute(
+            "SELECT COUNT(*) FROM statuses").fetchone()[0]
+
+    def remove(self, id):
+        # a no-op if a newer status has replaced this one meanwhile
+        db = self._connect()
+        db.execute("DELETE FROM statuses WHERE id=?", (id,))
+        db.commit()
+
+    def retry(self, id, not_before):
+        db = self._connect()
+        db.execute("UPDATE statuses SET attempts=attempts+1, not_before=?"
+                   " WHERE id=?", (not_before, id))
+        db.commit()
+
+def header(headers, name, default=None):
+    values = headers.getRawHeaders(name)
+    if not values:
+        return default
+    return values[0]
+
+class GitHubStatusDelivery(service.Service):
+    def __init__(self, queue, token, baseURL=None, interval=1.0,
+                 max_attempts=8, backoff=30.0, max_backoff=3600.0,
+                 reserve=50, timeout=60.0, clock=None):
+        self.queue = queue
+        self.token = token
+        self.baseURL = (baseURL or "https://api.github.com/").rstrip("/")
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.reserve = reserve
+        self.timeout = timeout
+        self.clock = clock or reactor
+        self.paused_until = 0.0
+        self.last_sent = 0.0
+        self.sent = self.coalesced = self.retried = self.dropped = 0
+        self.rate_limited = 0
+        self._timer = None
+        self._busy = False
+
+    def startService(self):
+        service.Service.startService(self)
+        self.wake()
+
+    def stopService(self):
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        return service.Service.stopService(self)
+
+    def enqueue(self, status):
+        if self.queue.put(status, self.clock.seconds()):
+            self.coalesced += 1
+        self.wake()
+
+    def wake(self):
+        # make sure _deliver runs when the next status is due
+        if not self.running or self._busy:
+            return
+        due = self.queue.next_time()
+        if due is None:
+            return
+        now = self.clock.seconds()
+        when = max(due, self.paused_until, self.last_sent + self.interval)
+        if self._timer is not None and self._timer.active():
+            if self._timer.getTime() <= when:
+                return
+            self._timer.cancel()
+        self._timer = self.clock.callLater(max(0, when - now), self._deliver)
+
+    @defer.inlineCallbacks
+    def _deliver(self):
+        self._timer = None
+        self._busy = True
+        try:
+            status = self.queue.next(self.clock.seconds())
+            if status is not None:
+                yield self.send(status)
+        except Exception:
+            log.err(None, "while sending a GitHub status")
+        self._busy = False
+        self.wake()
+
+    def post(self, url, payload):
+        """
+        POST 'payload' as JSON to 'url'. Fires with (code, headers, body),
+        or fails with defer.TimeoutError if that takes more than 'timeout'
+        seconds.
+        """
+        headers = Headers({"Authorization": ["token %s" % self.token],
+                           "User-Agent": ["tahoe-lafs-buildbot"],
+                           "Content-Type": ["application/json"]})
+        body = FileBodyProducer(BytesIO(json.dumps(payload).encode("utf-8")))
+        d = Agent(self.clock).request("POST", url, headers, body)
+        def got_response(response):
+            d = readBody(response)
+            d.addCallback(lambda body: (response.code, response.headers,
+                                        body))
+            return d
+        d.addCallback(got_response)
+        # a connection that GitHub accepts and then never answers would
+        # otherwise keep _deliver busy, and every status queued, for good
+        d.addTimeout(self.timeout, self.clock)
+        return d
+
+    @defer.inlineCallbacks
+    def send(self, status):
+        url = "%s/repos/%s/%s/statuses/%s" % (
+            self.baseURL, status["repo_owner"], status["repo_name"],
+            status["sha"])
+        payload = {"state": status["state"], "context": status["context"]}
+        for (key, name) in [("target_url", "target_url"),
+                            ("description", "description")]:
+            if status[key] is not None:
+                payload[name] = status[key]
+        what = ('status "%(state)s" for %(context)s on'
+                ' %(repo_owner)s/%(repo_name)s at %(sha)s' % status)
+        self.last_sent = self.clock.seconds()
+        try:
+            code, headers, body = yield self.post(url.encode("utf-8"),
+                                                  payload)
+        except defer.TimeoutError:
+            self.try_again(status, what,
+                           "no response in %ds" % self.timeout)
+            return
+        except Exception as e:
+            self.try_again(status, what, "%s" % (e,))
+            return
+        now = self.clock.seconds()
+        remaining = header(headers, "x-ratelimit-remaining")
+        reset = header(headers, "x-ratelimit-reset")
+        retry_after = header(headers, "retry-after")
+        if remaining is not None and reset is not None \
+                and int(remaining) < self.reserve:
+            self.paused_until = max(self.paused_until, float(reset))
+        if 200 <= code < 300:
+            self.queue.remove(status["id"])
+            self.sent += 1
+            log.msg("Sent %s." % what)
+        elif code in (403, 429) and (retry_after is not None or
+                                     remaining == "0"):
+            if retry_after is not None:
+                resume = now + float(retry_after)
+            elif reset is not None:
+                resume = float(reset)
+            else:
+                resume = now + self.backoff
+            self.paused_until = max(self.paused_until, resume)
+            self.rate_limited += 1
+            log.msg("GitHub rate limit reached, waiting %ds to send %s"
+                    % (max(0, self.paused_until - now), what))
+        elif code >= 500 or code == 408:
+            self.try_again(status, what, "HTTP %d" % code)
+        else:
+            self.queue.remove(status["id"])
+            self.dropped += 1
+            log.msg("Failed to send %s: HTTP %d %s" % (what, code, body))
+
+    def try_again(self, status, what, why):
+        if status["attempts"] + 1 >= self.max_attempts:
+            self.queue.remove(status["id"])
+            self.dropped += 1
+            log.msg("Giving up on %s after %d attempts: %s"
+                    % (what, status["attempts"] + 1, why))
+            return
+        delay = min(self.max_backoff,
+                    self.backoff * 2 ** status["attempts"])
+        # spread the retries of a burst out a little
+        delay *= random.uniform(0.5, 1.0)
+        self.queue.retry(status["id"], self.clock.seconds() + delay)
+        self.retried += 1
+        log.msg("Failed to send %s (%s), trying again in %ds"
+                % (what, why, delay))
+
+@defer.inlineCallbacks
+def bench(shas=40, contexts=12, limit=200, window=2.0, fail=0.05):
+    import os, sys, time, tempfile
+    from twisted.internet import task
+    import fakegithub
+    fake, port = fakegithub.listen(0, limit=limit, window=window, fail=fail)
+    baseURL = "http://127.0.0.1:%d/" % port.getHost().port
+    filename = os.path.join(tempfile.mkdtemp(), "github-status.sqlite")
+    def delivery():
+        return GitHubStatusDelivery(StatusQueue(filename), "token",
+                                    baseURL=baseURL, interval=0.0,
+                                    backoff=0.2, reserve=0)
+    first = delivery()
+    first.startService()
+    # every build starts, then some finish while others are still queued
+    expected = {}
+    start = time.time()
+    events = 0
+    for state in ("pending", "success"):
+        for i in range(shas):
+            for j in range(contexts):
+                final = state
+                if state == "success" and (i * contexts + j) % 7 == 0:
+                    final = "failure"
+                status = {"repoOwner": "tahoe-lafs", "repoName": "tahoe-lafs",
+                          "sha": "%040x" % i, "context": "buildbot/b%d" % j,
+                          "state": final, "targetURL": "http://x/",
+                          "description": "Build done."}
+                first.enqueue(status)
+                events += 1
+                expected[("%040x" % i, "buildbot/b%d" % j)] = final
+        if state == "pending":
+            yield task.deferLater(reactor, 0.5, lambda: None)
+    # restart halfway through
+    yield first.stopService()
+    second = delivery()
+    second.startService()
+    while second.queue.pending() or second._busy:
+        yield task.deferLater(reactor, 0.05, lambda: None)
+    elapsed = time.time() - start
+    yield second.stopService()
+    port.stopListening()
+
+    correct = sum([fake.statuses.get(key) == state
+                   for (key, state) in expected.items()])
+    sys.stdout.write(
+        "%d status events, %d API calls (%d accepted, %d failed,"
+        " %d rate limited), %d coalesced\n"
+        "%d of %d statuses correct on the fake GitHub\n"
+        "%.1fs, %.1f statuses/s\n"
+        % (events, fake.calls, fake.accepted, fake.failed, fake.limited,
+           first.coalesced + second.coalesced, correct, len(expected),
+           elapsed, len(expected) / elapsed))
+
+if __name__ == "__main__":
+    import sys
+    if sys.argv[1:2] != ["bench"]:
+        sys.stderr.write("usage: githubqueue.py bench\n")
+        sys.exit(1)
+    d = bench()
+    d.addErrback(log.err)
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
@@ -0,0 +1,280 @@
+"""
+A throwaway Tahoe grid on one buildslave, for the speed tests
+
+The speed builders used to run 'make check-speed' against a client node
+that was permanently connected to the perfnet grid. That hardware is gone,
+so this script builds the grid on the buildslave itself: an introducer, a
+few storage nodes and a client, all listening on 127.0.0.1. Optionally the
+client's connections to the storage nodes go through a small proxy that adds
+latency and limits bandwidth, to look roughly like the links the old
+builders were named after.
+
+It runs on the buildslave, not the buildmaster: the factory in master.cfg
+sends it over with a FileDownload step and then runs
+
+  python localgrid.py create _local_grid --storage 5 --profile DSL
+  python localgrid.py run _local_grid -- make check-speed TESTCLIENTDIR=_local_grid/client
+  python localgrid.py stop _local_grid
+
+'run' starts the introducer, the storage nodes and the proxies, runs the
+command (which starts and stops the client itself), and stops everything
+again however the command went. 'stop' is for cleaning up after a build
+that was interrupted.
+"""
+
+import os, sys, time, json, shutil, socket, select, threading, subprocess
+import argparse
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+# one-way latency is rtt/2. Bandwidth is in bytes per second, None for
+# unlimited; "up" is client to storage.
+PROFILES = {"local": None,
+            "colo": {"rtt": 0.002, "up": None, "down": None},
+            "fiber": {"rtt": 0.015, "up": 2.5e6, "down": 6e6},
+            "DSL": {"rtt": 0.045, "up": 96e3, "down": 750e3},
+            }
+
+def free_port():
+    s = socket.socket()
+    try:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+def tahoe(options, *args):
+    command = options.tahoe.split() + list(args)
+    sys.stdout.write("+ %s\n" % " ".join(command))
+    sys.stdout.flush()
+    return subprocess.call(command)
+
+def wait_for(filename, timeout=60):
+    deadline = time.time() + timeout
+    while not os.path.exists(filename):
+        if time.time() > deadline:
+            raise RuntimeError("timed out waiting for %s" % filename)
+        time.sleep(0.5)
+    with open(filename) as f:
+        return f.read().strip()
+
+def load_grid(basedir):
+    with open(os.path.join(basedir, "grid.json")) as f:
+        return json.load(f)
+
+def create(options):
+    basedir = options.basedir
+    if options.profile not in PROFILES:
+        raise SystemExit("unknown profile %r, use one of %s"
+                         % (options.profile, ", ".join(sorted(PROFILES))))
+    if os.path.exists(basedir):
+        shutil.rmtree(basedir)
+    os.makedirs(basedir)
+    grid = {"profile": options.profile, "tahoe": options.tahoe,
+            "storage": []}
+
+    port = free_port()
+    introducer = os.path.join(basedir, "introducer")
+    if tahoe(options, "create-introducer",
+             "--port=tcp:%d:interface=127.0.0.1" % port,
+             "--location=tcp:127.0.0.1:%d" % port, introducer):
+        raise SystemExit("unable to create the introducer")
+    # the introducer only writes its furl once it has started
+    tahoe(options, "start", introducer)
+    try:
+        furl = wait_for(os.path.join(introducer, "private", "introducer.furl"))
+    finally:
+        tahoe(options, "stop", introducer)
+
+    shaped = PROFILES[options.profile] is not None
+    for i in range(options.storage):
+        nodedir = os.path.join(basedir, "storage%d" % i)
+        port = free_port()
+        # storage servers announce the proxy's port when we shape, so that
+        # the client's connections go through it
+        proxy_port = shaped and free_port() or port
+        if tahoe(options, "create-node", "--nickname=storage%d" % i,
+                 "--introducer=%s" % furl, "--webport=none",
+                 "--port=tcp:%d:interface=127.0.0.1" % port,
+                 "--location=tcp:127.0.0.1:%d" % proxy_port, nodedir):
+            raise SystemExit("unable to create storage node %d" % i)
+        grid["storage"].append({"nodedir": nodedir, "port": port,
+                                "proxy_port": proxy_port})
+
+    client = os.path.join(basedir, "client")
+    needed = max(1, min(3, options.storage))
+    if tahoe(options, "create-client", "--nickname=client",
+             "--introducer=%s" % furl,
+             "--webport=tcp:%d:interface=127.0.0.1" % free_port(),
+             "--shares-needed=%d" % needed,
+             "--shares-happy=%d" % options.storage,
+             "--shares-total=%d" % options.storage, client):
+        raise SystemExit("unable to create the client")
+    grid["client"] = client
+    grid["introducer"] = introducer
+    with open(os.path.join(basedir, "grid.json"), "w") as f:
+        json.dump(grid, f, indent=1)
+    sys.stdout.write("created a %s grid with %d storage nodes in %s\n"
+                     % (options.profile, options.storage, basedir))
+
+class Pump(threading.Thread):
+    """
+    Copy one direction of a proxied connection, holding each chunk back by
+    'delay' seconds and then sending it no faster than 'rate' bytes per
+    second.
+    """
+    def __init__(self, source, dest, delay, rate):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.source = source
+        self.dest = dest
+        self.delay = delay
+        self.rate = rate
+        self.chunks = Queue()
+        self.sender = threading.Thread(target=self.send)
+        self.sender.daemon = True
+
+    def run(self):
+        self.sender.start()
+        while True:
+            try:
+                data = self.source.recv(16384)
+            except socket.error:
+                data = b""
+            self.chunks.put((time.time() + self.delay, data))
+            if not data:
+                return
+
+    def send(self):
+        while True:
+            when, data = self.chunks.get()
+            wait = when - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            if not data:
+                try:
+                    self.dest.shutdown(socket.SHUT_WR)
+                except socket.error:
+                    pass
+                return
+            try:
+                self.dest.sendall(data)
+            except socket.error:
+                return
+            if self.rate:
+                time.sleep(len(data) / self.rate)
+
+class ShapingProxy(threading.Thread):
+    def __init__(self, listen_port, target_port, profile):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.target_port = target_port
+        self.profile = profile
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", listen_port))
+        self.listener.listen(16)
+        self.running = True
+
+    def run(self):
+        delay = self.profile["rtt"] / 2.0
+        while self.running:
+            ready = select.select([self.listener], [], [], 0.5)[0]
+            if not ready:
+                continue
+            client, addr = self.listener.accept()
+            try:
+                server = socket.create_connection(("127.0.0.1", self.target_port))
+            except socket.error:
+                client.close()
+                continue
+            for s in (client, server):
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            Pump(client, server, delay, self.profile["up"]).start()
+            Pump(server, client, delay, self.profile["down"]).start()
+
+    def stop(self):
+        self.running = False
+        self.join(5)
+        self.listener.close()
+
+def node_dirs(basedir):
+    for name in sorted(os.listdir(basedir)):
+        nodedir = os.path.join(basedir, name)
+        if os.path.exists(os.path.join(nodedir, "tahoe.cfg")):
+            yield nodedir
+
+def run(options):
+    grid = load_grid(options.basedir)
+    options.tahoe = options.tahoe or grid["tahoe"]
+    profile = PROFILES[grid["profile"]]
+    proxies = []
+    rc = 1
+    try:
+        if tahoe(options, "start", grid["introducer"]):
+            raise SystemExit("unable to start the introducer")
+        for storage in grid["storage"]:
+            if tahoe(options, "start", storage["nodedir"]):
+                raise SystemExit("unable to start %s" % storage["nodedir"])
+            if profile is not None:
+                proxy = ShapingProxy(storage["proxy_port"], storage["port"],
+                                     profile)
+                proxy.start()
+                proxies.append(proxy)
+        # give the storage nodes a moment to announce themselves
+        time.sleep(options.settle)
+        sys.stdout.write("+ %s\n" % " ".join(options.command))
+        sys.stdout.flush()
+        rc = subprocess.call(options.command)
+    finally:
+        for proxy in proxies:
+            proxy.stop()
+        stop(options)
+    return rc
+
+def stop(options):
+    if not os.path.isdir(options.basedir):
+        return
+    if not options.tahoe:
+        options.tahoe = load_grid(options.basedir)["tahoe"]
+    for nodedir in node_dirs(options.basedir):
+        if os.path.exists(os.path.join(nodedir, "twistd.pid")):
+            tahoe(options, "stop", nodedir)
+
+def main(argv):
+    # everything after '--' is the command for 'run'
+    command = []
+    if "--" in argv:
+        command = argv[argv.index("--")+1:]
+        argv = argv[:argv.index("--")]
+    parser = argparse.ArgumentParser(description="a local Tahoe grid")
+    parser.add_argument("--tahoe", default=None,
+                        help="how to run tahoe (default: 'tahoe', or what"
+                        " the grid was created with)")
+    subparsers = parser.add_subparsers(dest="action")
+    p = subparsers.add_parser("create")
+    p.add_argument("basedir")
+    p.add_argument("--storage", type=int, default=5)
+    p.add_argument("--profile", default="local")
+    p = subparsers.add_parser("run")
+    p.add_argument("basedir")
+    p.add_argument("--settle", type=float, default=5.0)
+    p = subparsers.add_parser("stop")
+    p.add_argument("basedir")
+    options = parser.parse_args(argv)
+    if options.action == "create":
+        options.tahoe = options.tahoe or "tahoe"
+        create(options)
+    elif options.action == "run":
+        if not command:
+            parser.error("run needs a command, after '--'")
+        options.command = command
+        return run(options)
+    elif options.action == "stop":
+        stop(options)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
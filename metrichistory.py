@@ -0,0 +1,182 @@
+"""
+Build-to-build history of measured values
+
+A MetricHistory stores the values CheckSpeed and CheckMemory measure on
+each build (upload rate, per-file overhead, memory per byte uploaded) as
+named series ("speed-DSL", "memory-64") per builder.
+
+check_regression() decides whether a new value is significantly worse than
+a rolling baseline of earlier ones, linear_fit() does the A*x+B fits,
+sparkline() draws a short trend for the step text, and
+MetricHistoryResource serves the stored series as JSON from the WebStatus:
+
+  ws.putChild("metrics.json", MetricHistoryResource(metric_history))
+
+  GET metrics.json?series=speed-DSL&builder=speed-DSL&count=50
+"""
+
+import time, json
+from twisted.web.resource import Resource
+from sqlitestore import SqliteStore, median
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS metrics (
+         series TEXT NOT NULL,
+         builder TEXT NOT NULL,
+         buildnumber INTEGER NOT NULL,
+         revision TEXT,
+         name TEXT NOT NULL,
+         value REAL NOT NULL,
+         recorded_at REAL NOT NULL
+       )""",
+    "CREATE INDEX IF NOT EXISTS metrics_series"
+    " ON metrics (series, builder, name, buildnumber)",
+    ]
+
+def check_regression(baseline, value, bigger_is_better, threshold=10.0,
+                     min_samples=5, sigmas=3.0):
+    """
+    Compare 'value' against 'baseline' (the same measurement from earlier
+    builds). If it is worse than the baseline median by more than
+    'threshold' percent, and also by more than 'sigmas' times the
+    baseline's robust standard deviation (1.4826 * the median absolute
+    deviation, so that one odd build in the baseline doesn't mask or fake
+    a change), return how much worse it is as a percentage. Otherwise, or
+    if there are fewer than 'min_samples' earlier values, return None.
+    """
+    if len(baseline) < min_samples:
+        return None
+    center = median(baseline)
+    if not center:
+        return None
+    spread = 1.4826 * median([abs(v - center) for v in baseline])
+    if bigger_is_better:
+        worse = center - value
+    else:
+        worse = value - center
+    percent = 100.0 * worse / abs(center)
+    if percent <= threshold or worse <= sigmas * spread:
+        return None
+    return percent
+
+def linear_fit(points):
+    """
+    Least-squares fit of y = A*x + B to a list of (x, y) pairs. Return
+    (A, B), or None if there are fewer than two distinct x values.
+    """
+    n = len(points)
+    if len(set([x for (x, y) in points])) < 2:
+        return None
+    mean_x = sum([x for (x, y) in points]) / float(n)
+    mean_y = sum([y for (x, y) in points]) / float(n)
+    sxx = sum([(x - mean_x) ** 2 for (x, y) in points])
+    sxy = sum([(x - mean_x) * (y - mean_y) for (x, y) in points])
+    slope = sxy / sxx
+    return (slope, mean_y - slope * mean_x)
+
+SPARKS = u"\u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588"
+
+def sparkline(values):
+    if not values:
+        return u""
+    low, high = min(values), max(values)
+    if high == low:
+        return SPARKS[len(SPARKS) // 2] * len(values)
+    scale = (len(SPARKS) - 1) / float(high - low)
+    return u"".join([SPARKS[int(round((v - low) * scale))] for v in values])
+
+class MetricHistory(SqliteStore):
+    schema = SCHEMA
+
+    def __init__(self, filename="metric-history.sqlite"):
+        SqliteStore.__init__(self, filename)
+
+    def record(self, series, builder, buildnumber, revision, values):
+        """
+        Store one build's measurements, 'values' being a dict of name to
+        number. A rebuild of the same build number replaces what we had.
+        """
+        now = time.time()
+        db = self._connect()
+        db.execute("DELETE FROM metrics WHERE series=? AND builder=?"
+                   " AND buildnumber=?", (series, builder, buildnumber))
+        db.executemany("INSERT INTO metrics VALUES (?,?,?,?,?,?,?)",
+                       [(series, builder, buildnumber, revision, name,
+                         float(value), now)
+                        for (name, value) in values.items()])
+        db.commit()
+
+    def values(self, series, builder, name, count=20, before=None):
+        """
+        Return the last 'count' values of 'name' (from builds numbered
+        below 'before', if given), oldest first.
+        """
+        query = ("SELECT value FROM metrics"
+                 " WHERE series=? AND builder=? AND name=?")
+        args = [series, builder, name]
+        if before is not None:
+            query += " AND buildnumber < ?"
+            args.append(before)
+        query += " ORDER BY buildnumber DESC LIMIT ?"
+        args.append(count)
+        c = self._connect().execute(query, args)
+        return [row[0] for row in reversed(c.fetchall())]
+
+    def points(self, series, builder=None, name=None, count=100):
+        """
+        Return {builder: {name: [(buildnumber, revision, value,
+        recorded_at)]}} for the last 'count' builds of each, oldest first.
+        """
+        # the (builder, name) pairs come from the index; then the last
+        # 'count' builds of each, so that a request reads no more than it
+        # returns
+        query = "SELECT DISTINCT builder, name FROM metrics WHERE series=?"
+        args = [series]
+        if builder is not None:
+            query += " AND builder=?"
+            args.append(builder)
+        if name is not None:
+            query += " AND name=?"
+            args.append(name)
+        db = self._connect()
+        points = {}
+        for (row_builder, row_name) in db.execute(query, args).fetchall():
+            c = db.execute("SELECT buildnumber, revision, value, recorded_at"
+                           " FROM metrics"
+                           " WHERE series=? AND builder=? AND name=?"
+                           " ORDER BY buildnumber DESC LIMIT ?",
+                           (series, row_builder, row_name, count))
+            points.setdefault(row_builder, {})[row_name] = \
+                [tuple(row) for row in reversed(c.fetchall())]
+        return points
+
+class MetricHistoryResource(Resource):
+    isLeaf = True
+    max_count = 1000
+
+    def __init__(self, history):
+        Resource.__init__(self)
+        self.history = history
+
+    def render_GET(self, request):
+        def arg(name, default=None):
+            return request.args.get(name, [default])[0]
+        request.setHeader("content-type", "application/json")
+        series = arg("series")
+        if series is None:
+            request.setResponseCode(400)
+            return json.dumps({"error": "series= is required"})
+        try:
+            count = int(arg("count", 100))
+        except ValueError:
+            request.setResponseCode(400)
+            return json.dumps({"error": "count= must be an integer"})
+        if count < 1:
+            request.setResponseCode(400)
+            return json.dumps({"error": "count= must be positive"})
+        count = min(count, self.max_count)
+        return json.dumps({"series": series,
+                           "builders": self.history.points(series,
+                                                           arg("builder"),
+                                                           arg("name"),
+                                                           count)})
@@ -0,0 +1,294 @@
+"""
+One buildmaster for tahoe, zfec and pycryptopp
+
+Each project used to have a buildmaster of its own (tahoe/,
+zfec-bb0.8.5/, pycryptopp-git/), with its own process, state.sqlite, web
+server and slave port (9987, 12987, 10998), and many buildslave machines
+ran one buildslave for each of them. multi/master.cfg runs them all in
+one process instead:
+
+  from multimaster import Project, combine
+  c = BuildmasterConfig = combine(basedir, [
+      Project("tahoe", "../tahoe", prefix=""),
+      Project("zfec", "../zfec-bb0.8.5"),
+      ], slavePortnum=9987, db_url="sqlite:///state.sqlite")
+
+combine() loads each project's own master.cfg, unchanged (so each can
+still run on its own), and merges them:
+
+ - builders are renamed to '<prefix><name>' (by default 'zfec: ...', and
+   nothing for the first project) and tagged with the project's name.
+   Their status history stays in the project's old buildmaster directory
+   and their directories on the buildslaves stay where they were.
+ - schedulers are renamed to '<project>-<name>', follow their builders'
+   new names, and only see Changes of their own project. The GitHub hook
+   and PB change sources of each project tag their Changes with it.
+ - buildslaves of the same name are merged (their passwords must match),
+   so one buildslave on a machine can serve every project.
+ - each project's status targets are kept: its WebStatus stays on its own
+   port with its own public_html and templates and shows only its own
+   builders unless a ?tag= says otherwise. Targets that compare equal run
+   once, and so does the first DBMaintenance or BuildSummary of each file
+   (every project's DBMaintenance of the one state.sqlite).
+ - everything else (logHorizon, title, ...) comes from the first project,
+   and then from the keyword arguments.
+
+Before starting it, stop the old buildmasters (their builder directories
+are reused) and move tahoe's *.sqlite stores and status-summary.json into
+multi/. The buildslaves of zfec and pycryptopp have to be pointed at the
+one slave port.
+
+  python multimaster.py multi/master.cfg
+
+lists what the combined buildmaster would run, per project.
+"""
+
+import os
+from twisted.python import log
+from twisted.web import server
+from buildbot import config
+from buildbot.changes import filter
+from buildbot.changes.pb import PBChangeSource, ChangePerspective
+from buildbot.status.web.baseweb import WebStatus
+from buildbot.steps.trigger import Trigger
+from github_posthook import GithubHookChangeSource
+from dbmaintenance import DBMaintenance
+from statussummary import BuildSummary
+
+# where the combined buildmaster's own settings win over the first project's
+OWN_SETTINGS = ("slaves", "builders", "schedulers", "change_source",
+                "status", "slavePortnum", "protocols", "db_url", "db")
+
+class Project:
+    def __init__(self, name, directory, prefix=None):
+        # 'directory' is the project's own buildmaster directory, relative
+        # to the combined one
+        self.name = name
+        self.directory = directory
+        if prefix is None:
+            prefix = "%s: " % name
+        self.prefix = prefix
+        self.builders = {}
+        self.schedulers = {}
+
+    def load(self, basedir):
+        filename = os.path.abspath(os.path.join(basedir, self.directory,
+                                                "master.cfg"))
+        # what buildbot gives a master.cfg
+        namespace = {"basedir": os.path.dirname(filename),
+                     "__file__": filename}
+        f = open(filename)
+        try:
+            source = f.read()
+        finally:
+            f.close()
+        exec(compile(source, filename, "exec"), namespace)
+        return namespace["BuildmasterConfig"]
+
+class ProjectChangePerspective(ChangePerspective):
+    def __init__(self, master, prefix, project):
+        ChangePerspective.__init__(self, master, prefix)
+        self.project = project
+
+    def perspective_addChange(self, changedict):
+        if not changedict.get("project"):
+            changedict["project"] = self.project
+        return ChangePerspective.perspective_addChange(self, changedict)
+
+class ProjectPBChangeSource(PBChangeSource):
+    """
+    A PBChangeSource that tags the Changes it gets (unless 'buildbot
+    sendchange --project' already did) with 'project'.
+    """
+    compare_attrs = PBChangeSource.compare_attrs + ["project"]
+
+    def __init__(self, project, **kwargs):
+        PBChangeSource.__init__(self, **kwargs)
+        self.project = project
+
+    def getPerspective(self, mind, username):
+        assert username == self.user
+        return ProjectChangePerspective(self.master, self.prefix,
+                                        self.project)
+
+def project_filter(change_filter, project):
+    # 'change_filter', and the Change has to be from 'project'
+    scoped = filter.ChangeFilter(project=project)
+    if change_filter is not None:
+        scoped.filter_fn = change_filter.filter_fn
+        checks = dict(change_filter.checks)
+        if checks.get("project", (None, None, None)) == (None, None, None):
+            checks["project"] = scoped.checks["project"]
+        scoped.checks = checks
+    return scoped
+
+def tagged_request(tag):
+    class TaggedRequest(server.Request):
+        def process(self):
+            # a project's own web server shows its own builders, unless the
+            # URL asks for others
+            if "tag" not in self.args:
+                self.args["tag"] = [tag]
+            return server.Request.process(self)
+    return TaggedRequest
+
+def scope_webstatus(ws, project, basedir):
+    ws.public_html = os.path.join(project.directory, ws.public_html)
+    templates = os.path.abspath(os.path.join(basedir, project.directory,
+                                             "templates"))
+    if os.path.isdir(templates):
+        import jinja2
+        ws.jinja_loaders = ([jinja2.FileSystemLoader(templates)] +
+                            list(ws.jinja_loaders or []))
+    setupSite = ws.setupSite
+    def setupProjectSite():
+        setupSite()
+        ws.site.requestFactory = tagged_request(project.name)
+    ws.setupSite = setupProjectSite
+
+def as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+def add_builders(c, project, pc):
+    for b in pc.get("builders", []):
+        old = b.name
+        b.name = project.prefix + old
+        project.builders[old] = b.name
+        # slavebuilddir already defaults to the old builddir
+        b.builddir = os.path.join(project.directory, b.builddir)
+        if project.name not in (b.tags or []):
+            b.tags = list(b.tags or []) + [project.name]
+        c["builders"].append(b)
+
+def add_schedulers(c, project, pc):
+    for s in pc.get("schedulers", []):
+        old = s.name
+        if project.prefix:
+            s.name = "%s-%s" % (project.name, old)
+        project.schedulers[old] = s.name
+        s.builderNames = [project.builders.get(name, name)
+                          for name in s.builderNames]
+        if hasattr(s, "change_filter"):
+            s.change_filter = project_filter(s.change_filter, project.name)
+        c["schedulers"].append(s)
+    # Trigger steps name the schedulers they trigger
+    for b in pc.get("builders", []):
+        for step in getattr(b.factory, "steps", []):
+            if isinstance(step, tuple) or not issubclass(step.factory,
+                                                         Trigger):
+                continue
+            names = step.kwargs.get("schedulerNames")
+            if names:
+                step.kwargs["schedulerNames"] = [
+                    project.schedulers.get(name, name) for name in names]
+
+def add_change_sources(c, project, pc):
+    for cs in as_list(pc.get("change_source")):
+        if isinstance(cs, PBChangeSource):
+            for other in c["change_source"]:
+                if isinstance(other, PBChangeSource) \
+                        and other.user == cs.user and other.port == cs.port:
+                    config.error("the PBChangeSources of %s and %s both use"
+                                 " user %r, give one of them another"
+                                 % (other.project, project.name, cs.user))
+            cs = ProjectPBChangeSource(project.name, user=cs.user,
+                                       passwd=cs.passwd, port=cs.port,
+                                       prefix=cs.prefix)
+        elif isinstance(cs, GithubHookChangeSource):
+            cs.project = project.name
+        else:
+            log.msg("multimaster: Changes from %r aren't tagged with project"
+                    " %s, so %s's schedulers won't see them"
+                    % (cs, project.name, project.name))
+        c["change_source"].append(cs)
+
+def status_file(sr, basedir):
+    # the file a status target keeps its state in, for those that must not
+    # run twice on one file
+    if isinstance(sr, (DBMaintenance, BuildSummary)):
+        return (sr.__class__,
+                os.path.normpath(os.path.join(basedir, sr.filename)))
+    return None
+
+def add_status(c, project, pc, basedir):
+    for sr in pc.get("status", []):
+        key = status_file(sr, basedir)
+        if key is not None:
+            same = [old for old in c["status"]
+                    if status_file(old, basedir) == key]
+            if same:
+                if same[0] != sr:
+                    log.msg("multimaster: ignoring %s's %s of %s, another"
+                            " project's is already running"
+                            % (project.name, sr.__class__.__name__,
+                               sr.filename))
+                continue
+        elif sr in c["status"]:
+            continue
+        if isinstance(sr, WebStatus):
+            scope_webstatus(sr, project, basedir)
+        if isinstance(getattr(sr, "builders", None), list):
+            sr.builders = [project.builders.get(name, name)
+                           for name in sr.builders]
+        c["status"].append(sr)
+
+def combine(basedir, projects, **settings):
+    """
+    Load the master.cfg of every Project and return one BuildmasterConfig
+    that runs them all. 'settings' are BuildmasterConfig keys of the
+    combined buildmaster (slavePortnum, db_url, title, ...).
+    """
+    c = {"slaves": [], "builders": [], "schedulers": [],
+         "change_source": [], "status": []}
+    slaves = {}
+    for (i, project) in enumerate(projects):
+        pc = project.load(basedir)
+        for slave in pc.get("slaves", []):
+            known = slaves.get(slave.slavename)
+            if known is None:
+                slaves[slave.slavename] = (project, slave)
+                c["slaves"].append(slave)
+            elif known[1].password != slave.password:
+                config.error("buildslave %r has different passwords in %s"
+                             " and %s" % (slave.slavename, known[0].name,
+                                          project.name))
+        add_builders(c, project, pc)
+        add_schedulers(c, project, pc)
+        add_change_sources(c, project, pc)
+        add_status(c, project, pc, basedir)
+        for (key, value) in pc.items():
+            if key in OWN_SETTINGS or key in settings:
+                continue
+            if i == 0:
+                c[key] = value
+            elif c.get(key) != value:
+                log.msg("multimaster: ignoring %s's %s" % (project.name, key))
+    c.update(settings)
+    return c
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) != 2:
+        sys.stderr.write("usage: multimaster.py MASTER.CFG\n")
+        sys.exit(1)
+    filename = os.path.abspath(sys.argv[1])
+    os.chdir(os.path.dirname(filename))
+    namespace = {"basedir": os.getcwd(), "__file__": filename}
+    exec(compile(open(filename).read(), filename, "exec"), namespace)
+    c = namespace["BuildmasterConfig"]
+    for project in namespace.get("projects", []):
+        builders = [b for b in c["builders"] if project.name in b.tags]
+        slavenames = set()
+        for b in builders:
+            slavenames.update(b.slavenames)
+        sys.stdout.write("%s: %d builders, %d schedulers, %d buildslaves\n"
+                         % (project.name, len(builders),
+                            len(project.schedulers), len(slavenames)))
+    sys.stdout.write("%d builders, %d buildslaves, %d status targets,"
+                     " one slave port (%s)\n"
+                     % (len(c["builders"]), len(c["slaves"]),
+                        len(c["status"]), c.get("slavePortnum")))
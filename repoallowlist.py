@@ -0,0 +1,221 @@
+"""
+Repository allowlists for GoodRepo
+
+GoodRepo refuses to build from any repository that isn't on an allowlist.
+The allowlist in config.yaml is a set of hosts, each with the URL schemes
+and the users/organizations we will build from. Rather than expanding that
+into every scheme x host x user x '.git' permutation and searching the list,
+we normalize the URL being checked (scheme and host lowercased, 'git@host:'
+turned into ssh://, trailing slashes and '.git' dropped, user and project
+compared case-insensitively, like GitHub does) and look its pieces up in a
+few dicts and sets. Users can also be shell-style patterns like
+'tahoe-lafs-*'.
+
+ReloadingAllowlist re-reads config.yaml when it changes, so the list of
+users can be edited without reconfiguring the buildmaster.
+
+Run 'python repoallowlist.py' for a micro-benchmark of lookup cost against
+the number of allowed users.
+"""
+
+import os, re, time, fnmatch
+from urlparse import urlsplit
+
+# git@github.com:tahoe-lafs/tahoe-lafs.git
+scp_re = re.compile(r'^(?:([\w.-]+)@)?([\w.-]+):(?!//)(.*)$')
+
+def parse_repourl(url):
+    """
+    Return (scheme, host, user, project), all lowercase, for a repository
+    URL, or None if it doesn't look like one we could ever accept.
+    """
+    url = url.strip()
+    mo = scp_re.search(url)
+    if mo:
+        username, host, path = mo.groups()
+        scheme = "ssh"
+    else:
+        try:
+            parts = urlsplit(url)
+            host = parts.hostname
+            username = parts.username
+            port = parts.port
+        except ValueError:
+            return None
+        if (not host or parts.password is not None or port is not None or
+            parts.query or parts.fragment):
+            return None
+        scheme, path = parts.scheme, parts.path
+    if username is not None and (scheme, username) != ("ssh", "git"):
+        return None
+    path = path.strip("/")
+    if path.endswith(".git"):
+        path = path[:-len(".git")]
+    segments = path.split("/")
+    if len(segments) != 2 or "" in segments or ".." in segments:
+        return None
+    user, project = segments
+    return (scheme.lower(), host.lower(), user.lower(), project.lower())
+
+def is_pattern(user):
+    return "*" in user or "?" in user or "[" in user
+
+class RepoAllowlist:
+    def __init__(self, project, hosts, default_repourl=None):
+        # 'hosts' maps hostname to {"schemes": [..], "users": [..]}, as in
+        # config.yaml's allowed_hosts
+        self.project = project.lower()
+        self.default_repourl = default_repourl
+        self.hosts = {}
+        for hostname, hostconfig in hosts.items():
+            users = set()
+            patterns = []
+            for user in hostconfig["users"]:
+                if is_pattern(user):
+                    patterns.append((user.lower(),
+                                     re.compile(fnmatch.translate(user.lower()))))
+                else:
+                    users.add(user.lower())
+            self.hosts[hostname.lower()] = (
+                set([scheme.lower() for scheme in hostconfig["schemes"]]),
+                users, patterns)
+
+    @classmethod
+    def fromConfig(cls, config):
+        return cls(config["project"], config["allowed_hosts"],
+                   config.get("default_repourl"))
+
+    def allows(self, repourl):
+        parsed = parse_repourl(repourl)
+        if parsed is None:
+            return False
+        scheme, host, user, project = parsed
+        if project != self.project or host not in self.hosts:
+            return False
+        schemes, users, patterns = self.hosts[host]
+        if scheme not in schemes:
+            return False
+        if user in users:
+            return True
+        for (pattern, pattern_re) in patterns:
+            if pattern_re.match(user):
+                return True
+        return False
+
+    def describe(self):
+        hosts = []
+        for host in sorted(self.hosts):
+            schemes, users, patterns = self.hosts[host]
+            hosts.append("%s://%s/{%s}/%s" % (
+                "|".join(sorted(schemes)), host,
+                ",".join(sorted(users) + [p for (p, p_re) in patterns]),
+                self.project))
+        return " ".join(hosts)
+
+class ExactAllowlist:
+    """
+    An allowlist given as a list of full repository URLs. They are still
+    normalized, so 'https://github.com/x/y' also allows
+    'https://github.com/X/y.git/'.
+    """
+    def __init__(self, repos, default_repourl=None):
+        self.repos = repos
+        self.default_repourl = default_repourl
+        self.allowed = set()
+        for repourl in repos:
+            parsed = parse_repourl(repourl)
+            if parsed is not None:
+                self.allowed.add(parsed)
+
+    def allows(self, repourl):
+        parsed = parse_repourl(repourl)
+        return parsed is not None and parsed in self.allowed
+
+    def describe(self):
+        return ",".join(self.repos)
+
+def load_config(filename):
+    import yaml
+    with open(filename) as f:
+        return yaml.safe_load(f)
+
+class ReloadingAllowlist:
+    """
+    A RepoAllowlist built from a config.yaml file, and rebuilt whenever that
+    file's mtime changes. We look at the file at most once every 'interval'
+    seconds. If the new file can't be loaded, we keep using the old list.
+    """
+    def __init__(self, filename, interval=10, clock=time.time):
+        self.filename = filename
+        self.interval = interval
+        self.clock = clock
+        self.mtime = os.stat(filename).st_mtime
+        self.allowlist = RepoAllowlist.fromConfig(load_config(filename))
+        self.next_check = clock() + interval
+
+    def current(self):
+        now = self.clock()
+        if now < self.next_check:
+            return self.allowlist
+        self.next_check = now + self.interval
+        try:
+            mtime = os.stat(self.filename).st_mtime
+            if mtime != self.mtime:
+                self.allowlist = RepoAllowlist.fromConfig(load_config(self.filename))
+                self.mtime = mtime
+                log_msg("reloaded repository allowlist from %s: %s"
+                        % (self.filename, self.allowlist.describe()))
+        except Exception as e:
+            log_msg("unable to reload repository allowlist from %s: %r"
+                    % (self.filename, e))
+        return self.allowlist
+
+    @property
+    def default_repourl(self):
+        return self.current().default_repourl
+
+    def allows(self, repourl):
+        return self.current().allows(repourl)
+
+    def describe(self):
+        return self.current().describe()
+
+def log_msg(message):
+    from twisted.python import log
+    log.msg(message)
+
+def benchmark(user_counts=(10, 100, 1000, 10000), lookups=30000):
+    # compare against the old expanded list and 'repourl in repos'
+    import timeit
+    results = []
+    for count in user_counts:
+        users = ["tahoe-lafs"] + ["user%d" % i for i in range(count - 1)]
+        hosts = {"github.com": {"schemes": ["http", "https"], "users": users},
+                 "tahoe-lafs.org": {"schemes": ["http", "https"], "users": users}}
+        allowlist = RepoAllowlist("tahoe-lafs", hosts)
+        flat = []
+        for host in hosts:
+            for user in users:
+                for scheme in hosts[host]["schemes"]:
+                    path = "%s://%s/%s/tahoe-lafs" % (scheme, host, user)
+                    flat.extend([path, path + ".git"])
+        urls = ["https://github.com/user%d/tahoe-lafs" % (count // 2),
+                "https://github.com/tahoe-lafs/tahoe-lafs.git",
+                "https://github.com/mallory/tahoe-lafs"]
+        per_lookup = {}
+        # the flat list gets slow enough that fewer rounds will do
+        for name, check, rounds in [("compiled", allowlist.allows, lookups),
+                                    ("flat list", flat.__contains__,
+                                     max(300, lookups * 10 // count))]:
+            timer = timeit.Timer(lambda: [check(url) for url in urls])
+            number = rounds // len(urls)
+            per_lookup[name] = min(timer.repeat(3, number)) / (number * len(urls))
+        results.append((count, per_lookup["compiled"], per_lookup["flat list"]))
+    return results
+
+if __name__ == "__main__":
+    import sys
+    sys.stdout.write("%8s %14s %14s\n" % ("users", "compiled", "flat list"))
+    for (count, compiled, flat) in benchmark():
+        sys.stdout.write("%8d %12.2fus %12.2fus\n"
+                         % (count, compiled * 1e6, flat * 1e6))
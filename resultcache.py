@@ -0,0 +1,163 @@
+"""
+Results of trees we have built before
+
+A ResultCache stores the result of every successful full build keyed by
+(builder, git tree hash, factory fingerprint), with the properties and
+step texts that summarize it and how long it took. The tree hash comes
+from the checkout ('git rev-parse HEAD^{tree}'), so a PR head merged
+unchanged, a tag push or a forced rebuild of an identical tree finds the
+earlier build; factory_fingerprint() covers the builder's steps and their
+arguments, so changing master.cfg (a new tox env, another test suite)
+doesn't reuse results built another way.
+
+ReuseBuildResult, right after the checkout, ends a build with the cached
+result and copies the earlier build's summary logs, and RecordBuildResult,
+at the end, stores a new one. A build forced with the 'no_reuse' property
+always runs. Every reuse is recorded with the buildslave time it saved:
+
+  python ../resultcache.py result-cache.sqlite saved [DAYS]
+"""
+
+import json, time, hashlib
+from sqlitestore import SqliteStore
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS results (
+         builder TEXT NOT NULL,
+         tree TEXT NOT NULL,
+         fingerprint TEXT NOT NULL,
+         buildnumber INTEGER NOT NULL,
+         revision TEXT,
+         results INTEGER NOT NULL,
+         summary TEXT NOT NULL,
+         properties TEXT NOT NULL,
+         duration REAL NOT NULL,
+         recorded_at REAL NOT NULL,
+         PRIMARY KEY (builder, tree, fingerprint)
+       )""",
+    """CREATE TABLE IF NOT EXISTS reuses (
+         builder TEXT NOT NULL,
+         buildnumber INTEGER NOT NULL,
+         tree TEXT NOT NULL,
+         reused_buildnumber INTEGER NOT NULL,
+         saved REAL NOT NULL,
+         reused_at REAL NOT NULL
+       )""",
+    "CREATE INDEX IF NOT EXISTS reuses_at ON reuses (reused_at)",
+    ]
+
+def describe(value, depth=0):
+    # a stable, address-free description of a step argument
+    if isinstance(value, (bytes, type(u""), int, float, bool, type(None))):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [describe(v, depth + 1) for v in value]
+    if isinstance(value, dict):
+        return sorted([(describe(k, depth + 1), describe(v, depth + 1))
+                       for (k, v) in value.items()])
+    code = getattr(value, "__code__", None)
+    if code is not None:
+        # e.g. a doStepIf lambda
+        return ["function", hashlib.sha1(code.co_code).hexdigest(),
+                describe(list(code.co_consts[1:]), depth + 1)]
+    description = [value.__class__.__name__]
+    if depth < 3 and hasattr(value, "__dict__"):
+        description.append(describe(dict([(k, v) for (k, v)
+                                          in value.__dict__.items()
+                                          if not k.startswith("_")]),
+                                    depth + 1))
+    return description
+
+def factory_fingerprint(factory):
+    """
+    Hash the steps of a BuildFactory: their classes and the arguments they
+    were created with.
+    """
+    steps = []
+    for step in factory.steps:
+        # buildbot 0.8.12 wraps each step in a _BuildStepFactory, 0.8.5
+        # keeps (class, kwargs)
+        if isinstance(step, tuple):
+            steps.append([step[0].__name__, describe(step[1])])
+        else:
+            steps.append([step.factory.__name__, describe(step.args),
+                          describe(step.kwargs)])
+    text = json.dumps(steps, sort_keys=True, default=repr)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+class ResultCache(SqliteStore):
+    schema = SCHEMA
+
+    def __init__(self, filename="result-cache.sqlite", max_age=30*24*3600):
+        SqliteStore.__init__(self, filename)
+        self.max_age = max_age
+
+    def lookup(self, builder, tree, fingerprint, now=None):
+        """
+        Return the cached result for 'tree' as a dict (buildnumber,
+        revision, results, summary, properties, duration, recorded_at),
+        or None if there is none younger than max_age.
+        """
+        now = now or time.time()
+        row = self._connect().execute(
+            "SELECT buildnumber, revision, results, summary, properties,"
+            " duration, recorded_at FROM results WHERE builder=? AND tree=?"
+            " AND fingerprint=? AND recorded_at > ?",
+            (builder, tree, fingerprint, now - self.max_age)).fetchone()
+        if row is None:
+            return None
+        buildnumber, revision, results, summary, properties, duration, \
+            recorded_at = row
+        return {"buildnumber": buildnumber, "revision": revision,
+                "results": results, "summary": json.loads(summary),
+                "properties": json.loads(properties), "duration": duration,
+                "recorded_at": recorded_at}
+
+    def record(self, builder, tree, fingerprint, buildnumber, revision,
+               results, summary, properties, duration):
+        """
+        Store the result of a build: 'summary' is [(step name, [text])],
+        'properties' {name: value}, 'duration' in seconds.
+        """
+        now = time.time()
+        db = self._connect()
+        db.execute("INSERT OR REPLACE INTO results VALUES (?,?,?,?,?,?,?,?,?,?)",
+                   (builder, tree, fingerprint, buildnumber, revision,
+                    results, json.dumps(summary), json.dumps(properties),
+                    duration, now))
+        db.execute("DELETE FROM results WHERE recorded_at < ?",
+                   (now - self.max_age,))
+        db.commit()
+
+    def record_reuse(self, builder, buildnumber, tree, reused_buildnumber,
+                     saved):
+        db = self._connect()
+        db.execute("INSERT INTO reuses VALUES (?,?,?,?,?,?)",
+                   (builder, buildnumber, tree, reused_buildnumber, saved,
+                    time.time()))
+        db.commit()
+
+    def saved(self, days=30):
+        """
+        Return [(builder, reuses, seconds saved)] over the last 'days'
+        days, most saved first.
+        """
+        return self._connect().execute(
+            "SELECT builder, COUNT(*), SUM(saved) FROM reuses"
+            " WHERE reused_at > ? GROUP BY builder ORDER BY SUM(saved) DESC",
+            (time.time() - days * 24 * 3600,)).fetchall()
+
+if __name__ == "__main__":
+    import os, sys
+    if len(sys.argv) < 3 or sys.argv[2] != "saved" \
+            or not os.path.exists(sys.argv[1]):
+        sys.stderr.write("usage: resultcache.py DBFILE saved [DAYS]\n")
+        sys.exit(1)
+    days = float((sys.argv[3:] or [30])[0])
+    total = 0.0
+    for (builder, count, seconds) in ResultCache(sys.argv[1]).saved(days):
+        sys.stdout.write("%6.1fh %4d reuses: %s\n"
+                         % (seconds / 3600, count, builder))
+        total += seconds
+    sys.stdout.write("%6.1fh saved in the last %g days\n"
+                     % (total / 3600, days))
@@ -4,17 +4,24 @@
 from zope.interface import implements
 from buildbot.interfaces import IRenderable
 from twisted.python import log
+from repoallowlist import ExactAllowlist
 
 class GoodRepo:
     implements(IRenderable)
-    def __init__(self, repos, default_repourl):
+    def __init__(self, repos, default_repourl=None):
+        # 'repos' is either a list of allowed repository URLs or one of the
+        # allowlists from repoallowlist.py. If default_repourl is None, we
+        # use the allowlist's.
+        if isinstance(repos, (list, tuple)):
+            repos = ExactAllowlist(repos)
         self.repos = repos
         self.default_repourl = default_repourl
     def getRenderingFor(self, props):
         # the 'repository' property might be missing or an empty string
-        repourl = props.getProperty("repository", None) or self.default_repourl
-        if repourl not in self.repos:
+        repourl = (props.getProperty("repository", None) or
+                   self.default_repourl or self.repos.default_repourl)
+        if not self.repos.allows(repourl):
             log.msg("refusing to build from unsafe repo '%s'"
-                    " (will only accept: %s)" % (repourl, ",".join(self.repos)))
+                    " (will only accept: %s)" % (repourl, self.repos.describe()))
             raise ValueError("refusing to build from unsafe repo, see logs")
         return repourl
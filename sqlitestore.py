@@ -0,0 +1,46 @@
+"""
+The small sqlite files the buildmaster keeps its histories in
+
+A SqliteStore opens its file the first time it is used, creates the
+tables in 'schema', and adds any 'migrations' column its table lacks.
+TestHistory, MetricHistory, CoverageHistory, TestImpactMap, WarningIndex,
+ResultCache and StatusQueue are all SqliteStores.
+"""
+
+import sqlite3
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid-1] + values[mid]) / 2.0
+
+class SqliteStore:
+    # statements run every time the file is opened, so they must be
+    # idempotent (CREATE ... IF NOT EXISTS)
+    schema = []
+    # (table, column, statement): 'statement' is run when 'table' has no
+    # 'column' yet
+    migrations = []
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._db = None
+
+    def _connect(self):
+        # don't touch the disk until the first build records something, so
+        # that 'buildbot checkconfig' doesn't leave files lying around
+        if self._db is None:
+            self._db = sqlite3.connect(self.filename)
+            for statement in self.schema:
+                self._db.execute(statement)
+            for (table, column, statement) in self.migrations:
+                columns = [row[1] for row in self._db.execute(
+                    "PRAGMA table_info(%s)" % table)]
+                if column not in columns:
+                    self._db.execute(statement)
+            self._db.commit()
+        return self._db
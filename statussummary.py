@@ -0,0 +1,329 @@
+"""
+Latest results, kept up to date as builds finish
+
+The links on root.html (the waterfall filtered by tag, builders?branch=
+and one_line_per_build) are all rendered by walking the build history of
+every builder on each request, loading pickled builds from disk as they
+go, so they get slower the more builds there are.
+
+A BuildSummary is a status receiver that keeps, in memory, the latest
+finished build of each builder on each branch and the last 'recent' builds
+overall, and updates them in buildFinished(). Another branch than
+'default_branch' only keeps its latest builds while one of them is among
+the recent ones, so PR branches don't pile up. Each rendering of it (JSON
+or HTML, for a tag and/or branch) is made once per update and then served
+from memory with an ETag, so a client that polls with If-None-Match gets a
+304 until something finishes. The summary is saved to 'filename' after
+every update, so a restarted buildmaster doesn't have to go through the
+history again; without that file it starts from the last 'recent' builds
+of each builder.
+
+In master.cfg:
+
+  from statussummary import BuildSummary, SummaryResource
+  summary = BuildSummary("status-summary.json")
+  c['status'].append(summary)
+  ws.putChild("summary.json", SummaryResource(summary, "json"))
+  ws.putChild("summary", SummaryResource(summary, "html"))
+
+  GET summary.json?tag=supported&branch=master
+
+Renderings are only kept for tags and branches the summary knows about
+(any other query is rendered every time and not kept), so arbitrary query
+strings can't grow the cache.
+
+'python statussummary.py bench' times the summary against the history
+size. Its "list scan" column is not the real pages: it is a pass over an
+in-memory list of build dicts, a lower bound for what they do before they
+load each build from disk.
+"""
+
+import os, cgi, json, time, urllib, hashlib
+from collections import deque
+from twisted.python import log
+from twisted.web import http
+from twisted.web.resource import Resource
+from buildbot.status.base import StatusReceiverMultiService
+from buildbot.status.results import Results
+
+def build_entry(builderName, build):
+    sourcestamps = build.getSourceStamps()
+    branch = sourcestamps and sourcestamps[0].branch or ""
+    started, finished = build.getTimes()
+    return {"builder": builderName,
+            "number": build.getNumber(),
+            "branch": branch,
+            "revision": (build.getProperty("got_revision", None) or
+                         build.getProperty("revision", None)),
+            "results": Results[build.getResults()],
+            "text": " ".join(build.getText()),
+            "started": started,
+            "finished": finished,
+            }
+
+class BuildSummary(StatusReceiverMultiService):
+    compare_attrs = ["filename", "recent_builds", "default_branch"]
+
+    def __init__(self, filename="status-summary.json", recent=100,
+                 default_branch="master"):
+        StatusReceiverMultiService.__init__(self)
+        self.filename = filename
+        self.recent_builds = recent
+        self.default_branch = default_branch
+        self.recent = deque(maxlen=recent)
+        # builder -> {branch: entry}
+        self.latest = {}
+        # builder -> [tags]
+        self.tags = {}
+        self.version = 0
+        # (format, tag, branch) -> (etag, body)
+        self._rendered = {}
+
+    def startService(self):
+        StatusReceiverMultiService.startService(self)
+        self._status = self.parent.getStatus()
+        if not self.load():
+            self.seed()
+        self._status.subscribe(self)
+
+    def stopService(self):
+        self._status.unsubscribe(self)
+        return StatusReceiverMultiService.stopService(self)
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return False
+        try:
+            f = open(self.filename)
+            try:
+                saved = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            log.err(None, "unable to read %s" % self.filename)
+            return False
+        self.latest = saved["latest"]
+        self.tags = saved["tags"]
+        self.recent.extend(saved["recent"])
+        self.prune()
+        self.updated()
+        return True
+
+    def save(self):
+        tmp = self.filename + ".tmp"
+        f = open(tmp, "w")
+        try:
+            json.dump({"latest": self.latest, "tags": self.tags,
+                       "recent": list(self.recent)}, f)
+        finally:
+            f.close()
+        os.rename(tmp, self.filename)
+
+    def seed(self):
+        # the one time we go through the history: the last few builds of
+        # each builder, oldest first
+        entries = []
+        for name in self._status.getBuilderNames():
+            builder = self._status.getBuilder(name)
+            self.tags[name] = builder.getTags() or []
+            for build in builder.generateFinishedBuilds(
+                num_builds=self.recent.maxlen, max_search=self.recent.maxlen):
+                entries.append(build_entry(name, build))
+        entries.sort(key=lambda e: e["finished"])
+        for entry in entries:
+            self.record(entry)
+        self.updated()
+
+    def builderAdded(self, builderName, builder):
+        self.tags[builderName] = builder.getTags() or []
+        return self
+
+    def builderRemoved(self, builderName):
+        self.tags.pop(builderName, None)
+        if self.latest.pop(builderName, None) is not None:
+            self.updated()
+
+    def buildFinished(self, builderName, build, results):
+        self.record(build_entry(builderName, build))
+        self.updated()
+        try:
+            self.save()
+        except EnvironmentError:
+            log.err(None, "unable to save %s" % self.filename)
+
+    def record(self, entry):
+        self.latest.setdefault(entry["builder"], {})[entry["branch"]] = entry
+        self.recent.append(entry)
+        self.prune()
+
+    def prune(self):
+        # forget the latest builds of branches (other than the default one)
+        # that haven't had a recent build
+        recent = set([(e["builder"], e["branch"]) for e in self.recent])
+        for name in list(self.latest):
+            branches = self.latest[name]
+            for branch in list(branches):
+                if (branch not in ("", self.default_branch) and
+                    (name, branch) not in recent):
+                    del branches[branch]
+            if not branches:
+                del self.latest[name]
+
+    def updated(self):
+        self.version += 1
+        self._rendered = {}
+
+    def snapshot(self, tag=None, branch=None):
+        """
+        Return {"builders": [latest entries, by builder], "recent": [entries,
+        newest first]}, limited to builders with 'tag' and builds of
+        'branch' if those are given.
+        """
+        def wanted(entry):
+            if tag and tag not in self.tags.get(entry["builder"], []):
+                return False
+            return branch is None or entry["branch"] == branch
+        builders = []
+        for name in sorted(self.latest):
+            for b in sorted(self.latest[name]):
+                if wanted(self.latest[name][b]):
+                    builders.append(self.latest[name][b])
+        recent = [entry for entry in reversed(self.recent) if wanted(entry)]
+        return {"builders": builders, "recent": recent}
+
+    def known(self, tag, branch):
+        """
+        Return whether 'tag' is one of our builders' tags and 'branch' one
+        we have a latest build of (None counts as known for both).
+        """
+        if tag is not None and not [name for name in self.tags
+                                    if tag in self.tags[name]]:
+            return False
+        if branch is not None and not [name for name in self.latest
+                                       if branch in self.latest[name]]:
+            return False
+        return True
+
+    def rendered(self, format, tag=None, branch=None):
+        """
+        Return (etag, body) for the summary in 'format' ("json" or
+        "html"), rendering it only if the summary has changed since the
+        last time. Renderings for unknown tags or branches aren't kept.
+        """
+        key = (format, tag, branch)
+        if key in self._rendered:
+            return self._rendered[key]
+        snapshot = self.snapshot(tag, branch)
+        if format == "json":
+            body = json.dumps(snapshot, sort_keys=True)
+        else:
+            body = render_html(snapshot, tag, branch)
+        if not isinstance(body, bytes):
+            body = body.encode("utf-8")
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()[:20]
+        if self.known(tag, branch):
+            self._rendered[key] = (etag, body)
+        return (etag, body)
+
+def render_html(snapshot, tag, branch):
+    def row(entry):
+        link = "builders/%s/builds/%d" % (urllib.quote(entry["builder"], ""),
+                                          entry["number"])
+        finished = entry["finished"] and time.strftime(
+            "%Y-%m-%d %H:%M", time.localtime(entry["finished"])) or ""
+        return ('<tr><td>%s</td><td>%s</td><td class="%s">'
+                '<a href="%s">#%d</a> %s</td><td>%s</td><td>%s</td></tr>\n'
+                % (cgi.escape(entry["builder"]),
+                   cgi.escape(entry["branch"] or "(default)"),
+                   entry["results"], link, entry["number"],
+                   cgi.escape(entry["text"]),
+                   cgi.escape((entry["revision"] or "")[:12]), finished))
+    header = ("<tr><th>Builder</th><th>Branch</th><th>Result</th>"
+              "<th>Revision</th><th>Finished</th></tr>\n")
+    title = "Latest builds"
+    if tag:
+        title += ", %s builders" % cgi.escape(tag)
+    if branch:
+        title += ", branch %s" % cgi.escape(branch)
+    return ("<html><head><title>%s</title>"
+            '<link href="default.css" rel="stylesheet" type="text/css">'
+            "</head><body>\n<h1>%s</h1>\n<table>\n%s%s</table>\n"
+            "<h2>Recent builds</h2>\n<table>\n%s%s</table>\n</body></html>\n"
+            % (title, title,
+               header, "".join([row(e) for e in snapshot["builders"]]),
+               header, "".join([row(e) for e in snapshot["recent"]])))
+
+class SummaryResource(Resource):
+    isLeaf = True
+
+    def __init__(self, summary, format="json"):
+        Resource.__init__(self)
+        self.summary = summary
+        self.format = format
+
+    def render_GET(self, request):
+        def arg(name, default=None):
+            return request.args.get(name, [default])[0]
+        etag, body = self.summary.rendered(self.format, arg("tag"),
+                                           arg("branch"))
+        if self.format == "json":
+            request.setHeader("content-type", "application/json")
+        else:
+            request.setHeader("content-type", "text/html; charset=utf-8")
+        # the browser can keep it, but has to ask whether it changed
+        request.setHeader("cache-control", "no-cache")
+        if request.setETag(etag) == http.CACHED:
+            return ""
+        return body
+
+def bench(sizes, builders=30, requests=200):
+    import random, sys
+    names = ["builder-%d" % i for i in range(builders)]
+    sys.stdout.write("%8s %15s %12s %12s\n"
+                     % ("builds", "list scan (ms)", "render (ms)",
+                        "cached (ms)"))
+    for size in sizes:
+        history = []
+        for number in range(size):
+            name = random.choice(names)
+            history.append({"builder": name, "number": number,
+                            "branch": random.choice(["master", "pr-1"]),
+                            "revision": "%040x" % random.getrandbits(160),
+                            "results": random.choice(Results[:3]),
+                            "text": "build successful",
+                            "started": number, "finished": number + 1})
+        summary = BuildSummary(filename=None)
+        for name in names:
+            summary.tags[name] = [random.choice(["supported",
+                                                 "unsupported"])]
+        for entry in history:
+            summary.record(entry)
+        summary.updated()
+
+        # a lower bound for the history pages: find each builder's newest
+        # build in a list already in memory (they unpickle each build too)
+        start = time.time()
+        latest = {}
+        for entry in reversed(history):
+            latest.setdefault((entry["builder"], entry["branch"]), entry)
+        scan = time.time() - start
+
+        start = time.time()
+        for i in range(requests):
+            summary.updated()
+            summary.rendered("html", "supported", "master")
+        render = (time.time() - start) / requests
+
+        start = time.time()
+        for i in range(requests):
+            summary.rendered("html", "supported", "master")
+        cached = (time.time() - start) / requests
+        sys.stdout.write("%8d %15.3f %12.3f %12.4f\n"
+                         % (size, 1000 * scan, 1000 * render, 1000 * cached))
+
+if __name__ == "__main__":
+    import sys
+    if sys.argv[1:2] != ["bench"]:
+        sys.stderr.write("usage: statussummary.py bench [BUILDS ...]\n")
+        sys.exit(1)
+    bench([int(size) for size in sys.argv[2:]] or [100, 1000, 10000, 100000])
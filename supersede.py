@@ -0,0 +1,138 @@
+"""
+Don't build revisions that have already been replaced
+
+A PR branch often gets several pushes within a few minutes. s_tests and
+s_other used to queue a full build on every builder for each of them, and
+the build of an obsolete revision would keep its buildslave busy for an
+hour after the next push arrived.
+
+A SupersedingScheduler is an AnyBranchScheduler, so every (repository,
+branch) gets its own treeStableTimer and the pushes that arrive inside it
+are built together. It also remembers the newest buildset of each
+(repository, branch), until it completes. When a newer one is added, the
+requests of the older one that no buildslave has started yet are
+cancelled, and with stopRunning=True the builds that have started are
+stopped as well.
+
+The buildslave time this saves is estimated from how long each builder's
+last build took (minus what a stopped build had already used), logged for
+every superseded buildset, and kept as a running total in the scheduler's
+state as 'saved_seconds'.
+"""
+
+import time
+from twisted.internet import defer
+from twisted.python import log
+from buildbot.db.buildrequests import AlreadyClaimedError
+from buildbot.schedulers.basic import AnyBranchScheduler
+from buildbot.status.results import FAILURE
+
+def expected_duration(builder_status):
+    last = builder_status.getLastFinishedBuild()
+    if last is None:
+        return 0.0
+    started, finished = last.getTimes()
+    if finished is None:
+        return 0.0
+    return finished - started
+
+class SupersedingScheduler(AnyBranchScheduler):
+    def __init__(self, name, stopRunning=False, **kwargs):
+        AnyBranchScheduler.__init__(self, name, **kwargs)
+        self.stopRunning = stopRunning
+        self.saved_seconds = 0.0
+        # (repository, branch) -> (revision, bsid, {buildername: brid}),
+        # for the buildsets that haven't completed yet
+        self._newest = {}
+        self._completions = None
+
+    def preStartConsumingChanges(self):
+        self._completions = self.master.subscribeToBuildsetCompletions(
+            self.buildsetComplete)
+        d = self.getState("saved_seconds", 0.0)
+        def set_saved(saved_seconds):
+            self.saved_seconds = saved_seconds
+        d.addCallback(set_saved)
+        return d
+
+    def stopService(self):
+        if self._completions is not None:
+            self._completions.unsubscribe()
+            self._completions = None
+        return AnyBranchScheduler.stopService(self)
+
+    def buildsetComplete(self, bsid, results):
+        # there is nothing left of it to supersede
+        for (key, newest) in list(self._newest.items()):
+            if newest[1] == bsid:
+                del self._newest[key]
+
+    @defer.inlineCallbacks
+    def addBuildsetForChanges(self, **kwargs):
+        bsid, brids = yield AnyBranchScheduler.addBuildsetForChanges(self,
+                                                                     **kwargs)
+        changeids = kwargs.get("changeids")
+        if changeids:
+            change = yield self.master.db.changes.getChange(max(changeids))
+            key = (change["repository"], change["branch"])
+            older = self._newest.get(key)
+            self._newest[key] = (change["revision"], bsid, brids)
+            if older is not None:
+                try:
+                    yield self.supersede(older, change["revision"])
+                except Exception:
+                    log.err(None, "while superseding buildset %d" % older[1])
+        defer.returnValue((bsid, brids))
+
+    @defer.inlineCallbacks
+    def supersede(self, older, revision):
+        old_revision, bsid, brids = older
+        saved = 0.0
+        cancelled = []
+        stopped = []
+        for (buildername, brid) in brids.items():
+            builder = self.master.botmaster.builders.get(buildername)
+            try:
+                yield self.master.db.buildrequests.claimBuildRequests([brid])
+            except AlreadyClaimedError:
+                # it has started, or finished already
+                if self.stopRunning and builder is not None:
+                    count, seconds = self.stopBuilds(builder, brid, revision)
+                    if count:
+                        stopped.append(buildername)
+                        saved += seconds
+                continue
+            # buildbot's own "cancel" button completes the request with
+            # FAILURE too
+            yield self.master.db.buildrequests.completeBuildRequests([brid],
+                                                                     FAILURE)
+            cancelled.append(buildername)
+            if builder is not None:
+                saved += expected_duration(builder.builder_status)
+        if cancelled:
+            yield self.master.maybeBuildsetComplete(bsid)
+        if not (cancelled or stopped):
+            return
+
+        self.saved_seconds += saved
+        yield self.setState("saved_seconds", self.saved_seconds)
+        log.msg("%s: %s superseded by %s: cancelled %s, stopped %s,"
+                " saved about %.1f buildslave-hours (%.1f in total)"
+                % (self.name, old_revision, revision,
+                   ",".join(cancelled) or "none", ",".join(stopped) or "none",
+                   saved / 3600, self.saved_seconds / 3600))
+
+    def stopBuilds(self, builder, brid, revision):
+        count = 0
+        saved = 0.0
+        for build in builder.building[:]:
+            # leave builds that merged this request with others alone,
+            # the others may well be newer
+            if [request.id for request in build.requests] != [brid]:
+                continue
+            started = build.build_status.getTimes()[0]
+            saved += max(0.0, expected_duration(builder.builder_status)
+                         - (time.time() - started))
+            build.stopBuild("superseded by %s" % revision)
+            count += 1
+        return count, saved
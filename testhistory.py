@@ -0,0 +1,237 @@
+"""
+Per-test timing and outcome history
+
+A TestHistory stores how long each test took (from TrialCommand's
+--reporter=timing output) and whether it failed, errored or was skipped,
+keyed by builder, build number, revision and test id.
+
+In master.cfg:
+
+  from testhistory import TestHistory
+  test_history = TestHistory("test-history.sqlite")
+  f.addStep(TrialCommand(..., history=test_history))
+
+and then, from the buildmaster's basedir:
+
+  python ../testhistory.py test-history.sqlite slowest "OS-X 10.13" 10
+  python ../testhistory.py test-history.sqlite grown "OS-X 10.13" 25
+  python ../testhistory.py test-history.sqlite flaky "OS-X 10.13" 50
+
+RetryFailedTests records which failed tests passed when they were run
+again ("flaky") and which failed every time ("confirmed").
+
+Writes happen once per build, in one transaction, from the buildmaster's
+reactor thread. That takes a few milliseconds even for the full allmydata
+suite, so we don't bother with a thread pool.
+"""
+
+import os, sys, time
+from sqlitestore import SqliteStore, median
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS test_runs (
+         builder TEXT NOT NULL,
+         buildnumber INTEGER NOT NULL,
+         revision TEXT,
+         testid TEXT NOT NULL,
+         duration REAL,
+         outcome TEXT,
+         recorded_at REAL NOT NULL
+       )""",
+    "CREATE INDEX IF NOT EXISTS test_runs_build"
+    " ON test_runs (builder, buildnumber)",
+    "CREATE INDEX IF NOT EXISTS test_runs_test"
+    " ON test_runs (builder, testid)",
+    "CREATE INDEX IF NOT EXISTS test_runs_revision"
+    " ON test_runs (revision)",
+    """CREATE TABLE IF NOT EXISTS test_retries (
+         builder TEXT NOT NULL,
+         buildnumber INTEGER NOT NULL,
+         revision TEXT,
+         testid TEXT NOT NULL,
+         attempts INTEGER NOT NULL,
+         verdict TEXT NOT NULL,
+         recorded_at REAL NOT NULL
+       )""",
+    "CREATE INDEX IF NOT EXISTS test_retries_test"
+    " ON test_retries (builder, testid)",
+    ]
+
+class TestHistory(SqliteStore):
+    schema = SCHEMA
+
+    def __init__(self, filename="test-history.sqlite"):
+        SqliteStore.__init__(self, filename)
+
+    def record(self, builder, buildnumber, revision, timings, outcomes):
+        """
+        Store the results of one build. 'timings' is a list of (seconds,
+        testid) pairs, 'outcomes' maps testid to an outcome string like
+        'failure' or 'skipped'. Timed tests without an outcome passed.
+        """
+        now = time.time()
+        rows = []
+        seen = set()
+        for (duration, testid) in timings:
+            rows.append((builder, buildnumber, revision, testid, duration,
+                         outcomes.get(testid, "success"), now))
+            seen.add(testid)
+        for testid, outcome in outcomes.items():
+            if testid not in seen:
+                rows.append((builder, buildnumber, revision, testid, None,
+                             outcome, now))
+        db = self._connect()
+        # a rebuild of the same build number replaces what we had
+        db.execute("DELETE FROM test_runs WHERE builder=? AND buildnumber=?",
+                   (builder, buildnumber))
+        db.executemany("INSERT INTO test_runs VALUES (?,?,?,?,?,?,?)", rows)
+        db.commit()
+        return len(rows)
+
+    def _recent_builds(self, builder, count):
+        c = self._connect().execute(
+            "SELECT DISTINCT buildnumber FROM test_runs WHERE builder=?"
+            " ORDER BY buildnumber DESC LIMIT ?", (builder, count))
+        return [row[0] for row in c.fetchall()]
+
+    def _durations(self, builder, buildnumbers):
+        durations = {}
+        if not buildnumbers:
+            return durations
+        c = self._connect().execute(
+            "SELECT testid, duration FROM test_runs"
+            " WHERE builder=? AND buildnumber BETWEEN ? AND ?"
+            " AND duration IS NOT NULL",
+            (builder, min(buildnumbers), max(buildnumbers)))
+        for (testid, duration) in c.fetchall():
+            durations.setdefault(testid, []).append(duration)
+        return durations
+
+    def slowest(self, builder, builds=10, limit=20):
+        """
+        Return the 'limit' slowest tests on 'builder' over its last 'builds'
+        builds, as (median seconds, max seconds, runs, testid), slowest
+        first.
+        """
+        durations = self._durations(builder,
+                                    self._recent_builds(builder, builds))
+        tests = [(median(d), max(d), len(d), testid)
+                 for (testid, d) in durations.items()]
+        tests.sort(reverse=True)
+        return tests[:limit]
+
+    def median_durations(self, builders, builds=10):
+        """
+        Return {testid: median seconds} over the last 'builds' builds of
+        each of 'builders' together.
+        """
+        durations = {}
+        for builder in builders:
+            recent = self._durations(builder,
+                                     self._recent_builds(builder, builds))
+            for testid, d in recent.items():
+                durations.setdefault(testid, []).extend(d)
+        return dict([(testid, median(d)) for (testid, d) in durations.items()])
+
+    def grown(self, builder, percent, recent=5, baseline=20, min_seconds=0.1):
+        """
+        Return the tests on 'builder' whose median time over the last
+        'recent' builds is more than 'percent' percent above their median
+        over the 'baseline' builds before that, as (growth percent, old
+        median, new median, testid), worst first. Tests that take less than
+        'min_seconds' are too noisy to be worth reporting.
+        """
+        buildnumbers = self._recent_builds(builder, recent + baseline)
+        new = self._durations(builder, buildnumbers[:recent])
+        old = self._durations(builder, buildnumbers[recent:])
+        tests = []
+        for testid, new_durations in new.items():
+            if testid not in old:
+                continue
+            old_median = median(old[testid])
+            new_median = median(new_durations)
+            if max(old_median, new_median) < min_seconds or not old_median:
+                continue
+            growth = 100.0 * (new_median - old_median) / old_median
+            if growth > percent:
+                tests.append((growth, old_median, new_median, testid))
+        tests.sort(reverse=True)
+        return tests
+
+    def record_retries(self, builder, buildnumber, revision, retried):
+        """
+        Store what RetryFailedTests found: 'retried' maps testid to
+        (attempts, verdict), the verdict being 'flaky' or 'confirmed'.
+        """
+        now = time.time()
+        db = self._connect()
+        db.execute("DELETE FROM test_retries WHERE builder=? AND buildnumber=?",
+                   (builder, buildnumber))
+        db.executemany("INSERT INTO test_retries VALUES (?,?,?,?,?,?,?)",
+                       [(builder, buildnumber, revision, testid, attempts,
+                         verdict, now)
+                        for (testid, (attempts, verdict)) in retried.items()])
+        db.commit()
+
+    def flakiness(self, builder, builds=50):
+        """
+        Return the tests that passed on a retry in any of the last 'builds'
+        builds of 'builder', as (rate, flaky, confirmed, testid), flakiest
+        first. 'rate' is the fraction of those builds in which the test
+        failed and then passed when it was run again.
+        """
+        buildnumbers = self._recent_builds(builder, builds)
+        if not buildnumbers:
+            return []
+        c = self._connect().execute(
+            "SELECT testid, verdict, COUNT(*) FROM test_retries"
+            " WHERE builder=? AND buildnumber >= ? GROUP BY testid, verdict",
+            (builder, min(buildnumbers)))
+        verdicts = {}
+        for (testid, verdict, count) in c.fetchall():
+            verdicts.setdefault(testid, {})[verdict] = count
+        tests = [(float(v.get("flaky", 0)) / len(buildnumbers),
+                  v.get("flaky", 0), v.get("confirmed", 0), testid)
+                 for (testid, v) in verdicts.items() if v.get("flaky")]
+        tests.sort(reverse=True)
+        return tests
+
+    def outcomes(self, builder, testid, builds=20):
+        """
+        Return [(buildnumber, revision, outcome, seconds)] for one test over
+        the last 'builds' builds of 'builder', newest first.
+        """
+        c = self._connect().execute(
+            "SELECT buildnumber, revision, outcome, duration FROM test_runs"
+            " WHERE builder=? AND testid=? ORDER BY buildnumber DESC LIMIT ?",
+            (builder, testid, builds))
+        return c.fetchall()
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4 or not os.path.exists(sys.argv[1]):
+        sys.stderr.write("usage: testhistory.py DBFILE slowest BUILDER [BUILDS]\n"
+                         "       testhistory.py DBFILE grown BUILDER [PERCENT]\n"
+                         "       testhistory.py DBFILE flaky BUILDER [BUILDS]\n"
+                         "       testhistory.py DBFILE test BUILDER TESTID\n")
+        sys.exit(1)
+    history = TestHistory(sys.argv[1])
+    command, builder = sys.argv[2], sys.argv[3]
+    if command == "slowest":
+        builds = int((sys.argv[4:] or [10])[0])
+        for (med, longest, runs, testid) in history.slowest(builder, builds):
+            sys.stdout.write("%8.3fs median %8.3fs max %3d runs: %s\n"
+                             % (med, longest, runs, testid))
+    elif command == "grown":
+        percent = float((sys.argv[4:] or [20])[0])
+        for (growth, old, new, testid) in history.grown(builder, percent):
+            sys.stdout.write("%+7.1f%% %8.3fs -> %8.3fs: %s\n"
+                             % (growth, old, new, testid))
+    elif command == "flaky":
+        builds = int((sys.argv[4:] or [50])[0])
+        for (rate, flaky, confirmed, testid) in history.flakiness(builder, builds):
+            sys.stdout.write("%5.1f%% %3d flaky %3d confirmed: %s\n"
+                             % (100 * rate, flaky, confirmed, testid))
+    elif command == "test" and len(sys.argv) > 4:
+        for (buildnumber, revision, outcome, seconds) in history.outcomes(builder, sys.argv[4]):
+            sys.stdout.write("#%d %s %s %s\n" % (buildnumber, revision,
+                                                 outcome, seconds))
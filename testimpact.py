@@ -0,0 +1,135 @@
+"""
+Which test modules exercise which source files
+
+A TestImpactMap stores, for each source file, the test modules that ran it
+during the last coverage build of master, so that a PR build can run only
+the modules its changed files could affect.
+
+The coverage build runs with per-test contexts turned on ('covarchive.py
+rcfile'), writes the map with 'covarchive.py impact', uploads it, and the
+RecordTestImpact step stores it here. SelectImpactedTests then asks
+select() for the modules to run. select() returns None, meaning "run
+everything", when:
+
+ - there is no map, or it is older than max_age seconds
+ - a changed file matches one of the 'core' patterns (the build and test
+   machinery, which every test depends on)
+ - a changed file isn't in the map and isn't one of the 'ignored' ones
+   (documentation and the like), e.g. a new module
+
+A changed test module is always selected itself, along with the modules
+the map says run its tests (through mixins).
+"""
+
+import time, fnmatch
+from sqlitestore import SqliteStore
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS maps (
+         id INTEGER PRIMARY KEY,
+         builder TEXT NOT NULL,
+         buildnumber INTEGER NOT NULL,
+         revision TEXT,
+         recorded_at REAL NOT NULL
+       )""",
+    """CREATE TABLE IF NOT EXISTS file_tests (
+         map INTEGER NOT NULL,
+         filename TEXT NOT NULL,
+         module TEXT NOT NULL
+       )""",
+    "CREATE INDEX IF NOT EXISTS file_tests_map ON file_tests (map, filename)",
+    ]
+
+CORE = ["setup.py", "setup.cfg", "tox.ini", "requirements*", "Makefile",
+        "src/allmydata/__init__.py", "src/allmydata/_auto_deps.py",
+        "src/allmydata/test/__init__.py", "src/allmydata/test/common*.py",
+        "src/allmydata/test/no_network.py"]
+
+IGNORED = ["docs/*", "newsfragments/*", "*.rst", "*.md", "*.txt",
+           "CREDITS", "NEWS*"]
+
+def test_module(filename, srcdir="src", testdir="src/allmydata/test"):
+    # src/allmydata/test/cli/test_cli.py -> allmydata.test.cli.test_cli
+    if not (filename.startswith(testdir + "/") and filename.endswith(".py")
+            and filename.split("/")[-1].startswith("test_")):
+        return None
+    return filename[len(srcdir + "/"):-len(".py")].replace("/", ".")
+
+def matches(filename, patterns):
+    for pattern in patterns:
+        if fnmatch.fnmatch(filename, pattern):
+            return True
+    return False
+
+class TestImpactMap(SqliteStore):
+    schema = SCHEMA
+
+    def __init__(self, filename="test-impact.sqlite", max_age=14*24*3600,
+                 core=CORE, ignored=IGNORED):
+        SqliteStore.__init__(self, filename)
+        self.max_age = max_age
+        self.core = core
+        self.ignored = ignored
+
+    def record(self, builder, buildnumber, revision, files):
+        """
+        Store a new map, {filename: [test modules]}, in place of the old
+        one.
+        """
+        db = self._connect()
+        c = db.execute("INSERT INTO maps (builder, buildnumber, revision,"
+                       " recorded_at) VALUES (?,?,?,?)",
+                       (builder, buildnumber, revision, time.time()))
+        new = c.lastrowid
+        db.executemany("INSERT INTO file_tests VALUES (?,?,?)",
+                       [(new, filename, module)
+                        for (filename, modules) in files.items()
+                        for module in modules])
+        db.execute("DELETE FROM file_tests WHERE map != ?", (new,))
+        db.execute("DELETE FROM maps WHERE id != ?", (new,))
+        db.commit()
+
+    def latest(self):
+        """
+        Return (id, builder, buildnumber, revision, recorded_at) of the
+        current map, or None if we have none.
+        """
+        return self._connect().execute(
+            "SELECT id, builder, buildnumber, revision, recorded_at"
+            " FROM maps ORDER BY id DESC LIMIT 1").fetchone()
+
+    def select(self, changed, now=None, removed=()):
+        """
+        Return (modules, reason): the sorted test modules affected by the
+        'changed' filenames and a short description of the map used, or
+        (None, why) when the whole suite has to run. The 'removed' ones
+        among them are still looked up in the map, but a removed test
+        module isn't selected.
+        """
+        now = now or time.time()
+        current = self.latest()
+        if current is None:
+            return None, "no test map"
+        mapid, builder, buildnumber, revision, recorded_at = current
+        if now - recorded_at > self.max_age:
+            return None, "test map from %s is stale" % (
+                time.strftime("%Y-%m-%d", time.gmtime(recorded_at)),)
+        db = self._connect()
+        modules = set()
+        for filename in changed:
+            if matches(filename, self.core):
+                return None, "%s changed" % filename
+            module = test_module(filename)
+            if module is not None and filename not in removed:
+                modules.add(module)
+            # a test module's mixins may be run by other test modules too
+            rows = db.execute("SELECT module FROM file_tests"
+                              " WHERE map=? AND filename=?",
+                              (mapid, filename)).fetchall()
+            if rows:
+                modules.update([row[0] for row in rows])
+            elif module is None and not matches(filename, self.ignored):
+                return None, "%s isn't in the test map" % filename
+        modules.difference_update([test_module(f) for f in removed])
+        return sorted(modules), "test map from %s build %d" % (builder,
+                                                               buildnumber)
@@ -0,0 +1,208 @@
+"""
+A per-buildslave cache of tox environments
+
+The checkout at the start of every build runs 'git clean -x', which throws
+away .tox/, so every tox run used to rebuild its virtualenvs and reinstall
+every dependency, compiled ones included. This script keeps them between
+builds instead.
+
+It runs on the buildslave: master.cfg sends it over with a FileDownload
+step, and then runs, from the top of the checkout,
+
+  python ../toxcache.py --cache ../../tox-cache --fingerprint FP restore py27
+  tox -e py27 ...
+  python ../toxcache.py --cache ../../tox-cache --fingerprint FP save py27
+
+An environment is keyed on a hash of setup.py, tox.ini, the toxenv name,
+the interpreter fingerprint FP (what ToolVersions reported) and the absolute
+path of the environment, since virtualenvs can't be moved. 'restore' moves a
+cached environment into .tox/ on a hit, 'save' moves it back after the
+build (only if tox finished setting it up) and then evicts the least
+recently used entries until the cache fits in --max-size.
+
+Environments are moved, not copied, so restoring and saving cost next to
+nothing when the cache is on the same filesystem as the builds. Only one
+build at a time uses a given key, because the key includes the path.
+
+Wheels that pip builds on a miss go to <cache>/pip (set PIP_CACHE_DIR for
+the tox step), so a miss on one builder doesn't recompile what another
+builder on the same slave already compiled. Everything pip keeps there,
+its downloads too, counts towards --max-size and is evicted file by file
+along with the environments.
+"""
+
+import os, re, sys, time, shutil, hashlib, argparse, itertools
+try:
+    from ConfigParser import RawConfigParser
+except ImportError:
+    from configparser import RawConfigParser
+
+# tox writes this once the environment's dependencies are installed
+TOX_MARKER = ".tox-config1"
+
+def env_key(toxenv, fingerprint):
+    h = hashlib.sha256()
+    for filename in ("setup.py", "tox.ini"):
+        h.update(filename.encode("utf-8"))
+        if os.path.exists(filename):
+            with open(filename, "rb") as f:
+                h.update(f.read())
+    for part in (toxenv, fingerprint,
+                 os.path.abspath(os.path.join(".tox", toxenv))):
+        h.update(b"\0" + part.encode("utf-8"))
+    return "%s-%s" % (toxenv, h.hexdigest()[:16])
+
+def expand_envlist(envlist):
+    # the way tox reads an envlist: names separated by commas (or
+    # newlines) outside braces, and each {a,b} group in a name multiplies
+    # it, so {py27,pypy27}{-coverage,} is py27-coverage, py27,
+    # pypy27-coverage and pypy27
+    items, item, depth = [], "", 0
+    for char in envlist:
+        if char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+        if depth == 0 and (char == "," or char.isspace()):
+            items.append(item)
+            item = ""
+        else:
+            item += char
+    items.append(item)
+    names = []
+    for item in items:
+        groups = [part.startswith("{") and
+                  [a.strip() for a in part[1:-1].split(",")] or [part]
+                  for part in re.split(r"(\{[^{}]*\})", item)]
+        for parts in itertools.product(*groups):
+            name = "".join(parts)
+            if name and name not in names:
+                names.append(name)
+    return names
+
+def default_toxenvs():
+    # what a bare 'tox' would run: the envlist in tox.ini
+    config = RawConfigParser()
+    config.read("tox.ini")
+    if not config.has_option("tox", "envlist"):
+        return []
+    return expand_envlist(config.get("tox", "envlist"))
+
+def tree_size(path):
+    if not os.path.isdir(path):
+        return os.lstat(path).st_size
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return size
+
+def remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+def report(toxenv, what, key):
+    # ToxEnvCache in bbsupport.py reads these
+    sys.stdout.write("toxcache: %s %s %s\n" % (toxenv, what, key))
+    sys.stdout.flush()
+
+def restore(options):
+    envs = os.path.join(options.cache, "envs")
+    for toxenv in options.toxenvs:
+        key = env_key(toxenv, options.fingerprint)
+        cached = os.path.join(envs, key)
+        target = os.path.join(".tox", toxenv)
+        if not os.path.isdir(cached):
+            report(toxenv, "miss", key)
+            continue
+        remove(target)
+        if not os.path.isdir(".tox"):
+            os.makedirs(".tox")
+        shutil.move(cached, target)
+        # for the LRU
+        os.utime(target, None)
+        report(toxenv, "hit", key)
+
+def save(options):
+    envs = os.path.join(options.cache, "envs")
+    if not os.path.isdir(envs):
+        os.makedirs(envs)
+    for toxenv in options.toxenvs:
+        key = env_key(toxenv, options.fingerprint)
+        source = os.path.join(".tox", toxenv)
+        cached = os.path.join(envs, key)
+        if not os.path.exists(os.path.join(source, TOX_MARKER)):
+            report(toxenv, "unfinished", key)
+            continue
+        remove(cached)
+        # move it in under a temporary name, so that a half-copied
+        # environment (when the cache is on another filesystem) is never
+        # restored
+        partial = cached + ".partial"
+        remove(partial)
+        shutil.move(source, partial)
+        os.rename(partial, cached)
+        os.utime(cached, None)
+        report(toxenv, "saved", key)
+    evict(options.cache, options.max_size * 1e9)
+
+def cache_entries(cache):
+    # (last used, size, path) for every environment and every file in
+    # pip's cache (built wheels, and the http cache of downloads)
+    entries = []
+    envs = os.path.join(cache, "envs")
+    if os.path.isdir(envs):
+        for name in os.listdir(envs):
+            path = os.path.join(envs, name)
+            entries.append((os.stat(path).st_mtime, tree_size(path), path))
+    for dirpath, dirnames, filenames in os.walk(os.path.join(cache, "pip")):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            s = os.lstat(path)
+            entries.append((max(s.st_atime, s.st_mtime), s.st_size, path))
+    return entries
+
+def remove_empty_dirs(top):
+    # what evicting pip's files leaves behind
+    for dirpath, dirnames, filenames in os.walk(top, topdown=False):
+        if dirpath != top and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+
+def evict(cache, max_bytes):
+    entries = cache_entries(cache)
+    total = sum([size for (used, size, path) in entries])
+    entries.sort()
+    while entries and total > max_bytes:
+        used, size, path = entries.pop(0)
+        remove(path)
+        total -= size
+        sys.stdout.write("toxcache: evicted %s (%dMB, last used %s)\n"
+                         % (path, size // 1000000,
+                            time.strftime("%Y-%m-%d", time.localtime(used))))
+    remove_empty_dirs(os.path.join(cache, "pip"))
+    sys.stdout.write("toxcache: %dMB in %s\n" % (total // 1000000, cache))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="cache tox environments")
+    parser.add_argument("--cache", required=True)
+    parser.add_argument("--fingerprint", default="")
+    parser.add_argument("--max-size", type=float, default=5.0,
+                        help="in GB (default 5)")
+    parser.add_argument("action", choices=["restore", "save"])
+    parser.add_argument("toxenvs", nargs="*",
+                        help="default: the envlist in tox.ini")
+    options = parser.parse_args(argv)
+    options.toxenvs = options.toxenvs or default_toxenvs()
+    if options.action == "restore":
+        restore(options)
+    else:
+        save(options)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,96 @@
+"""
+Check that TrialOutputParser reads what this trial writes
+
+After a Twisted upgrade on the buildslaves, run it with their python:
+
+  python trialcheck.py [PYTHON]
+"""
+
+import os, sys, shutil, tempfile, subprocess
+from bbsupport import TrialOutputParser, failed_tests
+
+TRIAL_CHECK = '''
+from twisted.trial import unittest
+
+class Mixin(object):
+    def test_mixed(self):
+        self.fail("from a mixin")
+
+class Check(Mixin, unittest.TestCase):
+    def test_ok(self):
+        pass
+    def test_fail(self):
+        self.assertEqual(1, 2)
+    def test_error(self):
+        raise ValueError("boom")
+    def test_skip(self):
+        raise unittest.SkipTest("skipped")
+    def test_todo(self):
+        self.fail("not yet")
+    test_todo.todo = "not yet"
+'''
+
+def check_trial_parser(python="python"):
+    """
+    Run trial (--reporter=timing, as the tox builders do) on a few tests
+    that fail, error, skip and pass, feed its output through
+    TrialOutputParser, and return a list of what it got wrong.
+    """
+    class Step:
+        def __init__(self):
+            self.outcomes = {}
+        def addLog(self, name):
+            return self
+        def addStdout(self, text):
+            pass
+        def finish(self):
+            pass
+        def addTestResult(self, testname, results, text, tlog):
+            self.outcomes[".".join(testname)] = " ".join(text)
+    tmp = tempfile.mkdtemp(prefix="trialcheck-")
+    try:
+        f = open(os.path.join(tmp, "trialcheck.py"), "w")
+        f.write(TRIAL_CHECK)
+        f.close()
+        output = subprocess.Popen([python, "-m", "twisted.trial",
+                                   "--reporter=timing", "trialcheck"],
+                                  cwd=tmp, stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT).communicate()[0]
+    finally:
+        shutil.rmtree(tmp)
+    step = Step()
+    parser = TrialOutputParser()
+    parser.step = step
+    for line in output.decode("utf-8", "replace").splitlines():
+        parser.outLineReceived(line)
+    parser.finish()
+    expected = {"trialcheck.Check.test_fail": "failure",
+                "trialcheck.Check.test_mixed": "failure",
+                "trialcheck.Check.test_error": "error",
+                "trialcheck.Check.test_skip": "skipped",
+                "trialcheck.Check.test_todo": "expected failure"}
+    wrong = []
+    if step.outcomes != expected:
+        wrong.append("outcomes: got %r, expected %r" % (step.outcomes,
+                                                         expected))
+    if failed_tests(step.outcomes) != ["trialcheck.Check.test_error",
+                                       "trialcheck.Check.test_fail",
+                                       "trialcheck.Check.test_mixed"]:
+        wrong.append("failed tests: %r" % (failed_tests(step.outcomes),))
+    counts = parser.countFailedTests()
+    if (counts["total"], counts["failures"], counts["errors"]) != (6, 2, 1):
+        wrong.append("counts: %r" % (counts,))
+    if wrong:
+        wrong.append("trial output was:\n" + output.decode("utf-8", "replace"))
+    return wrong
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        sys.stderr.write("usage: trialcheck.py [PYTHON]\n")
+        sys.exit(1)
+    wrong = check_trial_parser(*sys.argv[1:2])
+    for problem in wrong:
+        sys.stdout.write("%s\n" % problem)
+    if wrong:
+        sys.exit(1)
+    sys.stdout.write("TrialOutputParser read trial's output correctly\n")
@@ -0,0 +1,161 @@
+"""
+Warnings we have seen before
+
+fingerprint() reduces a warning to (category, module, template): the
+module is worked out from the file the warning points at (whatever
+virtualenv or checkout it lives in), and the template is the message with
+paths, addresses and numbers replaced by placeholders, so the same warning
+matches across buildslaves and line numbers. A WarningIndex stores every
+fingerprint with the builder, build and revision it was first seen in and
+how often each build step saw it, so a step only reports the new ones.
+
+In master.cfg:
+
+  from warningindex import WarningIndex
+  warning_index = WarningIndex("warning-index.sqlite")
+  f.addStep(TrialCommand(..., warning_index=warning_index))
+"""
+
+import re, time, hashlib
+from sqlitestore import SqliteStore
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS fingerprints (
+         fingerprint TEXT PRIMARY KEY,
+         category TEXT NOT NULL,
+         module TEXT NOT NULL,
+         template TEXT NOT NULL,
+         example TEXT NOT NULL,
+         first_builder TEXT NOT NULL,
+         first_buildnumber INTEGER NOT NULL,
+         first_revision TEXT,
+         first_seen REAL NOT NULL,
+         last_seen REAL NOT NULL
+       )""",
+    """CREATE TABLE IF NOT EXISTS build_warnings (
+         fingerprint TEXT NOT NULL,
+         builder TEXT NOT NULL,
+         buildnumber INTEGER NOT NULL,
+         count INTEGER NOT NULL,
+         step TEXT NOT NULL DEFAULT ''
+       )""",
+    "CREATE INDEX IF NOT EXISTS build_warnings_build"
+    " ON build_warnings (builder, buildnumber)",
+    ]
+
+# build_warnings had no step column at first
+MIGRATIONS = [
+    ("build_warnings", "step",
+     "ALTER TABLE build_warnings ADD COLUMN step TEXT NOT NULL DEFAULT ''"),
+    ]
+
+# /home/buildslave/x/build/.tox/py27/lib/python2.7/site-packages/foo/bar.py:12: DeprecationWarning: ...
+warning_re = re.compile(r'(?:(\S+\.py):\d+: )?(?:exceptions\.)?(\w*Warning): (.*)')
+
+# the longest of these in a path is where the module name starts
+MODULE_ROOTS = ["site-packages/", "dist-packages/", "src/", "build/"]
+
+PLACEHOLDERS = [(re.compile(r"(?:[A-Za-z]:)?[\\/]?(?:[\w.-]+[\\/])+[\w.-]+"),
+                 "<path>"),
+                (re.compile(r"0x[0-9a-fA-F]+"), "<addr>"),
+                (re.compile(r"\b\d+(?:\.\d+)*\b"), "<n>"),
+                ]
+
+def module_name(path):
+    # .../site-packages/twisted/internet/defer.py -> twisted.internet.defer
+    path = path.replace("\\", "/")
+    start = 0
+    for root in MODULE_ROOTS:
+        index = path.rfind("/" + root)
+        if index != -1:
+            start = max(start, index + len(root) + 1)
+    if start == 0:
+        start = path.rfind("/") + 1
+    name = path[start:]
+    if name.endswith(".py"):
+        name = name[:-len(".py")]
+    if name.endswith("/__init__"):
+        name = name[:-len("/__init__")]
+    return name.replace("/", ".")
+
+def fingerprint(warning):
+    """
+    Return (category, module, template) for the text of one warning (its
+    first line is enough), or None if it doesn't look like one.
+    """
+    mo = warning_re.search(warning.strip().split("\n")[0])
+    if not mo:
+        return None
+    path, category, message = mo.groups()
+    module = path and module_name(path) or ""
+    template = message.strip()
+    for (pattern, placeholder) in PLACEHOLDERS:
+        template = pattern.sub(placeholder, template)
+    return (category, module, template)
+
+def fingerprint_id(fp):
+    return hashlib.sha1("\0".join(fp).encode("utf-8")).hexdigest()[:16]
+
+def fingerprint_warnings(warnings):
+    """
+    Group 'warnings' (a dict of warning text to how often it was seen) by
+    fingerprint. Returns {fingerprint: [count, an example warning]}.
+    Warnings without a fingerprint are left out.
+    """
+    grouped = {}
+    for (warning, count) in warnings.items():
+        fp = fingerprint(warning)
+        if fp is None:
+            continue
+        if fp in grouped:
+            grouped[fp][0] += count
+        else:
+            grouped[fp] = [count, warning]
+    return grouped
+
+class WarningIndex(SqliteStore):
+    schema = SCHEMA
+    migrations = MIGRATIONS
+
+    def __init__(self, filename="warning-index.sqlite"):
+        SqliteStore.__init__(self, filename)
+
+    def record(self, builder, buildnumber, revision, grouped, step=""):
+        """
+        Store the warnings one step of a build saw, as returned by
+        fingerprint_warnings(), in place of what that step recorded
+        before. Return the fingerprints that no build had seen before,
+        sorted.
+        """
+        now = time.time()
+        db = self._connect()
+        db.execute("DELETE FROM build_warnings WHERE builder=?"
+                   " AND buildnumber=? AND step=?",
+                   (builder, buildnumber, step))
+        new = []
+        for (fp, (count, example)) in grouped.items():
+            fid = fingerprint_id(fp)
+            c = db.execute("UPDATE fingerprints SET last_seen=?"
+                           " WHERE fingerprint=?", (now, fid))
+            if not c.rowcount:
+                category, module, template = fp
+                db.execute("INSERT INTO fingerprints VALUES"
+                           " (?,?,?,?,?,?,?,?,?,?)",
+                           (fid, category, module, template, example,
+                            builder, buildnumber, revision, now, now))
+                new.append(fp)
+            db.execute("INSERT INTO build_warnings (fingerprint, builder,"
+                       " buildnumber, count, step) VALUES (?,?,?,?,?)",
+                       (fid, builder, buildnumber, count, step))
+        db.commit()
+        return sorted(new)
+
+    def first_seen(self, fp):
+        """
+        Return (builder, buildnumber, revision, first_seen) for a
+        fingerprint, or None if we have never seen it.
+        """
+        return self._connect().execute(
+            "SELECT first_builder, first_buildnumber, first_revision,"
+            " first_seen FROM fingerprints WHERE fingerprint=?",
+            (fingerprint_id(fp),)).fetchone()
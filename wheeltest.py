@@ -0,0 +1,290 @@
+"""
+Build a wheel once, install it a few ways, and test what got installed
+
+The install checks used to be a handful of steps (CreateEgg, InstallToEgg,
+TestFromEgg, ...) that each ran 'setup.py bdist_egg' or easy_install again
+from a long 'python -c' one-liner. Now the checkout is built into a single
+wheel, and every layout we check is made from that wheel:
+
+ - venv: an isolated environment that is kept between builds. It is
+   rebuilt (with the wheel's dependencies from the index, plus any
+   --require) only when those dependencies, the interpreter or the path
+   change; otherwise only the package itself is reinstalled.
+ - prefix: 'pip install --prefix', what a distribution package or a
+   'setup.py install --prefix' would have
+ - egg: an unpacked .egg directory with EGG-INFO, for the old
+   PYTHONPATH-of-eggs layout. A zipped copy goes next to the wheel, for
+   UploadEgg.
+
+It runs on the buildslave from the top of the checkout (master.cfg sends
+it over with a FileDownload step):
+
+  python ../wheeltest.py build
+  python ../wheeltest.py install venv ../wheel-env --fingerprint FP
+  python ../wheeltest.py test venv ../wheel-env [zfec.test]
+  python ../wheeltest.py install prefix prefixinstalldir
+  python ../wheeltest.py test prefix prefixinstalldir
+
+'test' runs trial from inside the install directory, with the interpreter
+and PYTHONPATH of that layout, after checking that the package under test
+really is imported from there and not from the checkout. The default
+suite is the wheel's top-level package plus '.test'.
+"""
+
+import os, sys, glob, shutil, zipfile, hashlib, argparse, subprocess
+from distutils import sysconfig
+
+def report(what):
+    # the wheel steps in bbsupport.py read these
+    sys.stdout.write("wheeltest: %s\n" % (what,))
+    sys.stdout.flush()
+
+def run(command, **kwargs):
+    report("running %s" % " ".join(command))
+    return subprocess.call(command, **kwargs)
+
+def find_wheel(dist):
+    wheels = glob.glob(os.path.join(dist, "*.whl"))
+    if not wheels:
+        raise SystemExit("wheeltest: no wheel in %s, run 'build' first" % dist)
+    # the newest, in case an older one was left behind
+    wheels.sort(key=os.path.getmtime)
+    return os.path.abspath(wheels[-1])
+
+class Wheel:
+    def __init__(self, filename):
+        self.filename = filename
+        parts = os.path.basename(filename)[:-len(".whl")].split("-")
+        self.name, self.version = parts[0], parts[1]
+        self.zip = zipfile.ZipFile(filename)
+        self.dist_info = "%s-%s.dist-info/" % (self.name, self.version)
+        self.data = "%s-%s.data/" % (self.name, self.version)
+
+    def read(self, name, default=""):
+        try:
+            return self.zip.read(self.dist_info + name).decode("utf-8")
+        except KeyError:
+            return default
+
+    def requires(self):
+        return [line.split(":", 1)[1].strip()
+                for line in self.read("METADATA").splitlines()
+                if line.startswith("Requires-Dist:")]
+
+    def top_level(self):
+        names = self.read("top_level.txt").split()
+        return names and names[0] or self.name.lower()
+
+    def purelib(self):
+        return "Root-Is-Purelib: true" in self.read("WHEEL")
+
+def build(options):
+    for old in glob.glob(os.path.join(options.dist, "*.whl")):
+        os.unlink(old)
+    command = [sys.executable, "-m", "pip", "wheel", "--no-deps",
+               "--wheel-dir", options.dist, "."]
+    if run(command) != 0:
+        # pip too old for 'pip wheel'
+        command = [sys.executable, "setup.py", "bdist_wheel",
+                   "--dist-dir", options.dist]
+        if run(command) != 0:
+            return 1
+    report("built %s" % os.path.basename(find_wheel(options.dist)))
+    return 0
+
+def env_python(env):
+    if os.name == "nt":
+        return os.path.join(env, "Scripts", "python.exe")
+    return os.path.join(env, "bin", "python")
+
+def env_key(wheel, options):
+    h = hashlib.sha256()
+    for part in (wheel.requires() + list(options.requires) +
+                 [options.fingerprint, sys.version,
+                  os.path.abspath(options.installdir)]):
+        h.update(part.encode("utf-8") + b"\0")
+    return h.hexdigest()[:16]
+
+def install_venv(wheel, options):
+    env = options.installdir
+    stamp = os.path.join(env, ".wheeltest-key")
+    key = env_key(wheel, options)
+    python = env_python(env)
+    if os.path.exists(stamp) and open(stamp).read() == key \
+            and os.path.exists(python):
+        report("env hit %s" % key)
+        return run([python, "-m", "pip", "install", "--no-deps",
+                    "--force-reinstall", wheel.filename])
+    report("env miss %s" % key)
+    if os.path.isdir(env):
+        shutil.rmtree(env)
+    try:
+        import venv
+        create = [sys.executable, "-m", "venv", env]
+    except ImportError:
+        create = [sys.executable, "-m", "virtualenv", env]
+    if run(create) != 0:
+        return 1
+    if run([python, "-m", "pip", "install", wheel.filename] +
+           list(options.requires)) != 0:
+        return 1
+    # only once everything is in, so a half-made env is made again
+    f = open(stamp, "w")
+    f.write(key)
+    f.close()
+    return 0
+
+def install_prefix(wheel, options):
+    if os.path.isdir(options.installdir):
+        shutil.rmtree(options.installdir)
+    return run([sys.executable, "-m", "pip", "install", "--no-deps",
+                "--no-index", "--ignore-installed", "--prefix",
+                options.installdir, wheel.filename])
+
+def egg_name(wheel):
+    name = "%s-%s-py%d.%d" % (wheel.name, wheel.version,
+                              sys.version_info[0], sys.version_info[1])
+    if not wheel.purelib():
+        from distutils.util import get_platform
+        name += "-" + get_platform()
+    return name + ".egg"
+
+def requires_txt(wheel):
+    lines = []
+    for requirement in wheel.requires():
+        if ";" in requirement:
+            # extras and environment markers don't fit requires.txt
+            continue
+        lines.append(requirement.replace(" ", "").replace("(", "")
+                     .replace(")", ""))
+    return "".join([line + "\n" for line in lines])
+
+def install_egg(wheel, options):
+    if os.path.isdir(options.installdir):
+        shutil.rmtree(options.installdir)
+    egg = os.path.join(options.installdir, egg_name(wheel))
+    egg_info = os.path.join(egg, "EGG-INFO")
+    os.makedirs(egg_info)
+    for member in wheel.zip.namelist():
+        if member.endswith("/"):
+            continue
+        if member.startswith(wheel.dist_info):
+            continue
+        target = member
+        if member.startswith(wheel.data):
+            kind, rest = member[len(wheel.data):].split("/", 1)
+            if kind in ("purelib", "platlib"):
+                target = rest
+            elif kind == "scripts":
+                target = "EGG-INFO/scripts/" + rest
+            else:
+                continue
+        path = os.path.join(egg, *target.split("/"))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        f = open(path, "wb")
+        f.write(wheel.zip.read(member))
+        f.close()
+    for (name, contents) in [("PKG-INFO", wheel.read("METADATA")),
+                             ("top_level.txt", wheel.read("top_level.txt")),
+                             ("entry_points.txt",
+                              wheel.read("entry_points.txt")),
+                             ("requires.txt", requires_txt(wheel))]:
+        if contents:
+            f = open(os.path.join(egg_info, name), "wb")
+            f.write(contents.encode("utf-8"))
+            f.close()
+    # the zipped egg, for UploadEgg
+    zipped = os.path.join(options.dist, egg_name(wheel))
+    z = zipfile.ZipFile(zipped, "w", zipfile.ZIP_DEFLATED)
+    for dirpath, dirnames, filenames in os.walk(egg):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            z.write(path, os.path.relpath(path, egg))
+    z.close()
+    report("wrote %s" % zipped)
+    return 0
+
+INSTALLERS = {"venv": install_venv, "prefix": install_prefix,
+              "egg": install_egg}
+
+def install(options):
+    wheel = Wheel(find_wheel(options.dist))
+    if INSTALLERS[options.layout](wheel, options) != 0:
+        return 1
+    report("installed %s into %s (%s)" % (os.path.basename(wheel.filename),
+                                          options.installdir, options.layout))
+    return 0
+
+def layout_environment(options):
+    # (python, environment) that see the installed copy
+    installdir = os.path.abspath(options.installdir)
+    env = os.environ.copy()
+    if options.layout == "venv":
+        python = env_python(installdir)
+        bindir = os.path.dirname(python)
+        paths = []
+    elif options.layout == "prefix":
+        python = sys.executable
+        bindir = os.path.join(installdir, os.name == "nt" and "Scripts"
+                              or "bin")
+        paths = [sysconfig.get_python_lib(plat, prefix=installdir)
+                 for plat in (True, False)]
+    else:
+        python = sys.executable
+        egg = os.path.join(installdir, egg_name(Wheel(find_wheel(options.dist))))
+        bindir = os.path.join(egg, "EGG-INFO", "scripts")
+        paths = [egg]
+    env["PATH"] = bindir + os.pathsep + env.get("PATH", "")
+    if paths:
+        env["PYTHONPATH"] = os.pathsep.join(paths + [env.get("PYTHONPATH",
+                                                             "")])
+    return python, env
+
+def test(options):
+    wheel = Wheel(find_wheel(options.dist))
+    suite = options.suite or wheel.top_level() + ".test"
+    package = suite.split(".")[0]
+    installdir = os.path.abspath(options.installdir)
+    if not os.path.isdir(installdir):
+        report("nothing installed in %s" % installdir)
+        return 1
+    python, env = layout_environment(options)
+    # from inside the install directory, so the checkout isn't on sys.path
+    where = subprocess.Popen([python, "-c", "import %s; print(%s.__file__)"
+                              % (package, package)], env=env, cwd=installdir,
+                             stdout=subprocess.PIPE).communicate()[0]
+    where = os.path.realpath(where.decode("utf-8").strip())
+    if not where.startswith(os.path.realpath(installdir) + os.sep):
+        report("%s is imported from %s, not from %s"
+               % (package, where or "nowhere", installdir))
+        return 1
+    report("testing %s from %s" % (package, where))
+    return run([python, "-m", "twisted.trial", suite], env=env,
+               cwd=installdir)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="build and test a wheel")
+    parser.add_argument("--dist", default="dist")
+    sub = parser.add_subparsers(dest="action")
+    sub.add_parser("build")
+    for action in ("install", "test"):
+        p = sub.add_parser(action)
+        p.add_argument("layout", choices=sorted(INSTALLERS))
+        p.add_argument("installdir")
+        if action == "install":
+            p.add_argument("--fingerprint", default="")
+            p.add_argument("--require", dest="requires", action="append",
+                           default=[], help="also put this in a venv")
+        else:
+            p.add_argument("suite", nargs="?")
+    options = parser.parse_args(argv)
+    options.dist = os.path.abspath(options.dist)
+    if options.action == "build":
+        return build(options)
+    elif options.action == "install":
+        return install(options)
+    return test(options)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))